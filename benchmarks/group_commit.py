@@ -0,0 +1,100 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Throughput benchmark of sheet saves with and without group commit.
+
+Many clients save sheets of their own as fast as they can, either each on its
+own autocommit connection (one commit per save) or through a GroupCommitter
+(each save is acknowledged after the commit it was batched into). Reports the
+number of saves per second for both.
+
+    python benchmarks/group_commit.py --clients 16 --saves 100 --window 0
+"""
+
+import optparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.committer import GroupCommitter
+from quarterapp.tests.storage_test import setup_sqlite
+
+def date(i):
+    return "2013-{0:02d}-{1:02d}".format(i / 28 % 12 + 1, i % 28 + 1)
+
+def autocommit_client(filename, user, saves):
+    db = sqlite3.connect(filename, isolation_level = None, timeout = 60)
+    for i in range(saves):
+        quarterapp.storage.update_sheet(db, user, date(i), [i % 8] * 96)
+    db.close()
+
+def group_commit_client(committer, user, saves):
+    done = threading.Event()
+    for i in range(saves):
+        done.clear()
+        committer.submit(quarterapp.storage.update_sheet, (user, date(i), [i % 8] * 96), {}, lambda result: done.set())
+        done.wait()
+
+def run(clients, target, args):
+    threads = [threading.Thread(target = target, args = args + (user, )) for user in range(1, clients + 1)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--clients", type = "int", default = 16, help = "Number of concurrent clients")
+    parser.add_option("--saves", type = "int", default = 100, help = "Number of saves per client")
+    parser.add_option("--window", type = "int", default = 0, help = "Group commit window in milliseconds")
+    parser.add_option("--batch", type = "int", default = 64, help = "Maximum number of writes per commit")
+    opts, args = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    db = setup_sqlite(filename)
+    quarterapp.migrations.migrate(db)
+    db.close()
+    total = opts.clients * opts.saves
+
+    elapsed = run(opts.clients, lambda user, saves = opts.saves: autocommit_client(filename, user, saves), ())
+    print("Commit per save: {0} saves in {1:.2f}s ({2:.0f} saves/s)".format(total, elapsed, total / elapsed))
+
+    committer = GroupCommitter(lambda: sqlite3.connect(filename, isolation_level = None, check_same_thread = False),
+        window = opts.window / 1000.0, max_batch = opts.batch)
+    elapsed = run(opts.clients, lambda user, saves = opts.saves: group_commit_client(committer, user, saves), ())
+    committer.close()
+    stats = committer.stats()
+    print("Group commit:    {0} saves in {1:.2f}s ({2:.0f} saves/s, {3:.1f} saves per commit)".format(
+        total, elapsed, total / elapsed, stats["average_batch"]))
+
+    os.remove(filename)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Load test of /api/sheet latency while a slow admin query is running.
+
+Runs the application in-process on a temporary SQLite database and measures
+sheet saves, first on their own and then while /admin/statistics runs a query
+that takes several seconds. With storage calls off the IOLoop the p99 of the
+second run should stay close to the first.
+
+    python benchmarks/sheet_latency.py --requests 500 --concurrency 10
+"""
+
+import optparse
+import os
+import sqlite3
+import tempfile
+import time
+import urllib
+
+import tornado.escape
+import tornado.httpserver
+import tornado.ioloop
+import tornado.web
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.options import options
+from tornado.testing import get_unused_port
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.quarterapp import define_options, create_application
+from quarterapp.pool import ConnectionPool
+from quarterapp.tests.storage_test import setup_sqlite
+
+SLOW_QUERY = """WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter WHERE x < %(rows)s)
+    SELECT COUNT(*) AS count FROM counter;"""
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def cookie(user):
+    value = tornado.web.create_signed_value(options.cookie_secret, "user", tornado.escape.json_encode(user))
+    return "user=" + value
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--requests", type = "int", default = 500, help = "Sheet saves per run")
+    parser.add_option("--concurrency", type = "int", default = 10, help = "Concurrent clients")
+    parser.add_option("--slow-rows", type = "int", default = 5000000, help = "Rows counted by the slow admin query")
+    opts, args = parser.parse_args()
+
+    define_options()
+    options.cookie_secret = "benchmark"
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    db = setup_sqlite(filename)
+    quarterapp.migrations.migrate(db)
+    user_id = quarterapp.storage._exec(db, "INSERT INTO users (username, password, type, state) VALUES('bob', '', 0, 1);")
+    db.commit()
+    db.close()
+
+    def slow_signup_count(db):
+        return quarterapp.storage._query(db, SLOW_QUERY, { "rows" : opts.slow_rows })[0].count
+    quarterapp.storage.get_signup_count = slow_signup_count
+
+    pool = ConnectionPool(lambda: sqlite3.connect(filename, isolation_level = None, check_same_thread = False), size = 4)
+    application = create_application(pool)
+    port = get_unused_port()
+    tornado.httpserver.HTTPServer(application).listen(port)
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    client = AsyncHTTPClient(max_clients = opts.concurrency)
+    user_cookie = cookie({ "id" : user_id, "type" : 0 })
+    admin_cookie = cookie({ "id" : 1, "type" : 1 })
+    body = urllib.urlencode({ "quarters" : ",".join(["-1"] * 96) })
+    url = "http://127.0.0.1:{0}".format(port)
+
+    @gen.engine
+    def save_sheets(callback):
+        latencies = []
+        def save(callback):
+            started = time.time()
+            def done(response):
+                latencies.append(time.time() - started)
+                callback(response)
+            client.fetch(HTTPRequest(url + "/api/sheet/2013-02-05", method = "PUT", body = body,
+                headers = { "Cookie" : user_cookie, "Content-Type" : "application/x-www-form-urlencoded" }), done)
+        for i in range(0, opts.requests, opts.concurrency):
+            yield [gen.Task(save) for j in range(min(opts.concurrency, opts.requests - i))]
+        callback(latencies)
+
+    @gen.engine
+    def run(callback):
+        baseline = yield gen.Task(save_sheets)
+
+        slow = [None]
+        def slow_done(response):
+            slow[0] = response
+        started = time.time()
+        client.fetch(HTTPRequest(url + "/admin/statistics", headers = { "Cookie" : admin_cookie }, request_timeout = 600), slow_done)
+        loaded = yield gen.Task(save_sheets)
+        during_slow = slow[0] is None
+
+        for name, latencies in (("baseline", baseline), ("slow admin query", loaded)):
+            print("{0:18} p50 {1:7.1f} ms  p99 {2:7.1f} ms  max {3:7.1f} ms".format(name,
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies) * 1000))
+        if not during_slow:
+            print("Warning: the slow query finished before the saves, raise --slow-rows")
+        while slow[0] is None:
+            yield gen.Task(io_loop.add_timeout, time.time() + 0.1)
+        print("slow admin query took {0:.1f} s".format(time.time() - started))
+        callback()
+
+    run(callback = lambda: io_loop.stop())
+    io_loop.start()
+    os.remove(filename)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Concurrency benchmark for sheet saves.
+
+Many clients, each with its own connection, save the same (user, date) as fast
+as they can. Reports the number of saves per second and verifies that the day
+still is a single row afterwards.
+
+    python benchmarks/sheet_upsert.py --clients 16 --saves 200
+"""
+
+import optparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.tests.storage_test import setup_sqlite
+
+USER = 1
+DATE = "2013-02-05"
+
+def client(filename, saves, errors):
+    db = sqlite3.connect(filename, timeout = 60)
+    try:
+        for i in range(saves):
+            quarterapp.storage.update_sheet(db, USER, DATE, [i % 8] * 96)
+            db.commit()
+    except Exception, e:
+        errors.append(e)
+    finally:
+        db.close()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--clients", type = "int", default = 16, help = "Number of concurrent clients")
+    parser.add_option("--saves", type = "int", default = 200, help = "Number of saves per client")
+    opts, args = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    db = setup_sqlite(filename)
+    quarterapp.migrations.migrate(db)
+    db.commit()
+
+    errors = []
+    threads = [threading.Thread(target = client, args = (filename, opts.saves, errors)) for i in range(opts.clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    rows = quarterapp.storage._query(db, "SELECT id FROM sheets WHERE user=%(user)s AND date=%(date)s;",
+        { "user" : USER, "date" : DATE })
+    total = opts.clients * opts.saves
+    print("{0} saves from {1} clients in {2:.2f}s ({3:.0f} saves/s)".format(total, opts.clients, elapsed, total / elapsed))
+    print("Rows for the day: {0}, errors: {1}".format(len(rows), len(errors)))
+
+    db.close()
+    os.remove(filename)
+
+if __name__ == "__main__":
+    main()
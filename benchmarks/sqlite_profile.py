@@ -0,0 +1,137 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compares SQLite performance profiles on a sheet heavy workload.
+
+A database with a year of sheets for a number of users is copied for each
+profile. Writer threads then save sheets while reader threads load a month of
+sheets at a time, for a fixed duration. Reports the saves and reads per second
+and the read latency for each profile.
+
+    python benchmarks/sqlite_profile.py --writers 2 --readers 4 --seconds 5
+"""
+
+import datetime
+import optparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.tests.storage_test import setup_sqlite
+
+PROFILES = [
+    ("default", { "journal_mode" : "delete", "synchronous" : "full", "cache_size" : -2000, "mmap_size" : 0, "temp_store" : "default" }),
+    ("wal", { "journal_mode" : "wal", "synchronous" : "full", "cache_size" : -2000, "mmap_size" : 0, "temp_store" : "default" }),
+    ("wal+cache+mmap", { "journal_mode" : "wal", "synchronous" : "full", "cache_size" : -16000, "mmap_size" : 67108864, "temp_store" : "memory" }),
+    ("wal+normal", { "journal_mode" : "wal", "synchronous" : "normal", "cache_size" : -16000, "mmap_size" : 67108864, "temp_store" : "memory" }),
+]
+
+FIRST_DAY = datetime.date(2012, 1, 1)
+
+def day(offset):
+    return str(FIRST_DAY + datetime.timedelta(days = offset))
+
+def populate(filename, users, days):
+    db = setup_sqlite(filename)
+    quarterapp.migrations.migrate(db)
+    for user in range(1, users + 1):
+        quarterapp.storage.update_sheets(db, user, [(day(offset), [(user + offset + i / 8) % 6 for i in range(96)]) for offset in range(days)])
+    db.close()
+
+def connect(filename, pragmas):
+    db = sqlite3.connect(filename, isolation_level = None, check_same_thread = False)
+    quarterapp.storage.apply_pragmas(db, dict(pragmas, busy_timeout = 30000))
+    return db
+
+def writer(filename, pragmas, users, days, stop, counts):
+    db = connect(filename, pragmas)
+    rand = random.Random()
+    while not stop.is_set():
+        quarterapp.storage.update_sheet(db, rand.randint(1, users), day(rand.randrange(days)), [rand.randrange(6)] * 96)
+        counts.append(1)
+    db.close()
+
+def reader(filename, pragmas, users, days, stop, latencies):
+    db = connect(filename, pragmas)
+    rand = random.Random()
+    while not stop.is_set():
+        start = rand.randrange(days - 30)
+        started = time.time()
+        quarterapp.storage.get_sheets(db, rand.randint(1, users), day(start), day(start + 30))
+        latencies.append(time.time() - started)
+    db.close()
+
+def run_profile(source, pragmas, opts):
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    shutil.copyfile(source, filename)
+    connect(filename, pragmas).close()
+
+    stop = threading.Event()
+    saves = []
+    latencies = []
+    threads = [threading.Thread(target = writer, args = (filename, pragmas, opts.users, opts.days, stop, saves)) for i in range(opts.writers)]
+    threads += [threading.Thread(target = reader, args = (filename, pragmas, opts.users, opts.days, stop, latencies)) for i in range(opts.readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(opts.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+    return len(saves) / opts.seconds, len(latencies) / opts.seconds, p99
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--users", type = "int", default = 100, help = "Number of users with sheets")
+    parser.add_option("--days", type = "int", default = 365, help = "Number of days of sheets per user")
+    parser.add_option("--writers", type = "int", default = 2, help = "Number of threads saving sheets")
+    parser.add_option("--readers", type = "int", default = 4, help = "Number of threads loading a month of sheets")
+    parser.add_option("--seconds", type = "float", default = 5, help = "Duration of each profile run")
+    opts, args = parser.parse_args()
+
+    fd, source = tempfile.mkstemp()
+    os.close(fd)
+    populate(source, opts.users, opts.days)
+
+    print("{0:<16} {1:>10} {2:>10} {3:>14}".format("profile", "saves/s", "reads/s", "read p99 ms"))
+    for name, pragmas in PROFILES:
+        saves, reads, p99 = run_profile(source, pragmas, opts)
+        print("{0:<16} {1:>10.0f} {2:>10.0f} {3:>14.1f}".format(name, saves, reads, p99))
+
+    os.remove(source)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Microbenchmark of the per call overhead in storage._query and storage._exec.
+
+Compares the statement registry against translating the SQL on every call
+(the way the old hack_sql decorator did) on an in-memory SQLite database.
+
+    python benchmarks/storage_overhead.py --calls 100000
+"""
+
+import optparse
+import re
+import sqlite3
+import timeit
+
+import quarterapp.storage
+
+_SQLITE_RE = re.compile(r'%\((\w+)\)s')
+
+QUERY = "SELECT quarters FROM sheets WHERE user=%(user)s and date=%(date)s"
+EXEC = "UPDATE sheets SET quarters=%(quarters)s WHERE user=%(user)s and date=%(date)s"
+PARAMS = { "user" : 1, "date" : "2013-02-05", "quarters" : "" }
+
+def translate_per_call(db, sql, params):
+    """The old hack_sql translation, done on every call"""
+    if isinstance(db, sqlite3.Connection):
+        sql = _SQLITE_RE.sub(r':\1', sql.replace('%s', '?'))
+    cursor = db.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+def per_call(fn, calls):
+    """Microseconds per call"""
+    return min(timeit.repeat(fn, number = calls, repeat = 3)) / calls * 1000000
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--calls", type = "int", default = 100000, help = "Number of calls per measurement")
+    opts, args = parser.parse_args()
+
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE sheets (id INTEGER PRIMARY KEY, user INT, date DATE, quarters BLOB);")
+    db.execute("CREATE UNIQUE INDEX sheets_user_date ON sheets (user, date);")
+
+    results = [
+        ("_query, translated per call", per_call(lambda: translate_per_call(db, QUERY, PARAMS), opts.calls)),
+        ("_query, statement registry", per_call(lambda: quarterapp.storage._query(db, QUERY, PARAMS), opts.calls)),
+        ("_exec, translated per call", per_call(lambda: translate_per_call(db, EXEC, PARAMS), opts.calls)),
+        ("_exec, statement registry", per_call(lambda: quarterapp.storage._exec(db, EXEC, PARAMS), opts.calls)),
+    ]
+    for name, usec in results:
+        print("{0:32} {1:6.2f} us/call".format(name, usec))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of the admin username search on a synthetic users table.
+
+Fills a SQLite database with generated users, builds the username search index
+and compares a search done as a LIKE scan (count and first page) with the count
+and the first page of the admin listing answered by the index.
+
+    python benchmarks/user_search.py --users 1000000
+"""
+
+import optparse
+import os
+import random
+import tempfile
+import time
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.tests.storage_test import setup_sqlite
+
+NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi", "ivan", "judy", "mallory", "oscar"]
+DOMAINS = ["example.com", "internet.com", "mail.se", "quarterapp.com", "smhi.se", "university.edu"]
+
+SEARCHES = ["frank", "smhi.se", "y4242", "mallory8"]
+
+def generate_users(count):
+    rand = random.Random(42)
+    for i in range(count):
+        yield { "username" : "{0}{1}@{2}".format(rand.choice(NAMES), i, rand.choice(DOMAINS)) }
+
+def like_search(db, query_filter):
+    """The search as it was done before the index, a LIKE scan for both the count and the page"""
+    params = { "filter" : "%{0}%".format(query_filter), "count" : 5 }
+    count = quarterapp.storage._query(db, "SELECT COUNT(*) FROM users WHERE username LIKE %(filter)s;", params)
+    users = quarterapp.storage._query(db, "SELECT id, username, type, state, last_login FROM users WHERE username LIKE %(filter)s ORDER BY id LIMIT %(count)s;", params)
+    return getattr(count[0], "COUNT(*)"), users
+
+def index_page(db, query_filter):
+    """A page of the admin users listing, as /admin/users reads it"""
+    users = quarterapp.storage.get_filtered_users(db, query_filter, count = 5, after_id = 0)
+    quarterapp.storage.get_user_ids_after(db, 0, 46, query_filter)
+    return users
+
+def timed(fn, *args):
+    """Best of three, in milliseconds"""
+    best = None
+    for i in range(3):
+        started = time.time()
+        result = fn(*args)
+        elapsed = (time.time() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--users", type = "int", default = 1000000, help = "Number of users to generate")
+    opts, args = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    db = setup_sqlite(filename)
+    quarterapp.migrations.migrate(db, target = 3)
+
+    started = time.time()
+    db.cursor().executemany("INSERT INTO users (username, password, type, state) VALUES(:username, '', 0, 1);",
+        generate_users(opts.users))
+    db.commit()
+    print("Generated {0} users in {1:.1f}s".format(opts.users, time.time() - started))
+
+    started = time.time()
+    quarterapp.migrations.migrate(db, target = 4)
+    print("Built the search index in {0:.1f}s".format(time.time() - started))
+
+    print("{0:<12} {1:>8} {2:>10} {3:>12} {4:>12}".format("filter", "matches", "like ms", "index count", "index page"))
+    for query_filter in SEARCHES:
+        like_ms, (like_count, like_users) = timed(like_search, db, query_filter)
+        count_ms, count = timed(quarterapp.storage.get_filtered_user_count, db, query_filter)
+        page_ms, users = timed(index_page, db, query_filter)
+        assert like_count == count
+        assert [user.id for user in like_users] == [user.id for user in users]
+        print("{0:<12} {1:>8} {2:>10.1f} {3:>12.1f} {4:>12.1f}".format(query_filter, count, like_ms, count_ms, page_ms))
+
+    db.close()
+    os.remove(filename)
+
+if __name__ == "__main__":
+    main()
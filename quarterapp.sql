@@ -15,7 +15,7 @@ CREATE TABLE `sheets` (
     `id` INT(11) UNSIGNED NOT NULL AUTO_INCREMENT,
     `user` INT(11) NOT NULL,
     `date` DATE NOT NULL,
-    `quarters` TEXT NOT NULL,
+    `quarters` BLOB NOT NULL,
     PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
@@ -30,7 +30,7 @@ CREATE TABLE `settings` (
 CREATE TABLE `users` (
     `id` int(11) UNSIGNED NOT NULL AUTO_INCREMENT,
     `username` VARCHAR(256) NOT NULL DEFAULT '',
-    `password` VARCHAR(90) NOT NULL DEFAULT '',
+    `password` VARCHAR(255) NOT NULL DEFAULT '',
     `type` TINYINT NOT NULL DEFAULT '0',
     `state`  TINYINT NOT NULL DEFAULT '0',
     `last_login` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -23,9 +23,11 @@
 import logging
 import sys
 import os
+import time
 
 import tornado.web
 import tornado.escape
+from tornado import gen
 from tornado.options import options
 
 from basehandlers import *
@@ -33,10 +35,17 @@ from storage import *
 from email_utils import *
 from quarter_errors import *
 from quarter_utils import *
+from sessions import new_token, session_id
 
-class LogoutHandler(BaseHandler):
+class LogoutHandler(AuthenticatedHandler):
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
-        self.clear_cookie("user")
+        token = self.get_cookie("session")
+        if token:
+            self.application.sessions.forget(token)
+            yield self.storage.delete_session(session_id(token))
+        self.set_session(None)
         self.redirect(u"/")
 
 class SignupHandler(BaseHandler):
@@ -46,6 +55,8 @@ class SignupHandler(BaseHandler):
         else:
             raise tornado.web.HTTPError(404)
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         if not self.enabled("allow-signups"):
             raise tornado.web.HTTPError(500)
@@ -55,17 +66,17 @@ class SignupHandler(BaseHandler):
         error = False
         if len(username) == 0:
             error = "empty"
-        if not username_unique(self.application.db, username):
+        unique = yield self.storage.username_unique(username)
+        if not unique:
             error = "not_unique"
 
         if not error:
             try:
                 code = os.urandom(16).encode("base64")[:20]
-                if send_signup_email(username, code):
-                    signup_user(self.application.db, username, code, self.request.remote_ip)
-                    self.render(u"public/signup_instructions.html")
-                else:
-                    self.render(u"public/signup.html", error = error, username = username)    
+                yield self.storage.signup_user(username, code, self.request.remote_ip,
+                    signup_email(username, code))
+                self.wake_mailer()
+                self.render(u"public/signup_instructions.html")
             except Exception, e:
                 logging.error("Could not signup user: %s" % (e,))
                 self.render(u"public/signup.html", error = error, username = username)
@@ -84,6 +95,8 @@ class ActivationHandler(BaseHandler):
         else:
             raise tornado.web.HTTPError(404)
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         if not self.enabled("allow-activations"):
             raise tornado.web.HTTPError(500)
@@ -101,8 +114,14 @@ class ActivationHandler(BaseHandler):
         if error:
             self.render(u"public/activate.html", error = "not_valid", code = None)
         else:
-            salted_password = hash_password(password, options.salt)
-            if activate_user(self.application.db, code, salted_password):
+            salted_password = yield self.passwords.hash(password)
+            try:
+                activated = yield self.storage.activate_user(code, salted_password)
+            except Exception, e:
+                logging.error("Could not activate user: %s" % (e,))
+                self.render(u"public/activate.html", error = "unknown", code = code)
+                return
+            if activated:
                 # TODO Do login
                 self.redirect(u"/sheet")
             else:
@@ -112,6 +131,8 @@ class ForgotPasswordHandler(BaseHandler):
     def get(self):
         self.render(u"public/forgot.html", error = None, username = None)
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         username = self.get_argument("username", "")
         error = False
@@ -119,8 +140,10 @@ class ForgotPasswordHandler(BaseHandler):
             self.render(u"public/forgot.html", error = "empty", username = username)
         else:
             reset_code = os.urandom(16).encode("base64")[:20]
-            if set_user_reset_code(self.application.db, username, reset_code):
-                send_reset_email(username, reset_code)
+            code_set = yield self.storage.set_user_reset_code(username, reset_code,
+                reset_email(username, reset_code))
+            if code_set:
+                self.wake_mailer()
                 self.redirect(u"/reset")
             else:
                 self.render(u"public/forgot.html", error = "unknown", username = username)
@@ -132,6 +155,8 @@ class ResetPasswordHandler(BaseHandler):
             code = code_parameter
         self.render(u"public/reset.html", error = None, code = code)
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         code = self.get_argument("code", "")
         password = self.get_argument("password", "")
@@ -146,8 +171,9 @@ class ResetPasswordHandler(BaseHandler):
         if error:
             self.render(u"public/reset.html", error = "unknown", code = code)
         else:
-            salted_password = hash_password(password, options.salt)
-            if reset_password(self.application.db, code, salted_password):
+            salted_password = yield self.passwords.hash(password)
+            reset = yield self.storage.reset_password(code, salted_password)
+            if reset:
                 # TODO Do login
                 self.redirect(u"/sheet")
             else:
@@ -159,17 +185,25 @@ class LoginHandler(AuthenticatedHandler):
 
         self.render(u"public/login.html", allow_signups = allow_signups)
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
-        hashed_password = hash_password(password, options.salt)
-
-        user = authenticate_user(self.application.db, username, hashed_password)
-        if user:
+        user = yield self.storage.get_login(username)
+        # An unknown username is checked too, so the time taken does not tell which usernames exist
+        valid, upgraded = yield self.passwords.check(password, user.password if user else None)
+        if upgraded:
+            yield self.storage.set_password(user.id, upgraded)
+        if valid and user.state == User.Enabled:
             logging.warn("User authenticated")
-            self.set_current_user(user)
+            token = new_token()
+            expires = time.time() + options.session_days * 24 * 60 * 60
+            yield self.storage.create_session(session_id(token), user.id, expires)
+            self.application.sessions.remember(token, user, expires)
+            self.set_session(token)
             self.redirect(u"/sheet")
         else:
             logging.warn("User not authenticated")
-            self.set_current_user(None)
+            self.set_session(None)
             self.render(u"public/login.html")
@@ -28,6 +28,7 @@ import json
 
 import tornado.web
 import tornado.escape
+from tornado import gen
 from tornado.options import options
 from tornado.web import HTTPError
 
@@ -37,6 +38,7 @@ from quarter_errors import *
 from quarter_utils import *
 
 DEFAULT_PAGINATION_ITEMS_PER_PAGE = 5
+MAX_PAGINATION_ITEMS_PER_PAGE = 100
 DEFAULT_PAGINATION_PAGES = 10
 
 class AdminDefaultHandler(AuthenticatedHandler):
@@ -55,88 +57,86 @@ class AdminUsersHandler(AuthenticatedHandler):
     """
     Handler for user listing and searching
     """
-    @authenticated_admin
-    def generate_pagination(self, total, current, max_per_page, max_links, query_filter = None):
+    def generate_pagination(self, page, after_id, previous_ids, next_ids, count, query_filter = None):
         """
-        Generate a list of pagination links based on the following input.
+        Generate the pagination links around the current page. Pages are
+        addressed by the id of the user preceding them (keyset pagination), so
+        only the ids within the window of links are needed, never the total
+        number of users.
 
         Try to keep the current page at the center of the returned list
 
-        @param total The total number of items (not per page)
-        @param current The current position / index within that range (0:total)
-        @param max_per_page The maximum number of links per page
-        @param max_pages The maximum number of pagination links to return
+        The page index comes from the client and is only used to number the
+        links. It is corrected to agree with the ids found, the page is the
+        number of pages before it when the first page is within the window,
+        and never less than the pages before it otherwise.
+
+        @param page The index of the current page
+        @param after_id The id preceding the first user on the current page
+        @param previous_ids The ids up to and including after_id, in descending order
+        @param next_ids The ids following after_id, in ascending order
+        @param count The number of users per page
+        @param query_filter The username filter to keep in the links
         """
-        pagination = []
-        total_pages = 0
-        current_page = 0
-        
-        try:
-            if total == 0:
-                total_pages = 0
-            elif int(total) < int(max_per_page):
-                total_pages = 1
+        def link(index, after):
+            url = "/admin/users?after={0}&page={1}&count={2}".format(after, index, count)
+            if query_filter:
+                url += "&filter=" + tornado.escape.url_escape(query_filter)
+            return { 'index' : index, 'link' : url, 'current' : index == page }
+
+        # The ids preceding the pages before the current one, nearest first
+        boundaries = []
+        for distance in range(1, DEFAULT_PAGINATION_PAGES / 2 + 1):
+            if not previous_ids:
+                break
+            position = distance * count
+            if position < len(previous_ids):
+                boundaries.append(previous_ids[position])
             else:
-                total_pages = int(total) / int(max_per_page)
-                if int(total) % int(max_per_page) != 0:
-                    total_pages = total_pages + 1 
-            
-            if int(current) < int(max_per_page):
-                current_page = 0
-            else:
-                current_page = int(current) / int(max_per_page)
-
-            for i in range(total_pages):
-                start = int(i) * int(max_per_page)
+                boundaries.append(0)
+                break
 
-                link = ""
-                if query_filter:
-                    link = "/admin/users?start={0}&count={1}&filter={2}".format(start, max_per_page, query_filter)
-                else:
-                    link = "/admin/users?start={0}&count={1}".format(start, max_per_page)
-
-                current_page = int(start) <= int(current) < (int(start) + int(max_per_page))
-                
-                p = { 'index' : i, 'link' : link, 'current' : current_page }
-                pagination.append(p)
+        if not boundaries or boundaries[-1] == 0:
+            page = len(boundaries)
+        else:
+            page = max(page, len(boundaries) + 1)
 
-        except:
-            logging.warn("Could not generate the users pagination: %s", sys.exc_info())
+        before = [link(page - distance, boundary) for distance, boundary in enumerate(boundaries, 1)]
+        after = [link(page, after_id)]
+        for distance in range(1, DEFAULT_PAGINATION_PAGES - len(before)):
+            position = distance * count
+            if position >= len(next_ids):
+                break
+            after.append(link(page + distance, next_ids[position - 1]))
 
-        return pagination
+        return list(reversed(before)) + after
 
     @authenticated_admin
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
-        start = self.get_argument("start", "")
+        after_id = self.get_argument("after", "0")
+        page = self.get_argument("page", "0")
         count = self.get_argument("count", "")
         query_filter = self.get_argument("filter", "")
-        
-        users = []
-        pagination_link = []
-        error = False
-
-        if len(start) > 0:
-            if not start.isdigit():
-                error = True
-        else:
-            start = 0 # Default start index
 
-        if len(count) > 0:
-            if not count.isdigit():
-                error = True
-        else:
-            count = DEFAULT_PAGINATION_ITEMS_PER_PAGE
+        if not count:
+            count = str(DEFAULT_PAGINATION_ITEMS_PER_PAGE)
 
-        if not error:
+        if after_id.isdigit() and page.isdigit() and count.isdigit() and int(count) > 0:
+            after_id, page, count = int(after_id), int(page), min(int(count), MAX_PAGINATION_ITEMS_PER_PAGE)
+            behind = DEFAULT_PAGINATION_PAGES / 2 * count + 1
+            ahead = (DEFAULT_PAGINATION_PAGES - 1) * count + 1
             try:
                 if query_filter:
-                    user_count = get_filtered_user_count(self.application.db, query_filter)
-                    pagination_links = self.generate_pagination(user_count, start, count, DEFAULT_PAGINATION_PAGES, query_filter = query_filter)
-                    users = get_filtered_users(self.application.db, query_filter, start, count)
+                    users = yield self.storage.get_filtered_users(query_filter, count = count, after_id = after_id)
                 else:
-                    user_count = get_user_count(self.application.db)
-                    pagination_links = self.generate_pagination(user_count, start, count, DEFAULT_PAGINATION_PAGES)
-                    users = get_users(self.application.db, start, count)
+                    users = yield self.storage.get_users(count = count, after_id = after_id)
+                previous_ids = []
+                if after_id > 0:
+                    previous_ids = yield self.storage.get_user_ids_through(after_id, behind, query_filter)
+                next_ids = yield self.storage.get_user_ids_after(after_id, ahead, query_filter)
+                pagination_links = self.generate_pagination(page, after_id, previous_ids, next_ids, count, query_filter = query_filter)
 
                 self.render(u"admin/users.html", users = users, pagination = pagination_links, error = False, query_filter = query_filter)
             except:
@@ -158,6 +158,8 @@ class AdminNewUserHandler(AuthenticatedHandler):
         self.render(u"admin/new-user.html", completed = False, error = False)
 
     @authenticated_admin
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
@@ -173,13 +175,14 @@ class AdminNewUserHandler(AuthenticatedHandler):
             error = True
         if not password == verify_password:
             error = True
-        if not username_unique(self.application.db, username):
+        unique = yield self.storage.username_unique(username)
+        if not unique:
             error = True
 
         if not error:
             try:
-                salted_password = hash_password(password, options.salt)
-                add_user(self.application.db, username, salted_password, ut)
+                salted_password = yield self.passwords.hash(password)
+                yield self.storage.add_user(username, salted_password, ut)
                 self.render(u"admin/new-user.html", completed = True, error = False)
             except:
                 self.render(u"admin/new-user.html", completed = False, error = True)
@@ -191,13 +194,26 @@ class AdminStatisticsHandler(AuthenticatedHandler):
     Handler for rendering the statistics view
     """
     @authenticated_admin
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
-        user_count = get_user_count(self.application.db)
-        signup_count = get_signup_count(self.application.db)
+        user_count = yield self.storage.get_user_count()
+        signup_count = yield self.storage.get_signup_count()
+        sheet_count = yield self.storage.get_sheet_count()
+        outbox_size = yield self.storage.get_outbox_size()
         quarter_count = 0
+        pool_stats = self.application.pool.stats()
+        committer = self.application.storage.committer
+        commit_stats = committer.stats() if committer else None
+        cache = self.application.storage.cache
+        cache_stats = cache.stats() if cache else None
+        mailer = self.application.mailer
+        mail_stats = mailer.stats() if mailer else None
 
         self.render(u"admin/statistics.html",
-            user_count = user_count, signup_count = signup_count, quarter_count = quarter_count)
+            user_count = user_count, signup_count = signup_count, sheet_count = sheet_count, quarter_count = quarter_count,
+            pool_stats = pool_stats, commit_stats = commit_stats, cache_stats = cache_stats,
+            outbox_size = outbox_size, mail_stats = mail_stats)
 
 #
 # Admin API handlers
@@ -224,11 +240,15 @@ class SettingsHandler(AuthenticatedHandler):
             self.respond_with_error(ERROR_RETRIEVE_SETTING)
 
     @authenticated_admin
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self, key):
         try:
             if key:
                 value = self.get_argument("value", "")
-                self.application.quarter_settings.put_value(key, value)
+                succeeded, error = yield gen.Task(self.application.quarter_settings.put_value, key, value)
+                if not succeeded:
+                    raise error[0], error[1], error[2]
                 self.write({"key" : key, "value" : value})
                 self.finish()
             else:
@@ -239,10 +259,13 @@ class SettingsHandler(AuthenticatedHandler):
 
 class AdminDisableUser(AuthenticatedHandler):
     @authenticated_admin
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self, username):
         if len(username) > 0:
             try:
-                disable_user(self.application.db, username)
+                yield self.storage.disable_user(username)
+                self.application.sessions.poll()
                 self.write_success()
             except:
                 logging.error("Could not disble user: %s", sys.exc_info())
@@ -253,10 +276,12 @@ class AdminDisableUser(AuthenticatedHandler):
         
 class AdminEnableUser(AuthenticatedHandler):
     @authenticated_admin
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self, username):
         if len(username) > 0:
             try:
-                enable_user(self.application.db, username)
+                yield self.storage.enable_user(username)
                 self.write_success()
             except:
                 logging.error("Could not enable user: %s", sys.exc_info())
@@ -266,15 +291,61 @@ class AdminEnableUser(AuthenticatedHandler):
             self.respond_with_error(ERROR_ENABLE_NO_USER)
 
 class AdminDeleteUser(AuthenticatedHandler):
+    """
+    Deletes a user and all of its data. The rows are deleted in chunks, the
+    number of chunks and rows deleted so far can be polled with a GET while the
+    delete is running.
+    """
+    @authenticated_admin
+    def get(self, username):
+        status = self.application.deletions.get(username)
+        if status is None:
+            self.respond_with_error(ERROR_NO_DELETE_RUNNING)
+        else:
+            self.write(dict(status, error = SUCCESS_CODE, message = "Ok"))
+            self.finish()
+
     @authenticated_admin
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self, username):
         if len(username) > 0:
+            status = { "chunks" : 0, "activities" : 0, "sheets" : 0 }
+            finished = { "activities" : 0, "sheets" : 0 }
+
+            def progress(table, deleted):
+                # Called on the storage thread, the status is only changed on the IOLoop
+                def update():
+                    status["chunks"] += 1
+                    status[table] = finished[table] + deleted
+                    logging.info("Deleting user %s: %d rows removed from %s", username, deleted, table)
+                self.storage.io_loop.add_callback(update)
+
+            self.application.deletions[username] = status
             try:
-                delete_user(self.application.db, username)
-                self.write_success()
+                user_id = yield self.storage.get_user_id(username)
+                if self.storage.shards and user_id is not None:
+                    # The user's data may be on another shard, delete it while the user can still be located
+                    data = yield self.storage.delete_user_data(user_id, progress = progress)
+                    finished.update(data)
+                deleted = yield self.storage.delete_user(username, progress = progress)
+                if user_id is not None:
+                    self.storage.invalidate(user_id)
+                deleted = dict(deleted, activities = deleted["activities"] + finished["activities"],
+                    sheets = deleted["sheets"] + finished["sheets"])
+                logging.info("Deleted user %s in %d chunks: %s", username, status["chunks"], deleted)
+                self.application.sessions.poll()
+                self.write({
+                    "error" : SUCCESS_CODE,
+                    "message" : "Ok",
+                    "chunks" : status["chunks"],
+                    "deleted" : deleted })
+                self.finish()
             except:
                 logging.error("Could not delete user: %s", sys.exc_info())
                 self.respond_with_error(ERROR_DELETE_USER)
+            finally:
+                del self.application.deletions[username]
         else:
             logging.error("Could not delete user - no user given: %s", sys.exc_info())
             self.respond_with_error(ERROR_DELETE_NO_USER)
@@ -20,6 +20,7 @@
 #  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 #  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import functools
 import logging
 import sys
 import os
@@ -29,9 +30,11 @@ from collections import Counter
 
 import tornado.web
 import tornado.escape
+from tornado import gen
 from tornado.options import options
 from tornado.web import HTTPError
 
+import sheet_codec
 from basehandlers import *
 from storage import *
 from quarter_errors import *
@@ -42,18 +45,22 @@ class ActivityApiHandler(AuthenticatedHandler):
     The activity API handler implements all supported operations on activities.
     """
     @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
         """
         Get the complete list of activities
         """
         user_id  = self.get_current_user_id()
-        activities = get_activities(self.application.db, user_id)
+        activities = yield self.storage.get_activities(user_id)
         if not activities:
             activities = []
-        self.write( { "activities" : activities } )
+        self.write( { "activities" : [dict(activity) for activity in activities] } )
         self.finish()
 
     @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         """
         Create a new activity
@@ -74,12 +81,13 @@ class ActivityApiHandler(AuthenticatedHandler):
         if len(errors) > 0:
             self.respond_with_errors(errors)
         else:
-            activity_id = add_activity(self.application.db, user_id, title, color)
-            activity = get_activity(self.application.db, user_id, activity_id)
-            self.write( { "activity" : activity } )
+            activity_id = yield self.storage.add_activity(user_id, title, color)
+            self.write( { "activity" : { "id" : activity_id, "title" : title, "color" : color } } )
             self.finish()
 
     @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
     def put(self, activity_id):
         """
         Update a given activity
@@ -100,12 +108,14 @@ class ActivityApiHandler(AuthenticatedHandler):
         if len(errors) > 0:
             self.respond_with_errors(errors)
         else:
-            update_activity(self.application.db, user_id, activity_id, title, color)
-            activity = get_activity(self.application.db, user_id, activity_id)
-            self.write( { "activity" : activity } )
+            yield self.storage.update_activity(user_id, activity_id, title, color)
+            activity = yield self.storage.get_activity(user_id, activity_id)
+            self.write( { "activity" : dict(activity) if activity else None } )
             self.finish()
 
     @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
     def delete(self, activity_id):
         """
         Delete a given activity
@@ -120,38 +130,272 @@ class ActivityApiHandler(AuthenticatedHandler):
             if len(errors) > 0:
                 self.respond_with_errors(errors)
             else:
-                delete_activity(self.application.db, user_id, activity_id)
+                yield self.storage.delete_activity(user_id, activity_id)
                 self.write_success()
         except:
             logging.warn("Could not delete activity: %s", sys.exc_info())
             self.respond_with_error(ERROR_DELETE_ACTIVITY)
 
 class SheetApiHandler(AuthenticatedHandler):
+    def sheet_etag(self, user_id, date, version):
+        """
+        Get the ETag of a version of the user's sheet of a date
+        """
+        return '"{0}-{1}-{2}"'.format(user_id, date, version)
+
+    def etag_matches(self, etag):
+        """
+        Check if the request's If-None-Match lists the given ETag (compared
+        weakly, as If-None-Match is) or is *
+        """
+        tags = [tag.strip() for tag in self.request.headers.get("If-None-Match", "").split(",")]
+        return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+    def get_sheet_version(self):
+        """
+        Get the version a write was based on, from the version argument
+
+        @return The version, None if not given
+        @raise ValueError If the version is not a number
+        """
+        version = self.get_argument("version", None)
+        if version is None or version == "":
+            return None
+        return int(version)
+
+    def respond_with_stale_sheet(self, user_id, date, stale):
+        """
+        Respond to a write based on an old version with HTTP 409 and the
+        stored sheet, so the client can apply its change on top of it and
+        send it again
+
+        @param stale The storage.StaleSheet raised by the write
+        """
+        self.set_header("Etag", self.sheet_etag(user_id, date, stale.version))
+        self.set_status(409)
+        self.finish({
+            "error" : ERROR_STALE_SHEET.code,
+            "message" : ERROR_STALE_SHEET.message,
+            "date" : date,
+            "version" : stale.version,
+            "runs" : sheet_codec.encode_runs(stale.quarters),
+            "summary" : Counter(str(quarter) for quarter in stale.quarters) })
+
+    @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, date):
+        """
+        Get the sheet of the given date, a day without a sheet has no work in
+        any quarter. The response has an ETag from the sheet's version, a
+        request with a matching If-None-Match gets a 304 without a body.
+
+        @param date The sheet date in format YYYY-MM-DD
+        @return a JSON map with the run-length encoded quarters (see
+            sheet_codec.encode_runs), the activity summary and the version
+        """
+        user_id  = self.get_current_user_id()
+
+        if not valid_date(date):
+            self.respond_with_error(ERROR_INVALID_SHEET_DATE)
+            return
+
+        version, quarters = yield self.storage.get_sheet_version(user_id, date)
+        etag = self.sheet_etag(user_id, date, version)
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control", "private, no-cache")
+        if self.etag_matches(etag):
+            self.set_status(304)
+            self.finish()
+            return
+
+        if quarters is None:
+            quarters = [-1] * 96
+        self.write({
+            "date" : date,
+            "version" : version,
+            "runs" : sheet_codec.encode_runs(quarters),
+            "summary" : Counter(str(quarter) for quarter in quarters) })
+        self.finish()
+
     @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
     def put(self, date):
         """
         Update a sheet with the quarters passed and return a map containing
-        the unique occurance of each activity.
+        the unique occurance of each activity. If a version is passed the sheet
+        is only replaced if it still has that version, otherwise the response
+        is a 409 with the stored sheet.
 
         @param date The sheet date in format YYYY-MM-DD
-        @return a JSON map containing the unique count for each activity
+        @return a JSON map containing the unique count for each activity and
+            the sheet's new version
         """
         user_id  = self.get_current_user_id()
 
         if not valid_date(date):
             self.respond_with_error(ERROR_INVALID_SHEET_DATE)
+            return
+
+        try:
+            expected_version = self.get_sheet_version()
+        except ValueError:
+            self.respond_with_error(ERROR_INVALID_SHEET_VERSION)
+            return
 
         quarters = self.get_argument("quarters", "")
 
         if quarters:
             quarters_array = quarters.split(',')
             if len(quarters_array) == 96:
-                update_sheet(self.application.db, user_id, date, quarters)
+                try:
+                    version = yield self.storage.update_sheet(user_id, date, quarters_array, expected_version)
+                except ValueError:
+                    self.respond_with_error(ERROR_INVALID_QUARTERS)
+                    return
+                except StaleSheet, stale:
+                    self.respond_with_stale_sheet(user_id, date, stale)
+                    return
                 summary = Counter(quarters_array)
-                self.write({ "summary" : summary })
+                self.set_header("Etag", self.sheet_etag(user_id, date, version))
+                self.write({ "summary" : summary, "version" : version })
                 self.finish()
             else:
                 self.respond_with_error(ERROR_NOT_96_QUARTERS)
         else:
             logging.warn("Could not extract quarters from PUT request")
             self.respond_with_error(ERROR_NO_QUARTERS)
+
+    @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
+    def patch(self, date):
+        """
+        Set some of the quarters of a sheet, given as run-length encoded runs
+        (see sheet_codec.decode_runs), and return the change of the activity
+        summary. Without a version the runs win over whatever is stored, with a
+        version a sheet changed since then gets a 409 with the stored sheet.
+
+        @param date The sheet date in format YYYY-MM-DD
+        @return a JSON map with the change of each activity's number of
+            quarters and the sheet's new version
+        """
+        user_id  = self.get_current_user_id()
+
+        if not valid_date(date):
+            self.respond_with_error(ERROR_INVALID_SHEET_DATE)
+            return
+
+        try:
+            runs = sheet_codec.decode_runs(self.get_argument("runs", ""))
+        except ValueError:
+            self.respond_with_error(ERROR_INVALID_RUNS)
+            return
+
+        try:
+            expected_version = self.get_sheet_version()
+        except ValueError:
+            self.respond_with_error(ERROR_INVALID_SHEET_VERSION)
+            return
+
+        try:
+            version, changes = yield self.storage.patch_sheet(user_id, date, runs, expected_version)
+        except StaleSheet, stale:
+            self.respond_with_stale_sheet(user_id, date, stale)
+            return
+        self.set_header("Etag", self.sheet_etag(user_id, date, version))
+        self.write({
+            "changes" : dict((str(activity_id), change) for activity_id, change in changes.items()),
+            "version" : version })
+        self.finish()
+
+class SheetsApiHandler(AuthenticatedHandler):
+    """
+    Read API for a range of sheets (e.g. a week, a month or a year)
+    """
+    MAX_DAYS = 366
+    FLUSH_DAYS = 31
+
+    @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self):
+        """
+        Get all sheets between the from and to dates (inclusive), streamed as a
+        JSON list with the quarters and activity summary of each day
+
+        @return a JSON map containing the list of sheets
+        """
+        user_id  = self.get_current_user_id()
+        start = parse_date(self.get_argument("from", ""))
+        end = parse_date(self.get_argument("to", ""))
+
+        if not start or not end or start > end or (end - start).days >= self.MAX_DAYS:
+            self.respond_with_error(ERROR_INVALID_SHEET_RANGE)
+            return
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write('{"sheets":[')
+        self.written_sheets = 0
+        # The chunks are handed over from the storage thread, they reach the IOLoop before the result does
+        io_loop = self.storage.io_loop
+        yield self.storage.stream_sheets(user_id, str(start), str(end),
+            lambda sheets: io_loop.add_callback(functools.partial(self.write_sheets, sheets)), self.FLUSH_DAYS)
+        self.write("]}")
+        self.finish()
+
+    def write_sheets(self, sheets):
+        """
+        Write a chunk of (date, quarters) sheets of the list and flush it
+        """
+        for date, quarters in sheets:
+            if self.written_sheets > 0:
+                self.write(",")
+            self.write(tornado.escape.json_encode({ "date" : date, "quarters" : list(quarters),
+                "summary" : Counter(str(quarter) for quarter in quarters) }))
+            self.written_sheets += 1
+        self.flush()
+
+    @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
+    def put(self):
+        """
+        Update many sheets at once. The sheets argument is a JSON map of dates
+        (YYYY-MM-DD) to quarters, each day given either as a list or as a comma
+        separated string of 96 activity ids. Every day is validated before
+        anything is written and all days are written in one transaction.
+
+        @return a JSON map containing the unique count for each activity, per date
+        """
+        user_id  = self.get_current_user_id()
+
+        try:
+            sheets = tornado.escape.json_decode(self.get_argument("sheets", ""))
+        except ValueError:
+            sheets = None
+        if not isinstance(sheets, dict) or not sheets or len(sheets) > self.MAX_DAYS:
+            self.respond_with_error(ERROR_INVALID_SHEETS)
+            return
+
+        days = []
+        for date, quarters in sorted(sheets.items()):
+            if not valid_date(date):
+                self.respond_with_error(ERROR_INVALID_SHEET_DATE)
+                return
+            if isinstance(quarters, basestring):
+                quarters = quarters.split(",")
+            if not isinstance(quarters, list) or len(quarters) != 96:
+                self.respond_with_error(ERROR_NOT_96_QUARTERS)
+                return
+            try:
+                quarters = [sheet_codec.parse_id(quarter) for quarter in quarters]
+            except (TypeError, ValueError):
+                self.respond_with_error(ERROR_INVALID_QUARTERS)
+                return
+            days.append((str(date), quarters))
+
+        yield self.storage.update_sheets(user_id, days)
+        self.write({ "summaries" : dict((date, Counter(quarters)) for date, quarters in days) })
+        self.finish()
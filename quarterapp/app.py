@@ -23,6 +23,7 @@
 import datetime
 import logging
 import tornado.web
+from tornado import gen
 
 from tornado.options import options
 from tornado.web import HTTPError
@@ -34,9 +35,11 @@ from quarter_utils import *
 
 class ActivityHandler(AuthenticatedHandler):
     @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
         user_id  = self.get_current_user_id()
-        activities = get_activities(self.application.db, user_id)
+        activities = yield self.storage.get_activities(user_id)
         self.render(u"app/activities.html", activities = activities)
 
 class SheetHandler(AuthenticatedHandler):
@@ -47,6 +50,8 @@ class SheetHandler(AuthenticatedHandler):
         return quarters
 
     @authenticated_user
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, date = None):
         user_id  = self.get_current_user_id()
         date_obj = None
@@ -69,19 +74,19 @@ class SheetHandler(AuthenticatedHandler):
         tomorrow = date_obj + datetime.timedelta(days = 1)
         weekday = date_obj.strftime("%A")
 
-        activities = get_activities(self.application.db, user_id)
+        activities = yield self.storage.get_activities(user_id)
 
         # Create a dict representation of the list of activities, to quicker resolve colors
         # for cells.
         activity_dict = get_dict_from_sequence(activities, "id")
 
-        sheet = get_sheet(self.application.db, user_id, date)
+        # The version is where the page's edits start from, see SheetApiHandler.patch
+        version, sheet = yield self.storage.get_sheet_version(user_id, str(date_obj))
         quarters = []
         if sheet:
-            ids = sheet.split(',')
-            for i in ids:
-                if int(i) > -1:
-                    color = activity_dict[int(i)]["color"]
+            for i in sheet:
+                if i > -1:
+                    color = activity_dict[i]["color"]
                     border_color = "#ccc" # darken color
                     quarters.append({ "id" : i, "color" : color, "border-color" : border_color})
                 else:
@@ -91,4 +96,4 @@ class SheetHandler(AuthenticatedHandler):
 
         self.render(u"app/sheet.html", date = date_obj, weekday = weekday,
             today = today, yesterday = yesterday, tomorrow = tomorrow,
-            activities = activities, quarters = quarters)
+            activities = activities, quarters = quarters, version = version)
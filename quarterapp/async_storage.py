@@ -0,0 +1,302 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import functools
+import logging
+import Queue
+import sys
+import threading
+import types
+
+from tornado import gen, stack_context
+from tornado.ioloop import IOLoop
+
+import storage
+
+class StorageBusy(Exception):
+    """
+    Raised when the queue of pending storage calls is full
+    """
+    pass
+
+class StorageCall(gen.YieldPoint):
+    """
+    A storage function call to yield from a gen.engine generator. The
+    generator is resumed with the function's return value, or has the
+    function's exception raised at the yield.
+    """
+    def __init__(self, executor, fn, args, kwargs):
+        self.executor = executor
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def start(self, runner):
+        self.runner = runner
+        self.key = object()
+        runner.register_callback(self.key)
+        self.executor.submit(self.fn, self.args, self.kwargs, runner.result_callback(self.key))
+
+    def is_ready(self):
+        return self.runner.is_ready(self.key)
+
+    def get_result(self):
+        succeeded, value = self.runner.pop_result(self.key)
+        if not succeeded:
+            raise value[0], value[1], value[2]
+        return value
+
+def _user_of(fn, args, kwargs):
+    """
+    Get the user a storage call is made for, the user_id argument following db
+    """
+    if fn.func_code.co_varnames[1:2] == ("user_id", ):
+        return args[0] if args else kwargs.get("user_id")
+    return None
+
+class AsyncStorage(object):
+    """
+    Non-blocking facade for the storage module.
+
+    Storage functions are run on a bounded pool of worker threads, each with a
+    connection from the connection pool, and the result is handed back to the
+    IOLoop. With a committer the writes are run by the committer instead, and
+    the pool may be read-only. With a router reads may be run on replicas, with
+    shards the users' activities and sheets are spread over several databases
+    and with a cache the reads of a user's data are cached. The facade has the storage functions without their db argument:
+
+        @tornado.web.asynchronous
+        @gen.engine
+        def get(self):
+            activities = yield self.storage.get_activities(user_id)
+    """
+
+    def __init__(self, pool, workers = None, queue_size = 1000, io_loop = None, committer = None, router = None,
+            shards = None, cache = None):
+        """
+        @param pool The connection pool the workers take connections from
+        @param workers The number of worker threads (default is the pool size)
+        @param queue_size The maximum number of calls waiting for a worker
+        @param io_loop The IOLoop to deliver results on
+        @param committer Optional GroupCommitter running the storage functions
+            marked with storage.write, it is closed with the facade
+        @param router Optional ReplicaRouter choosing the connection pool of
+            each read, it is closed with the facade
+        @param shards Optional shards.Shards running the storage functions marked
+            with storage.sharded or storage.fanout, the first shard is the pool
+            and committer given here, the others are closed with the facade
+        @param cache Optional cache.StorageCache of the reads marked with
+            storage.cached
+        """
+        self.pool = pool
+        self.committer = committer
+        self.router = router
+        self.shards = shards
+        self.cache = cache
+        self._pending_writes = {}
+        self.io_loop = io_loop or IOLoop.instance()
+        self._calls = Queue.Queue(queue_size)
+        self._workers = []
+        for i in range(workers or pool.size):
+            worker = threading.Thread(target = self._work, name = "storage-{0}".format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def __getattr__(self, name):
+        fn = getattr(storage, name)
+        if name.startswith("_") or not isinstance(fn, types.FunctionType):
+            raise AttributeError(name)
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            return StorageCall(self, fn, args, kwargs)
+        setattr(self, name, call)
+        return call
+
+    def submit(self, fn, args, kwargs, callback):
+        """
+        Queue a call to fn(db, *args, **kwargs), callback is run on the IOLoop
+        with a (succeeded, result or exc_info) tuple. Must be called on the
+        IOLoop thread.
+
+        A read for a user (a function taking user_id) while a write for the same
+        user is pending is queued behind the write on the committer, or run on
+        the primary, so a user always reads their own writes.
+
+        With shards, a call for a user whose location is not cached is queued
+        once the user has been looked up in the directory.
+
+        With a cache, a cached read is answered without a query. A read is not
+        cached while its user has pending writes.
+        """
+        callback = stack_context.wrap(callback)
+        if self.shards and getattr(fn, "fanout", None):
+            self._fan_out(fn, args, kwargs, callback)
+            return
+        user_id = _user_of(fn, args, kwargs)
+        if self.cache and user_id is not None:
+            key = self.cache.key(fn, user_id, args, kwargs)
+            located = not self.shards or self.shards.located(user_id) is not None
+            if key and located and user_id not in self._pending_writes:
+                hit, value = self.cache.get(key)
+                if hit:
+                    self._deliver(callback, (True, value))
+                    return
+                callback = functools.partial(self._cache, key, self.cache.started(), callback)
+            if getattr(fn, "invalidates", None):
+                self.cache.invalidate(user_id, fn.invalidates)
+        self._route(fn, args, kwargs, callback, user_id)
+
+    def _route(self, fn, args, kwargs, callback, user_id):
+        """
+        Queue a call on the committer or the connection pool it belongs on
+        """
+        write = getattr(fn, "write", False)
+        pool, committer = self.pool, self.committer
+        if self.shards and getattr(fn, "sharded", False):
+            location = self.shards.located(user_id)
+            if location is None:
+                self._locate(user_id, callback, functools.partial(self._route, fn, args, kwargs, callback, user_id))
+                return
+            if write and location.moving is not None:
+                raise StorageBusy("User is being moved to another shard")
+            if location.shard:
+                pool, committer = self.shards.pool(location.shard), self.shards.committer(location.shard)
+
+        pending = self._pending_writes.get(user_id)
+        if write and user_id is not None:
+            callback = functools.partial(self._written, user_id, getattr(fn, "invalidates", None), callback)
+
+        if committer and (write or pending):
+            committer.submit(fn, args, kwargs, functools.partial(self._deliver, callback))
+        else:
+            if self.router and pool is self.pool and not write and not pending:
+                pool = self.router.pool_for(fn, user_id)
+            try:
+                self._calls.put_nowait((fn, args, kwargs, callback, pool))
+            except Queue.Full:
+                raise StorageBusy("Too many pending storage calls")
+
+        if write and user_id is not None:
+            self._pending_writes[user_id] = self._pending_writes.get(user_id, 0) + 1
+
+    def pending(self):
+        """
+        Get the number of calls waiting for a worker
+        """
+        return self._calls.qsize()
+
+    def invalidate(self, user_id):
+        """
+        Drop the cached reads of a user after a write that is not made for the
+        user's id (e.g. deleting the user by username)
+        """
+        if self.cache:
+            self.cache.invalidate(user_id)
+
+    def close(self):
+        """
+        Stop the workers once the pending calls are done
+        """
+        for worker in self._workers:
+            self._calls.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self.committer:
+            self.committer.close()
+        if self.router:
+            self.router.close()
+        if self.shards:
+            self.shards.close()
+
+    def _deliver(self, callback, result):
+        self.io_loop.add_callback(functools.partial(callback, result))
+
+    def _locate(self, user_id, callback, then):
+        """
+        Look up the shard of a user, placing the user if not yet placed, and run
+        then, or run callback with the failure
+        """
+        def located(result):
+            succeeded, location = result
+            if not succeeded:
+                callback(result)
+                return
+            try:
+                if location is not None and location.shard is None:
+                    self.submit(storage.place_user, (user_id, self.shards.home(user_id)), {}, located)
+                else:
+                    if self.shards.remember(user_id, location) and self.cache:
+                        self.cache.invalidate(user_id)
+                    then()
+            except StorageBusy:
+                callback((False, sys.exc_info()))
+        self.submit(storage.get_user_shard, (user_id, ), {}, located)
+
+    def _fan_out(self, fn, args, kwargs, callback):
+        """
+        Run a call on every shard in parallel, callback gets the results merged
+        with fn.fanout, or the first failure
+        """
+        results = [None] * len(self.shards)
+        def done(index, result):
+            results[index] = result
+            if None in results:
+                return
+            failures = [shard_result for shard_result in results if not shard_result[0]]
+            callback(failures[0] if failures else (True, fn.fanout([value for succeeded, value in results])))
+        # Calls are only queued from the IOLoop thread, so the room checked here can only grow
+        if self._calls.maxsize > 0 and self._calls.maxsize - self._calls.qsize() < len(self.shards):
+            raise StorageBusy("Too many pending storage calls")
+        for index in range(len(self.shards)):
+            self._calls.put_nowait((fn, args, kwargs, functools.partial(done, index), self.shards.pool(index)))
+
+    def _cache(self, key, started, callback, result):
+        if result[0]:
+            self.cache.put(key, result[1], started)
+        callback(result)
+
+    def _written(self, user_id, groups, callback, result):
+        if groups and self.cache:
+            self.cache.invalidate(user_id, groups)
+        self._pending_writes[user_id] -= 1
+        if not self._pending_writes[user_id]:
+            del self._pending_writes[user_id]
+        if self.router:
+            self.router.wrote(user_id)
+        callback(result)
+
+    def _work(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            fn, args, kwargs, callback, pool = call
+            try:
+                with pool.connection() as db:
+                    result = (True, fn(db, *args, **kwargs))
+            except Exception:
+                logging.warning("Storage call %s failed: %s", fn.__name__, sys.exc_info()[1])
+                result = (False, sys.exc_info())
+            self._deliver(callback, result)
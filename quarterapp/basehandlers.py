@@ -40,29 +40,55 @@ class QuarterEncoder(json.JSONEncoder):
         if isinstance(obj, ApiError):
             return { "code" : obj.code, "message" : obj.message }
 
-def authenticated_user(method):
-    """Decorate methods with this to require that the user be logged in."""
-    @functools.wraps(method)
-    def wrapper(self, *args, **kwargs):
-        if not self.current_user:
-            if self.request.method in ("GET", "HEAD"):
-                url = self.get_login_url()
-                self.redirect(url)
+def with_current_user(check):
+    """
+    Decorate methods with this to resolve the session cookie before they run,
+    a session that is not cached is looked up without blocking the IOLoop. The
+    method is only run if check(handler) returns True.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            state = { "deferred" : False }
+            def resolved(user):
+                self._current_user = user
+                self._auto_finish = True
+                if check(self):
+                    method(self, *args, **kwargs)
+                # Finish like RequestHandler._execute would have for a synchronous method
+                if state["deferred"] and self._auto_finish and not self._finished:
+                    self.finish()
+
+            if hasattr(self, "_current_user"):
+                resolved(self._current_user)
                 return
-            raise tornado.web.HTTPError(403)
-        return method(self, *args, **kwargs)
-    return wrapper
-
-def authenticated_admin(method):
-    """Check if user is admin, if not, render 404 (to avoid exposing admin part) """
-    @functools.wraps(method)
-    def wrapper(self, *args, **kwargs):
-        if not self.current_user:
-            raise tornado.web.HTTPError(404)
-        elif self.current_user["type"] != User.Administrator:
-            raise tornado.web.HTTPError(404)
-        return method(self, *args, **kwargs)
-    return wrapper
+            self._auto_finish = False
+            self.application.sessions.resolve(self.get_cookie("session"), self.async_callback(resolved))
+            state["deferred"] = True
+        return wrapper
+    return decorator
+
+def _require_user(self):
+    if not self.current_user:
+        if self.request.method in ("GET", "HEAD"):
+            url = self.get_login_url()
+            self.redirect(url)
+            return False
+        raise tornado.web.HTTPError(403)
+    return True
+
+def _require_admin(self):
+    if not self.current_user:
+        raise tornado.web.HTTPError(404)
+    elif self.current_user["type"] != User.Administrator:
+        raise tornado.web.HTTPError(404)
+    return True
+
+# Decorate methods with this to require that the user be logged in.
+authenticated_user = with_current_user(_require_user)
+
+# Check if user is admin, if not, render 404 (to avoid exposing admin part)
+authenticated_admin = with_current_user(_require_admin)
 
 
 class IndexHandler(tornado.web.RequestHandler):
@@ -75,6 +101,29 @@ class Http404Handler(tornado.web.RequestHandler):
         self.render(u"public/404.html")
 
 class BaseHandler(tornado.web.RequestHandler):
+    @property
+    def storage(self):
+        """
+        The application's non-blocking storage, yield its calls from a
+        gen.engine method
+        """
+        return self.application.storage
+
+    @property
+    def passwords(self):
+        """
+        The application's password hasher, yield its calls from a gen.engine
+        method
+        """
+        return self.application.passwords
+
+    def wake_mailer(self):
+        """
+        Have the mailer send the mail just queued, if this process runs one
+        """
+        if self.application.mailer:
+            self.application.mailer.wake()
+
     def write_success(self):
         """
         Respond with a successful code and HTTP 200
@@ -124,20 +173,26 @@ class BaseHandler(tornado.web.RequestHandler):
 
 class AuthenticatedHandler(BaseHandler):
     def get_current_user(self):
-        user_json = self.get_secure_cookie("user")
-        if not user_json:
-            return None
-        return tornado.escape.json_decode(user_json)
+        """
+        Get the user of a cached session, methods decorated with
+        authenticated_user or authenticated_admin also see sessions that had to
+        be looked up
+        """
+        return self.application.sessions.cached(self.get_cookie("session"))
 
-    def set_current_user(self, user):
-        if user:
-            self.set_secure_cookie("user", tornado.escape.json_encode(user))
+    def set_session(self, token):
+        """
+        Set the session cookie
+
+        @param token The session token, or None to clear the cookie
+        """
+        if token:
+            self.set_cookie("session", token, expires_days = options.session_days, httponly = True)
         else:
-            self.clear_cookie("user")
+            self.clear_cookie("session")
 
     def get_current_user_id(self):
-        user = self.get_current_user()
+        user = self.current_user
         if user:
             return user["id"]
         return None
-
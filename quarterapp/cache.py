@@ -0,0 +1,174 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import collections
+import copy
+import sys
+import time
+
+def _sizeof(value):
+    """
+    Estimate the memory used by a cached value, counting the items of lists and
+    tuples (such as rows) but not objects shared between values
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(_sizeof(item) for item in value)
+    return size
+
+class StorageCache(object):
+    """
+    A bounded LRU cache of storage reads of a user's data.
+
+    Storage functions marked with storage.cached(group) are cached by user and
+    arguments, a write marked with storage.invalidates(group) drops the cached
+    reads of its user in the group. A read that overlapped a write of the same
+    user is not cached, so a write can never be hidden by an older read.
+
+    The cache is in-process: with several processes sharing a database a user
+    may read data cached before a write made by another process, for at most
+    max_age seconds when given.
+
+    Not thread safe, it is used on the IOLoop thread.
+    """
+
+    def __init__(self, max_bytes, max_age = 0, max_writers = 100000, clock = time.time):
+        """
+        @param max_bytes The estimated memory the cached values may use
+        @param max_age Seconds a value may be cached, 0 for no limit
+        @param max_writers The number of recent writers to remember, a read
+            older than the writes forgotten is not cached
+        @param clock The time function
+        """
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_writers = max_writers
+        self.clock = clock
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._user_keys = {}
+        self._tick = 0
+        self._written = collections.OrderedDict()
+        self._forgotten = 0
+
+    def key(self, fn, user_id, args, kwargs):
+        """
+        Get the cache key of a storage call
+
+        @return The key, or None if the call is not cached
+        """
+        group = getattr(fn, "cached", None)
+        if group is None or user_id is None:
+            return None
+        return (user_id, group, fn.__name__, args, tuple(sorted(kwargs.items())))
+
+    def started(self):
+        """
+        Get the token to pass to put() for a read started now
+        """
+        return self._tick
+
+    def get(self, key):
+        """
+        Get a cached value
+
+        @return A (hit, value) tuple, the value is a copy
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None or (self.max_age and self.clock() > entry[2]):
+            if entry:
+                self._remove(key, entry)
+            self.misses += 1
+            return False, None
+        self._entries[key] = entry
+        self.hits += 1
+        return True, copy.copy(entry[0])
+
+    def put(self, key, value, started):
+        """
+        Cache the value of a read, unless the read's user has written since
+
+        @param key The key of the read
+        @param value The value read
+        @param started The token returned by started() when the read was submitted
+        """
+        user_id = key[0]
+        if started < self._forgotten or self._written.get(user_id, 0) > started:
+            return
+        size = _sizeof(key) + _sizeof(value)
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous:
+            self._remove(key, previous)
+        self._entries[key] = (copy.copy(value), size, self.clock() + self.max_age)
+        self._user_keys.setdefault(user_id, set()).add(key)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest, entry = self._entries.popitem(last = False)
+            self._remove(oldest, entry)
+            self.evictions += 1
+
+    def invalidate(self, user_id, groups = None):
+        """
+        Drop the cached reads of a user and keep reads in progress from being
+        cached
+
+        @param user_id The user
+        @param groups The groups to drop, None for all
+        """
+        self._tick += 1
+        self._written.pop(user_id, None)
+        self._written[user_id] = self._tick
+        while len(self._written) > self.max_writers:
+            writer, tick = self._written.popitem(last = False)
+            self._forgotten = tick
+        for key in list(self._user_keys.get(user_id, ())):
+            if groups is None or key[1] in groups:
+                self._remove(key, self._entries.pop(key))
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        @return A dict with hits, misses, hit_ratio, evictions, entries, bytes
+            and max_bytes
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_ratio" : float(self.hits) / lookups if lookups else 0.0,
+            "evictions" : self.evictions,
+            "entries" : len(self._entries),
+            "bytes" : self.bytes,
+            "max_bytes" : self.max_bytes }
+
+    def _remove(self, key, entry):
+        self.bytes -= entry[1]
+        keys = self._user_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._user_keys[key[0]]
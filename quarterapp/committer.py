@@ -0,0 +1,228 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import Queue
+import sys
+import threading
+import time
+
+import storage
+from async_storage import StorageBusy
+
+class GroupCommitter(object):
+    """
+    The single writer for a database that allows one writer at a time. Writes
+    from many requests run on one connection, in order, and short writes are
+    committed together so a burst of writes costs one commit (and one fsync)
+    instead of one per write.
+
+    The writer thread takes the first waiting write and keeps collecting writes
+    for up to `window` seconds or until `max_batch` writes are collected. With
+    no window the batch is the writes that queued up while the previous commit
+    was running, which adds no latency to a lone write. Each write runs in a
+    savepoint of its own, so a failing write is rolled back without affecting
+    the rest of the batch, and the batch is then committed in one transaction.
+    A write is acknowledged only after the commit has returned.
+
+    Writes marked with storage.write(alone = True) manage their own
+    transactions and are run on their own, between batches. Between the chunks
+    of such a write (see storage.between_chunks) the writes that queued up
+    behind it are committed, so a long delete does not hold up the short writes
+    until it is done. Reads may be queued as well, they see every write queued
+    before them.
+    """
+
+    def __init__(self, connect, window = 0, max_batch = 64, queue_size = 1000):
+        """
+        @param connect A function returning a new database connection in autocommit mode
+        @param window Seconds to wait for more writes to join a batch, 0 batches only the writes already waiting
+        @param max_batch The maximum number of writes per commit
+        @param queue_size The maximum number of writes waiting for the writer
+        """
+        self.connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self._writes = Queue.Queue(queue_size)
+        self._held = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._commits = 0
+        self._committed_writes = 0
+        self._failed_commits = 0
+        self._largest_batch = 0
+        self._writer = threading.Thread(target = self._run, name = "group-commit")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def submit(self, fn, args, kwargs, callback):
+        """
+        Queue a write of fn(db, *args, **kwargs), callback is run on the writer
+        thread with a (succeeded, result or exc_info) tuple once the write's
+        batch is committed.
+        """
+        try:
+            self._writes.put_nowait((fn, args, kwargs, callback))
+        except Queue.Full:
+            raise StorageBusy("Too many pending writes")
+
+    def pending(self):
+        """
+        Get the number of writes waiting for the writer
+        """
+        return self._writes.qsize()
+
+    def stats(self):
+        """
+        Get the commit counters
+
+        @return A dict with the number of commits, committed writes, failed
+            commits, the average and the largest batch size
+        """
+        with self._lock:
+            return {
+                "commits" : self._commits,
+                "writes" : self._committed_writes,
+                "failed_commits" : self._failed_commits,
+                "average_batch" : float(self._committed_writes) / self._commits if self._commits else 0.0,
+                "largest_batch" : self._largest_batch }
+
+    def close(self):
+        """
+        Stop the writer once the pending writes are committed
+        """
+        self._writes.put(None)
+        self._writer.join()
+
+    def _collect(self, first, window = None):
+        """
+        Collect a batch starting with the given write. A write to run alone ends
+        the batch and is held for the next round, a None (the committer was
+        closed) ends the batch and is returned last.
+        """
+        batch = [first]
+        deadline = time.time() + (self.window if window is None else window)
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    write = self._writes.get(True, remaining)
+                else:
+                    write = self._writes.get_nowait()
+            except Queue.Empty:
+                break
+            if write is not None and getattr(write[0], "write_alone", False):
+                self._held = write
+                break
+            batch.append(write)
+            if write is None:
+                break
+        return batch
+
+    def _next(self):
+        write, self._held = self._held, None
+        return write or self._writes.get()
+
+    def _run(self):
+        db = self.connect()
+        try:
+            while True:
+                write = self._next()
+                if write is None:
+                    return
+                if getattr(write[0], "write_alone", False):
+                    self._run_alone(db, write)
+                    if self._closed:
+                        return
+                    continue
+                batch = self._collect(write)
+                closed = batch[-1] is None
+                if closed:
+                    batch.pop()
+                self._commit(db, batch)
+                if closed:
+                    return
+        finally:
+            db.close()
+
+    def _run_alone(self, db, write):
+        fn, args, kwargs, callback = write
+        try:
+            with storage.between_chunks(db, self._commit_waiting):
+                result = (True, fn(db, *args, **kwargs))
+        except Exception:
+            logging.warning("Write %s failed: %s", fn.__name__, sys.exc_info()[1])
+            result = (False, sys.exc_info())
+        callback(result)
+
+    def _commit_waiting(self, db):
+        """
+        Commit the writes waiting behind a write run alone, between two of its
+        chunks. Nothing is committed once another write to run alone is held,
+        it has to run before the writes queued after it.
+        """
+        if self._held is not None or self._closed:
+            return
+        try:
+            write = self._writes.get_nowait()
+        except Queue.Empty:
+            return
+        if write is None:
+            self._closed = True
+            return
+        if getattr(write[0], "write_alone", False):
+            self._held = write
+            return
+        batch = self._collect(write, window = 0)
+        if batch[-1] is None:
+            batch.pop()
+            self._closed = True
+        self._commit(db, batch)
+
+    def _commit(self, db, batch):
+        results = []
+        try:
+            with storage.transaction(db):
+                for fn, args, kwargs, callback in batch:
+                    try:
+                        with storage.transaction(db):
+                            results.append((True, fn(db, *args, **kwargs)))
+                    except Exception:
+                        logging.warning("Write %s failed: %s", fn.__name__, sys.exc_info()[1])
+                        results.append((False, sys.exc_info()))
+        except Exception:
+            logging.error("Could not commit %d writes: %s", len(batch), sys.exc_info()[1])
+            results = [(False, sys.exc_info())] * len(batch)
+            try:
+                db.rollback()
+            except Exception:
+                pass
+            with self._lock:
+                self._failed_commits += 1
+        else:
+            with self._lock:
+                self._commits += 1
+                self._committed_writes += len(batch)
+                self._largest_batch = max(self._largest_batch, len(batch))
+
+        for (fn, args, kwargs, callback), result in zip(batch, results):
+            callback(result)
@@ -20,10 +20,6 @@
 #  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 #  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import smtplib
-import logging
-import sys
-
 import tornado.template
 from tornado.options import options
 
@@ -64,55 +60,32 @@ Cheers!
 
 """)
 
-def send_mail(username, message):
-    try:
-        server = smtplib.SMTP(options.mail_host)
-        server.ehlo()
-        server.starttls()
-        server.ehlo()
-        server.login(options.mail_user, options.mail_password)
-        server.sendmail(options.mail_sender, username, message)
-        return True
-    except:
-        logging.warn("Could not send email: %s", sys.exc_info())
-        logging.warn(message)
-        return True
-
-def send_signup_email(username, code):
+def signup_email(username, code):
     """
-    Sends the activation email to the given address with the given activation code.
+    Create the activation email to the given address with the given activation code.
 
     @param username The username to send the email to
     @param code The activation code
-    @return True if mail could be sent, else False
+    @return The message, to queue with storage.queue_mail
     """
-    try:
-        message = signup_email_template.generate(subject = "Welcome to quarterapp",
-                    email_from = options.mail_sender,
-                    email_to = username,
-                    code_link = "http://" + options.base_url + "/activate/" + code,
-                    link = "http://" + options.base_url + "/activate",
-                    code = code)
-        return send_mail(username, message)
-    except:
-        logging.warn("Could not send signup email: %s", sys.exc_info())
-        return False
-
-def send_reset_email(username, code):
+    return signup_email_template.generate(subject = "Welcome to quarterapp",
+                email_from = options.mail_sender,
+                email_to = username,
+                code_link = "http://" + options.base_url + "/activate/" + code,
+                link = "http://" + options.base_url + "/activate",
+                code = code)
+
+def reset_email(username, code):
     """
-    Sends the password reset email to the given address with the given reset code.
+    Create the password reset email to the given address with the given reset code.
+
     @param username The username to send the email to
-    @param code The activation code
-    @return True if mail could be sent, else False
+    @param code The reset code
+    @return The message, to queue with storage.queue_mail
     """
-    try:
-        message = reset_email_template.generate(subject = "Reset your password",
-                    email_from = options.mail_sender,
-                    email_to = username,
-                    code_link = "http://" + options.base_url + "/reset/" + code,
-                    link = "http://" + options.base_url + "/reset",
-                    code = code)
-        return send_mail(username, message)
-    except:
-        logging.warn("Could not send reset email: %s", sys.exc_info())
-        return False
+    return reset_email_template.generate(subject = "Reset your password",
+                email_from = options.mail_sender,
+                email_to = username,
+                code_link = "http://" + options.base_url + "/reset/" + code,
+                link = "http://" + options.base_url + "/reset",
+                code = code)
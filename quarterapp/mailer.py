@@ -0,0 +1,244 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Background mail sender.
+
+Handlers never talk to the SMTP server, they put the mail in the outbox table
+(storage.queue_mail) and wake the Mailer. The mailer's thread claims the due
+mail in batches and sends it over one long-lived SMTP session, which is only
+reconnected after it has been idle for a while or the server dropped it. Mail
+that cannot be sent is retried with exponential backoff, and dropped after
+max_attempts attempts or when the server refuses the recipient.
+"""
+
+import logging
+import smtplib
+import socket
+import sys
+import threading
+import time
+
+import pool
+import storage
+
+class Mailer(object):
+    """
+    Sends the mail in the outbox on a background thread
+    """
+
+    def __init__(self, db, host, port = 25, user = None, password = None, sender = None, committer = None,
+            use_ssl = False, batch_size = 20, poll_interval = 5, backoff = 30, max_attempts = 8,
+            idle_timeout = 60, timeout = 30, clock = time.time):
+        """
+        @param db The connection pool used to read the outbox
+        @param host The SMTP host
+        @param port The SMTP port
+        @param user The SMTP user, None to not log in
+        @param password The SMTP password
+        @param sender The sender address
+        @param committer Optional GroupCommitter running the outbox writes
+        @param use_ssl Connect with SMTP over SSL instead of STARTTLS
+        @param batch_size The maximum number of mails claimed at a time
+        @param poll_interval Seconds between looks at the outbox when not woken
+        @param backoff Seconds before the first retry, doubled for every retry
+        @param max_attempts The number of attempts before a mail is dropped
+        @param idle_timeout Seconds an unused SMTP session is kept open
+        @param timeout The SMTP socket timeout in seconds
+        @param clock Function returning the current time in seconds
+        """
+        self.db = db
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender
+        self.committer = committer
+        self.use_ssl = use_ssl
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.clock = clock
+        self._smtp = None
+        self._last_used = 0
+        self._wake = threading.Event()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._retried = 0
+        self._dropped = 0
+        self._connects = 0
+        self._thread = None
+
+    def start(self):
+        """
+        Start the sender thread
+        """
+        self._thread = threading.Thread(target = self._run, name = "mailer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        """
+        Look at the outbox now, e.g. after queueing a mail
+        """
+        self._wake.set()
+
+    def close(self):
+        """
+        Stop the sender thread and end the SMTP session
+        """
+        self._closed = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self._disconnect()
+
+    def stats(self):
+        """
+        Get the sender's counters
+
+        @return A dict with the number of mails sent, retried and dropped and
+            the number of SMTP sessions opened
+        """
+        with self._lock:
+            return { "sent" : self._sent, "retried" : self._retried, "dropped" : self._dropped, "connects" : self._connects }
+
+    def send_due(self):
+        """
+        Send one batch of due mail
+
+        @return The number of mails claimed
+        """
+        now = self.clock()
+        # Long enough to send the whole batch even if every send times out
+        lease = now + self.timeout * (self.batch_size + 1)
+        mails = self._call(storage.claim_mail, now, self.batch_size, lease)
+        sent = []
+        for mail in mails:
+            try:
+                self._send(mail)
+                sent.append(mail.id)
+            except smtplib.SMTPRecipientsRefused:
+                logging.error("Dropping mail %d, recipient %s refused: %s", mail.id, mail.recipient, sys.exc_info()[1])
+                sent.append(mail.id)
+                self._count("_dropped")
+            except (smtplib.SMTPException, socket.error, IOError):
+                logging.warning("Could not send mail %d to %s: %s", mail.id, mail.recipient, sys.exc_info()[1])
+                self._disconnect()
+                self._retry(mail, now)
+        if sent:
+            self._call(storage.delete_mail, sent)
+        return len(mails)
+
+    def _send(self, mail):
+        reused = self._smtp is not None
+        try:
+            self._session().sendmail(self.sender, mail.recipient, mail.message)
+        except smtplib.SMTPServerDisconnected:
+            if not reused:
+                raise
+            # The server ended the idle session, send again on a new one
+            self._disconnect()
+            self._session().sendmail(self.sender, mail.recipient, mail.message)
+        self._last_used = self.clock()
+        self._count("_sent")
+
+    def _retry(self, mail, now):
+        attempts = mail.attempts + 1
+        if attempts >= self.max_attempts:
+            logging.error("Dropping mail %d to %s after %d attempts", mail.id, mail.recipient, attempts)
+            self._call(storage.delete_mail, [mail.id])
+            self._count("_dropped")
+        else:
+            self._call(storage.defer_mail, mail.id, attempts, now + self.backoff * 2 ** mail.attempts)
+            self._count("_retried")
+
+    def _session(self):
+        """
+        Get the SMTP session, connecting if there is none
+        """
+        if self._smtp is None:
+            if self.use_ssl:
+                smtp = smtplib.SMTP_SSL(self.host, self.port, timeout = self.timeout)
+            else:
+                smtp = smtplib.SMTP(self.host, self.port, timeout = self.timeout)
+            try:
+                smtp.ehlo()
+                if not self.use_ssl and smtp.has_extn("starttls"):
+                    smtp.starttls()
+                    smtp.ehlo()
+                if self.user:
+                    smtp.login(self.user, self.password)
+            except:
+                smtp.close()
+                raise
+            self._smtp = smtp
+            self._count("_connects")
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                self._smtp.close()
+            self._smtp = None
+
+    def _call(self, fn, *args):
+        """
+        Run a storage function, writes on the committer if there is one
+        """
+        if self.committer and getattr(fn, "write", False):
+            done = threading.Event()
+            results = []
+            def callback(result):
+                results.append(result)
+                done.set()
+            self.committer.submit(fn, args, {}, callback)
+            done.wait()
+            succeeded, value = results[0]
+            if not succeeded:
+                raise value[0], value[1], value[2]
+            return value
+        with pool.connection(self.db) as db:
+            return fn(db, *args)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.clear()
+            try:
+                if self.send_due() == self.batch_size:
+                    continue
+            except Exception:
+                logging.error("Could not send the outbox: %s", sys.exc_info()[1])
+            if self._smtp is not None and self.clock() - self._last_used > self.idle_timeout:
+                self._disconnect()
+            self._wake.wait(self.poll_interval)
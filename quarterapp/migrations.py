@@ -0,0 +1,219 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Versioned schema migrations.
+
+quarterapp.sql creates the base schema (version 0), every change after that is
+a Migration in the MIGRATIONS list. The applied version is kept in the
+schema_version table and 'qapp migrate' applies whatever is missing, in order.
+
+The application refuses to start while a migration is missing, except for
+online migrations (e.g. converting rows), which may still be running while the
+new version serves requests.
+"""
+
+import logging
+
+import storage
+
+class Migration(object):
+    """
+    A single schema change. A migration is either a list of SQL statements per
+    backend, or a function taking the database connection.
+    """
+    def __init__(self, version, description, sqlite = None, mysql = None, run = None, online = False):
+        self.version = version
+        self.description = description
+        self.sqlite = sqlite or []
+        self.mysql = mysql or []
+        self.run = run
+        self.online = online
+
+    def apply(self, db):
+        if self.run:
+            self.run(db)
+        else:
+            for sql in getattr(self, storage.dialect(db).name):
+                storage._exec(db, sql)
+
+def _sheets_as_blob(db):
+    if storage.dialect(db) is not storage.MYSQL:
+        return
+    rows = storage._query(db, "SELECT DATA_TYPE AS type FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='sheets' AND COLUMN_NAME='quarters';")
+    if rows and rows[0].type.lower() != "blob":
+        storage._exec(db, "ALTER TABLE sheets MODIFY quarters BLOB NOT NULL, ALGORITHM=COPY, LOCK=SHARED;")
+
+MIGRATIONS = [
+    Migration(1, "Index the columns used to look up users, signups and activities",
+        sqlite = [
+            "CREATE INDEX activities_user ON activities (user);",
+            "CREATE INDEX users_username ON users (username);",
+            "CREATE INDEX users_reset_code ON users (reset_code);",
+            "CREATE INDEX signups_activation_code ON signups (activation_code);"],
+        mysql = [
+            "CREATE INDEX activities_user ON activities (user);",
+            "CREATE INDEX users_username ON users (username(255));",
+            "CREATE INDEX users_reset_code ON users (reset_code);",
+            "CREATE INDEX signups_activation_code ON signups (activation_code);"]),
+
+    Migration(2, "One sheet per user and date",
+        sqlite = [
+            "DELETE FROM sheets WHERE id NOT IN (SELECT MAX(id) FROM sheets GROUP BY user, date);",
+            "CREATE UNIQUE INDEX sheets_user_date ON sheets (user, date);"],
+        mysql = [
+            "DELETE older FROM sheets older JOIN sheets newer ON older.user = newer.user AND older.date = newer.date AND older.id < newer.id;",
+            "CREATE UNIQUE INDEX sheets_user_date ON sheets (user, date);"]),
+
+    # The packed format is written as soon as the new version runs, so the
+    # column must be a BLOB before it starts (strict MySQL rejects the bytes in
+    # a utf8 TEXT column). The rebuild blocks writes but not reads, and is skipped
+    # if the column was already changed with an online schema change tool.
+    Migration(3, "Store sheets as BLOB",
+        run = _sheets_as_blob),
+
+    Migration(4, "Username search index",
+        sqlite = [
+            "CREATE VIRTUAL TABLE users_search USING fts5(username, content='users', content_rowid='id', tokenize='trigram');",
+            "INSERT INTO users_search (users_search) VALUES('rebuild');",
+            "CREATE TRIGGER users_search_insert AFTER INSERT ON users BEGIN "
+                "INSERT INTO users_search (rowid, username) VALUES(new.id, new.username); END;",
+            "CREATE TRIGGER users_search_delete AFTER DELETE ON users BEGIN "
+                "INSERT INTO users_search (users_search, rowid, username) VALUES('delete', old.id, old.username); END;",
+            "CREATE TRIGGER users_search_update AFTER UPDATE OF username ON users BEGIN "
+                "INSERT INTO users_search (users_search, rowid, username) VALUES('delete', old.id, old.username); "
+                "INSERT INTO users_search (rowid, username) VALUES(new.id, new.username); END;"],
+        mysql = [
+            # With stopwords enabled the ngram parser drops every bigram containing one (e.g. 'a')
+            "SET SESSION innodb_ft_enable_stopword = OFF;",
+            "CREATE FULLTEXT INDEX users_search ON users (username) WITH PARSER ngram;"]),
+
+    Migration(5, "Replication heartbeat used to measure replica lag",
+        sqlite = [
+            "CREATE TABLE replication_heartbeat (id INTEGER PRIMARY KEY, beat DOUBLE NOT NULL);",
+            "INSERT INTO replication_heartbeat (id, beat) VALUES(1, 0);"],
+        mysql = [
+            "CREATE TABLE replication_heartbeat (id INT NOT NULL PRIMARY KEY, beat DOUBLE NOT NULL) ENGINE=InnoDB;",
+            "INSERT INTO replication_heartbeat (id, beat) VALUES(1, 0);"]),
+
+    Migration(6, "Directory of the shard each user's activities and sheets are on",
+        sqlite = [
+            "ALTER TABLE users ADD COLUMN shard INTEGER;",
+            "UPDATE users SET shard=0;",
+            "CREATE TABLE shard_moves (user INTEGER PRIMARY KEY, source INTEGER NOT NULL, target INTEGER NOT NULL);"],
+        mysql = [
+            "ALTER TABLE users ADD COLUMN shard INT NULL;",
+            "UPDATE users SET shard=0;",
+            "CREATE TABLE shard_moves (user INT NOT NULL PRIMARY KEY, source INT NOT NULL, target INT NOT NULL) ENGINE=InnoDB;"]),
+
+    Migration(7, "Settings version, bumped on every settings change",
+        sqlite = [
+            "CREATE TABLE settings_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL);",
+            "INSERT INTO settings_version (id, version) VALUES(1, 0);"],
+        mysql = [
+            "CREATE TABLE settings_version (id INT NOT NULL PRIMARY KEY, version INT NOT NULL) ENGINE=InnoDB;",
+            "INSERT INTO settings_version (id, version) VALUES(1, 0);"]),
+
+    Migration(8, "Server side sessions and the log of revoked sessions",
+        sqlite = [
+            "CREATE TABLE sessions (id CHAR(64) PRIMARY KEY, user INTEGER NOT NULL, expires DOUBLE NOT NULL);",
+            "CREATE INDEX sessions_user ON sessions (user);",
+            "CREATE TABLE session_revocations (id INTEGER PRIMARY KEY AUTOINCREMENT, user INTEGER NOT NULL, revoked DOUBLE NOT NULL);",
+            "CREATE INDEX session_revocations_revoked ON session_revocations (revoked);"],
+        mysql = [
+            "CREATE TABLE sessions (id CHAR(64) NOT NULL PRIMARY KEY, user INT NOT NULL, expires DOUBLE NOT NULL) ENGINE=InnoDB;",
+            "CREATE INDEX sessions_user ON sessions (user);",
+            "CREATE TABLE session_revocations (id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, user INT NOT NULL, revoked DOUBLE NOT NULL) ENGINE=InnoDB;",
+            "CREATE INDEX session_revocations_revoked ON session_revocations (revoked);"]),
+
+    Migration(9, "Outbox of mail waiting to be sent",
+        sqlite = [
+            "CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, recipient VARCHAR(256) NOT NULL, message TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, next_attempt DOUBLE NOT NULL);",
+            "CREATE INDEX outbox_next_attempt ON outbox (next_attempt);"],
+        mysql = [
+            "CREATE TABLE outbox (id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, recipient VARCHAR(256) NOT NULL, message MEDIUMTEXT NOT NULL, "
+                "attempts INT NOT NULL DEFAULT 0, next_attempt DOUBLE NOT NULL) ENGINE=InnoDB;",
+            "CREATE INDEX outbox_next_attempt ON outbox (next_attempt);"]),
+
+    Migration(10, "Sheet versions, bumped on every write of a sheet",
+        sqlite = [
+            "ALTER TABLE sheets ADD COLUMN version INTEGER NOT NULL DEFAULT 1;"],
+        mysql = [
+            "ALTER TABLE sheets ADD COLUMN version INT NOT NULL DEFAULT 1;"]),
+
+    # SQLite does not enforce the length of a VARCHAR
+    Migration(11, "Room for salted password hashes",
+        mysql = [
+            "ALTER TABLE users MODIFY password VARCHAR(255) NOT NULL DEFAULT '';"]),
+
+    Migration(12, "Convert text sheets to the packed format",
+        run = storage.pack_sheets, online = True),
+]
+
+def current_version(db):
+    """
+    Get the schema version of the given database, creating the version table
+    if needed.
+
+    @param db The database connection to use
+    @return The applied version, 0 for a database with only the base schema
+    """
+    storage._exec(db, "CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL);")
+    rows = storage._query(db, "SELECT MAX(version) AS version FROM schema_version;")
+    if rows and rows[0].version is not None:
+        return rows[0].version
+    return 0
+
+def migrate(db, target = None):
+    """
+    Apply all migrations newer than the database's current version.
+
+    @param db The database connection to use
+    @param target The version to migrate to (default is the latest)
+    @return The list of applied migration versions
+    """
+    version = current_version(db)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        if target is not None and migration.version > target:
+            break
+        logging.info("Applying migration %d: %s", migration.version, migration.description)
+        migration.apply(db)
+        storage._exec(db, "INSERT INTO schema_version (version) VALUES(%(version)s);", { "version" : migration.version })
+        db.commit()
+        applied.append(migration.version)
+    return applied
+
+def missing(db):
+    """
+    Get the migrations the application cannot run without
+
+    @param db The database connection to use
+    @return The list of migrations newer than the database's version, except
+        online ones
+    """
+    version = current_version(db)
+    return [migration for migration in MIGRATIONS if migration.version > version and not migration.online]
@@ -0,0 +1,145 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Password hashing off the IOLoop.
+
+Hashing and checking passwords with a slow KDF takes tens of milliseconds of
+CPU, the PasswordHasher runs them on a pool of worker processes so logins
+neither block the IOLoop nor serialize on the GIL:
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def post(self):
+        valid, upgraded = yield self.application.passwords.check(password, stored)
+"""
+
+import functools
+import logging
+import multiprocessing
+
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+from async_storage import StorageCall
+from quarter_utils import make_password, check_password, PASSWORD_ALGORITHM
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when too many passwords are waiting to be hashed
+    """
+    pass
+
+def _run(fn, args):
+    """
+    Run fn in a worker process, returning a (succeeded, result or exc_info)
+    tuple without the traceback, which cannot be pickled
+    """
+    try:
+        return (True, fn(*args))
+    except Exception, e:
+        return (False, (type(e), e, None))
+
+class PasswordHasher(object):
+    """
+    Hashes and checks passwords on a pool of worker processes, with a bounded
+    number of pending calls. With processes = 0 the work is done inline, on
+    the calling thread.
+    """
+
+    def __init__(self, iterations, legacy_salt, processes = None, queue_size = 100, io_loop = None):
+        """
+        @param iterations The PBKDF2 iteration count of new hashes
+        @param legacy_salt The application salt of legacy hashes
+        @param processes The number of worker processes (default is one per
+            core, 0 for none)
+        @param queue_size The maximum number of pending calls
+        @param io_loop The IOLoop to deliver results on
+        """
+        self.iterations = iterations
+        self.legacy_salt = legacy_salt
+        self.queue_size = queue_size
+        self.io_loop = io_loop or IOLoop.instance()
+        self._pending = 0
+        # Checked in place of a missing hash, it costs as much as a real one and matches no password
+        self._no_password = "$".join((PASSWORD_ALGORITHM, str(iterations), "none", ""))
+        self._pool = multiprocessing.Pool(processes or None) if processes != 0 else None
+
+    def hash(self, password):
+        """
+        Hash a new password
+
+        @param password The plain text password
+        @return A yield point resuming with the hash to store
+        """
+        return StorageCall(self, make_password, (password, self.iterations), {})
+
+    def check(self, password, stored):
+        """
+        Check a password against its stored hash. Without a stored hash (no
+        such user) the check takes as long as with one and is never valid.
+
+        @param password The plain text password
+        @param stored The stored hash, or None
+        @return A yield point resuming with a (valid, upgraded) tuple, see
+            quarter_utils.check_password
+        """
+        return StorageCall(self, check_password, (password, stored or self._no_password, self.legacy_salt, self.iterations), {})
+
+    def submit(self, fn, args, kwargs, callback):
+        """
+        Queue a call to fn(*args), callback is run on the IOLoop with a
+        (succeeded, result or exc_info) tuple. Must be called on the IOLoop
+        thread.
+        """
+        if self._pending >= self.queue_size:
+            raise PasswordHasherBusy("Too many pending password hashes")
+        callback = stack_context.wrap(callback)
+        if not self._pool:
+            callback(_run(fn, args))
+            return
+        self._pending += 1
+        self._pool.apply_async(_run, (fn, args), callback = functools.partial(self._deliver, callback))
+
+    def pending(self):
+        """
+        Get the number of calls waiting for, or running on, a worker process
+        """
+        return self._pending
+
+    def close(self):
+        """
+        Stop the worker processes once the pending calls are done
+        """
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+    def _deliver(self, callback, result):
+        self.io_loop.add_callback(functools.partial(self._done, callback, result))
+
+    def _done(self, callback, result):
+        self._pending -= 1
+        if not result[0]:
+            logging.warning("Password hashing failed: %s", result[1][1])
+        callback(result)
@@ -0,0 +1,205 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import logging
+import Queue
+import threading
+import time
+from contextlib import contextmanager
+
+class PoolError(Exception):
+    """
+    Raised when no healthy connection could be checked out from the pool
+    """
+    pass
+
+def ping(db):
+    """
+    Default health check, run a trivial query on the connection
+    """
+    cursor = db.cursor()
+    cursor.execute("SELECT 1")
+    cursor.fetchall()
+    cursor.close()
+
+class ConnectionPool(object):
+    """
+    A fixed size pool of database connections.
+
+    Connections are opened lazily, health checked on every checkout and
+    re-opened with an exponential backoff if the check fails. The pool keeps
+    counters on checkouts, wait time and utilization, see stats().
+    """
+
+    def __init__(self, connect, size = 5, timeout = 10, health_check = ping, retries = 5, backoff = 0.1):
+        """
+        @param connect A function returning a new database connection
+        @param size The maximum number of open connections
+        @param timeout Seconds to wait for a free connection before giving up
+        @param health_check A function raising an exception if the given connection is broken
+        @param retries The number of attempts to open a connection
+        @param backoff Seconds to wait after the first failed attempt, doubled for each retry
+        """
+        self.size = size
+        self.timeout = timeout
+        self._connect = connect
+        self._health_check = health_check
+        self._retries = retries
+        self._backoff = backoff
+
+        # Free slots, None is a slot without an open connection
+        self._idle = Queue.LifoQueue()
+        for i in range(size):
+            self._idle.put(None)
+
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def checkout(self):
+        """
+        Get a healthy connection from the pool, waiting for one to be returned
+        if all are in use.
+
+        @return A database connection, which must be given back using checkin()
+        """
+        started = time.time()
+        try:
+            db = self._idle.get(timeout = self.timeout)
+        except Queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise PoolError("No free database connection within {0} seconds".format(self.timeout))
+        waited = time.time() - started
+
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        try:
+            return self._healthy(db)
+        except:
+            self._release(None)
+            raise
+
+    def checkin(self, db):
+        """
+        Return a connection to the pool
+
+        @param db The connection previously checked out
+        """
+        self._release(db)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with block
+        """
+        db = self.checkout()
+        try:
+            yield db
+        finally:
+            self.checkin(db)
+
+    def stats(self):
+        """
+        Get the pool metrics
+
+        @return A dict with the current utilization and the wait time counters
+        """
+        with self._lock:
+            return {
+                "size" : self.size,
+                "in_use" : self.in_use,
+                "peak_in_use" : self.peak_in_use,
+                "utilization" : float(self.in_use) / self.size,
+                "checkouts" : self.checkouts,
+                "timeouts" : self.timeouts,
+                "reconnects" : self.reconnects,
+                "average_wait" : self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait" : self.max_wait }
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            if db is not None:
+                self._close(db)
+
+    def _release(self, db):
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(db)
+
+    def _healthy(self, db):
+        if db is not None:
+            try:
+                self._health_check(db)
+                return db
+            except Exception:
+                logging.warning("Database connection failed health check, reconnecting")
+                self._close(db)
+                with self._lock:
+                    self.reconnects += 1
+
+        delay = self._backoff
+        for attempt in range(self._retries):
+            try:
+                return self._connect()
+            except Exception, e:
+                logging.warning("Could not connect to database (attempt %d): %s", attempt + 1, e)
+                if attempt + 1 < self._retries:
+                    time.sleep(delay)
+                    delay *= 2
+        raise PoolError("Could not connect to database")
+
+    def _close(self, db):
+        try:
+            db.close()
+        except Exception:
+            pass
+
+@contextmanager
+def connection(source):
+    """
+    Use a connection from the given pool, or the given connection as is. Lets
+    code that is handed either a pool or a single connection treat them alike.
+    """
+    if isinstance(source, ConnectionPool):
+        with source.connection() as db:
+            yield db
+    else:
+        yield source
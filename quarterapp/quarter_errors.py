@@ -41,6 +41,7 @@ ERROR_ENABLE_USER           = ApiError(302, "Could not enable the given user")
 ERROR_ENABLE_NO_USER        = ApiError(303, "Could not enable user - no user given")
 ERROR_DELETE_USER           = ApiError(304, "Could not delete the given user")
 ERROR_DELETE_NO_USER        = ApiError(305, "Could not delete user - no user given")
+ERROR_NO_DELETE_RUNNING     = ApiError(306, "The given user is not being deleted")
 
 ERROR_NOT_AUTHENTICATED     = ApiError(400, "Not logged in")
 
@@ -53,3 +54,9 @@ ERROR_DELETE_ACTIVITY       = ApiError(504, "Could not delete activity")
 ERROR_NO_QUARTERS           = ApiError(600, "No quarters given")
 ERROR_NOT_96_QUARTERS       = ApiError(601, "Expected 96 quarters")
 ERROR_INVALID_SHEET_DATE    = ApiError(602, "Expected date in YYYY-MM-DD format")
+ERROR_INVALID_QUARTERS      = ApiError(603, "Quarters must be activity ids")
+ERROR_INVALID_SHEET_RANGE   = ApiError(604, "Expected from and to dates at most 366 days apart")
+ERROR_INVALID_SHEETS        = ApiError(605, "Expected a map of at most 366 dates to quarters")
+ERROR_INVALID_RUNS          = ApiError(606, "Expected runs of quarters as start-end:activity")
+ERROR_INVALID_SHEET_VERSION = ApiError(607, "Expected the sheet version as a number")
+ERROR_STALE_SHEET           = ApiError(608, "The sheet has been changed since that version")
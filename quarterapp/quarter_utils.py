@@ -22,14 +22,17 @@
 
 import datetime
 import hashlib
+import hmac
 import base64
+import os
 import re
 
 color_hex_re = re.compile(r"^(#)([0-9a-fA-F]{3})([0-9a-fA-F]{3})?$")
 
 def hash_password(password, salt):
     """
-    Performs a password hash using the given salt.
+    Performs a password hash using the given salt. This is the legacy format,
+    new passwords are hashed with make_password.
 
     @param password The plain text password
     @param salt The applications salt
@@ -40,6 +43,54 @@ def hash_password(password, salt):
     hashed_password = base64.urlsafe_b64encode(sha.digest())
     return hashed_password
 
+PASSWORD_ALGORITHM = "pbkdf2_sha512"
+PASSWORD_SALT_BYTES = 16
+
+def make_password(password, iterations, salt = None):
+    """
+    Hash a password with PBKDF2-HMAC-SHA512 and a per password salt. This is
+    deliberately slow, run it on a passwords.PasswordHasher, not the IOLoop.
+
+    @param password The plain text password
+    @param iterations The PBKDF2 iteration count
+    @param salt The salt to use (default is a new random salt)
+    @return The hash as "pbkdf2_sha512$<iterations>$<salt>$<hash>"
+    """
+    if salt is None:
+        salt = base64.urlsafe_b64encode(os.urandom(PASSWORD_SALT_BYTES)).rstrip("=")
+    if isinstance(password, unicode):
+        password = password.encode("utf-8")
+    # A salt read back from the database may be unicode, pbkdf2_hmac would hash its internal buffer
+    salt = str(salt)
+    digest = hashlib.pbkdf2_hmac("sha512", password, salt, iterations)
+    return "$".join((PASSWORD_ALGORITHM, str(iterations), salt, base64.urlsafe_b64encode(digest)))
+
+def check_password(password, stored, legacy_salt, iterations):
+    """
+    Check a password against a stored hash, either a make_password hash or a
+    legacy hash_password one made with the application salt.
+
+    @param password The plain text password
+    @param stored The stored password hash
+    @param legacy_salt The application salt of legacy hashes
+    @param iterations The current PBKDF2 iteration count
+    @return A (valid, upgraded) tuple, upgraded is a new hash to store when the
+        password is valid but its hash is legacy or uses fewer iterations
+    """
+    if not stored:
+        return (False, None)
+    parts = stored.split("$")
+    if len(parts) == 4 and parts[0] == PASSWORD_ALGORITHM:
+        stored_iterations = int(parts[1])
+        valid = hmac.compare_digest(str(make_password(password, stored_iterations, parts[2])), str(stored))
+        upgrade = valid and stored_iterations < iterations
+    else:
+        if isinstance(password, unicode):
+            password = password.encode("utf-8")
+        valid = hmac.compare_digest(str(hash_password(password, legacy_salt)), str(stored))
+        upgrade = valid
+    return (valid, make_password(password, iterations) if upgrade else None)
+
 def valid_color_hex(color_code):
     """
     Validates that the given color code is a correct HEX code. For this
@@ -69,6 +120,18 @@ def valid_date(date):
     except:
         return False
 
+def parse_date(date):
+    """
+    Parse a date string in the format YYYY-MM-DD
+
+    @param date The date in string format
+    @return The date object, or None if the date is not valid
+    """
+    if valid_date(date):
+        parts = date.split("-")
+        return datetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
+    return None
+
 def get_dict_from_sequence(seq, key):
     # from http://stackoverflow.com/a/4391722
     return dict((d[key], dict(d, index=index)) for (index, d) in enumerate(seq))
\ No newline at end of file
@@ -30,35 +30,80 @@ import tornado.auth
 import tornado.options
 from tornado.options import options, define
 
+import storage
 from settings import QuarterSettings
+from pool import ConnectionPool
+from async_storage import AsyncStorage
+from committer import GroupCommitter
+from replicas import ReplicaRouter
+from shards import Shards
+from cache import StorageCache
+from sessions import SessionStore
+from passwords import PasswordHasher
+from mailer import Mailer
 from account import *
 from admin import *
 from api import *
 from app import *
 from quarter_utils import *
 
-def read_configuration():
+def define_options():
     """
-    Setup expected options and parse from commandline and configuration file
+    Define the expected options, safe to call more than once
     """
+    if "base_url" in options:
+        return
     define("base_url", help="Application base URL (including port but not schema")
     define("port", type=int, help="Port to listen on")
-    define("app_config_age", type=int, help="Time in minutes between application config update")
+    define("settings_poll_interval", type=int, default=2, help="Seconds between checks for changed application settings")
     define("cookie_secret", help="Random long hexvalue to secure cookies")
-    define("salt", help="Password salt used")
+    define("session_days", type=int, default=30, help="Days a login session lasts")
+    define("session_poll_interval", type=int, default=2, help="Seconds between checks for revoked sessions")
+    define("salt", help="Password salt of legacy password hashes")
+    define("password_iterations", type=int, default=100000, help="PBKDF2 iterations of new password hashes")
+    define("password_workers", type=int, help="Processes hashing passwords (default is one per core)")
+    define("password_queue_size", type=int, default=100, help="Maximum number of passwords waiting to be hashed")
     define("mysql_host", help="MySQL hostname")
     define("mysql_port", help="MySQL port", type=int)
     define("mysql_database", help="MySQL database name")
     define("mysql_user", help="MySQL username")
     define("mysql_password", help="MySQL password")
+    define("mysql_replicas", default="", help="Comma separated host:port list of MySQL replicas to read from")
+    define("replica_max_lag", type=int, default=5, help="Seconds a replica may be behind the primary and still be read from")
+    define("replica_heartbeat_interval", type=int, default=1, help="Seconds between replication heartbeats")
+    define("shards", default="", help="Comma separated list of extra databases to spread the users' data over, SQLite files or MySQL databases on mysql_host")
+    define("shard_cache_ttl", type=int, default=5, help="Seconds to cache the shard of a user")
     define("backend", help="Choice of backend, sqlite or mysql")
     define("sqlite_database", help="SQLite3 database file")
+    define("sqlite_journal_mode", default="wal", help="SQLite journal mode (delete, truncate, persist, memory, wal or off)")
+    define("sqlite_synchronous", default="full", help="SQLite synchronous level (off, normal, full or extra)")
+    define("sqlite_cache_size", type=int, default=-16000, help="SQLite page cache, in pages or in KiB if negative")
+    define("sqlite_mmap_size", type=int, default=67108864, help="Bytes of the SQLite database to memory map, 0 disables mmap")
+    define("sqlite_temp_store", default="memory", help="Where SQLite keeps temporary tables (default, file or memory)")
+    define("sqlite_busy_timeout", type=int, default=5000, help="Milliseconds SQLite waits for a lock before failing")
+    define("db_pool_size", type=int, default=5, help="Maximum number of open database connections")
+    define("db_pool_timeout", type=int, default=10, help="Seconds to wait for a free database connection")
+    define("db_queue_size", type=int, default=1000, help="Maximum number of storage calls waiting for a connection")
+    define("db_cache_size", type=int, default=16384, help="KiB of activities and sheets to cache per process, 0 disables the cache")
+    define("db_cache_max_age", type=int, default=30, help="Seconds a read may be cached, 0 for no limit")
+    define("db_group_commit_window", type=int, default=0, help="Milliseconds to collect SQLite writes into one commit")
+    define("db_group_commit_size", type=int, default=64, help="Maximum number of SQLite writes per commit, 0 or 1 commits every write on its own")
     define("mail_host", help="SMTP host name")
     define("mail_port", type=int, help="SMTP port number")
     define("mail_user", help="SMTP Authentication username")
     define("mail_password", help="SMTP Authentication password")
     define("mail_sender", help="Email sender address")
+    define("mail_batch_size", type=int, default=20, help="Maximum number of mails sent per look at the outbox")
+    define("mail_poll_interval", type=int, default=5, help="Seconds between looks at the outbox")
+    define("mail_retry_backoff", type=int, default=30, help="Seconds before retrying a failed mail, doubled for every retry")
+    define("mail_max_attempts", type=int, default=8, help="Attempts to send a mail before it is dropped")
+    define("mail_idle_timeout", type=int, default=60, help="Seconds an idle SMTP connection is kept open")
 
+def read_configuration():
+    """
+    Setup expected options and parse from commandline and configuration file
+    """
+    define_options()
     try:
         tornado.options.parse_command_line()
         tornado.options.parse_config_file("quarterapp.conf")
@@ -67,7 +112,176 @@ def read_configuration():
         exit(1)
 
 
-def quarterapp_main():
+def connect_database(read_only=False, database=None):
+    """
+    Open a connection to the configured backend. Connections run in autocommit
+    mode, every statement is committed as it is executed.
+
+    @param read_only Open a SQLite connection that refuses to write
+    @param database The SQLite file or MySQL database of a shard, default is
+        the main database
+    """
+    if options.backend == 'sqlite':
+        import sqlite3
+        db = sqlite3.connect(database or options.sqlite_database, isolation_level=None, check_same_thread=False)
+        storage.apply_pragmas(db, sqlite_pragmas())
+        if read_only:
+            storage._exec(db, "PRAGMA query_only = ON;")
+        return db
+    else:
+        return connect_mysql(options.mysql_host, options.mysql_port, database)
+
+def connect_mysql(host, port, database=None):
+    """
+    Open an autocommit connection to the configured database, or the given
+    database, on the given MySQL host
+    """
+    import MySQLdb
+    db = MySQLdb.connect(host=host, port=port, db=database or options.mysql_database,
+        user=options.mysql_user, passwd=options.mysql_password)
+    db.autocommit(True)
+    return db
+
+def sqlite_pragmas():
+    """
+    Get the configured SQLite performance pragmas
+    """
+    return {
+        "journal_mode" : options.sqlite_journal_mode,
+        "synchronous" : options.sqlite_synchronous,
+        "cache_size" : options.sqlite_cache_size,
+        "mmap_size" : options.sqlite_mmap_size,
+        "temp_store" : options.sqlite_temp_store,
+        "busy_timeout" : options.sqlite_busy_timeout }
+
+def report_database(pool):
+    """
+    Log the effective database settings
+    """
+    if options.backend == 'sqlite':
+        with pool.connection() as db:
+            pragmas = storage.get_pragmas(db)
+        logging.info("SQLite %s: %s", options.sqlite_database,
+            ", ".join("{0}={1}".format(name, pragmas[name]) for name in storage.SQLITE_PRAGMAS))
+
+def check_migrations():
+    """
+    Check that the main database and the shards have every migration this
+    version needs, see migrations.missing
+
+    @return True if they have, else False (and the missing migration is logged)
+    """
+    import migrations
+    for database in [None] + shard_databases():
+        db = connect_database(database=database)
+        try:
+            missing = migrations.missing(db)
+        finally:
+            db.close()
+        if missing:
+            logging.error("%s is missing migration %d (%s), run 'qapp migrate' first",
+                database or "The main database", missing[0].version, missing[0].description)
+            return False
+    return True
+
+def create_pool(database=None):
+    """
+    Create the connection pool for the configured backend. On SQLite the pool
+    has read-only connections, all writes go through the committer.
+
+    @param database The database of a shard, default is the main database
+    """
+    if options.backend == 'sqlite':
+        return ConnectionPool(lambda: connect_database(read_only=True, database=database), size=options.db_pool_size,
+            timeout=options.db_pool_timeout)
+    else:
+        return ConnectionPool(lambda: connect_database(database=database), size=options.db_pool_size,
+            timeout=options.db_pool_timeout, health_check=lambda db: db.ping())
+
+def create_committer(database=None):
+    """
+    Create the committer for the configured backend. SQLite allows one writer
+    at a time, so all writes are run by the committer's single writer thread.
+
+    @param database The database of a shard, default is the main database
+    """
+    if options.backend == 'sqlite':
+        return GroupCommitter(lambda: connect_database(database=database), window=options.db_group_commit_window / 1000.0,
+            max_batch=max(options.db_group_commit_size, 1), queue_size=options.db_queue_size)
+    return None
+
+def shard_databases():
+    """
+    Get the configured shard databases, besides the main database
+    """
+    return [database.strip() for database in options.shards.split(",") if database.strip()]
+
+def create_shards(pool, committer):
+    """
+    Create the shards if shard databases are configured, the main database is
+    the first shard and uses the given pool and committer
+    """
+    databases = shard_databases()
+    if not databases:
+        return None
+    main = options.sqlite_database if options.backend == 'sqlite' else options.mysql_database
+    return Shards([(main, pool, committer)] + [(database, create_pool(database), create_committer(database))
+        for database in databases], cache_ttl=options.shard_cache_ttl)
+
+def create_router(pool):
+    """
+    Create the replica router if replicas are configured, reads that may be
+    stale are then sent to replicas that are no more than replica_max_lag
+    seconds behind the primary
+    """
+    if options.backend == 'sqlite' or not options.mysql_replicas:
+        return None
+    replicas = []
+    for replica in options.mysql_replicas.split(","):
+        host, _, port = replica.strip().partition(":")
+        port = int(port) if port else options.mysql_port
+        replicas.append((replica.strip(), ConnectionPool(lambda host=host, port=port: connect_mysql(host, port),
+            size=options.db_pool_size, timeout=options.db_pool_timeout, health_check=lambda db: db.ping())))
+    return ReplicaRouter(pool, replicas, max_lag=options.replica_max_lag, interval=options.replica_heartbeat_interval)
+
+def create_cache():
+    """
+    Create the cache of the users' activities and sheets, if enabled
+    """
+    if options.db_cache_size > 0:
+        return StorageCache(options.db_cache_size * 1024, max_age=options.db_cache_max_age)
+    return None
+
+def create_passwords(io_loop=None):
+    """
+    Create the pool of processes hashing passwords, before any threads are
+    started as the processes are forked
+    """
+    return PasswordHasher(options.password_iterations, options.salt, processes=options.password_workers,
+        queue_size=options.password_queue_size, io_loop=io_loop)
+
+def create_mailer(pool, committer):
+    """
+    Create the sender of the mail in the outbox, if a mail host is configured.
+    Port 465 is SMTP over SSL, on other ports STARTTLS is used when offered.
+    """
+    if not options.mail_host:
+        return None
+    port = options.mail_port or 25
+    return Mailer(pool, options.mail_host, port, user=options.mail_user, password=options.mail_password,
+        sender=options.mail_sender, committer=committer, use_ssl=port == 465, batch_size=options.mail_batch_size,
+        poll_interval=options.mail_poll_interval, backoff=options.mail_retry_backoff,
+        max_attempts=options.mail_max_attempts, idle_timeout=options.mail_idle_timeout)
+
+def create_application(pool, io_loop=None, committer=None, router=None, shards=None, cache=None, passwords=None,
+        mailer=None):
+    """
+    Create the application, running its storage calls on connections from the
+    given pool, its writes through the committer, its reads through the
+    replica router and the cache and the users' data on the shards, if given.
+    Passwords are hashed on the IOLoop unless a password hasher is given, mail
+    is left in the outbox unless a mailer is given.
+    """
     application = tornado.web.Application(
         # Application routes
         [
@@ -101,6 +315,7 @@ def quarterapp_main():
             (r"/api/activity", ActivityApiHandler),
             (r"/api/activity/([^\/]+)", ActivityApiHandler),
             (r"/api/sheet/([^\/]+)", SheetApiHandler),
+            (r"/api/sheets", SheetsApiHandler),
             (r"/", IndexHandler),
             
             (r".*", Http404Handler)
@@ -122,28 +337,52 @@ def quarterapp_main():
         login_url = "/login"
     )
 
-    logging.info("Starting application...")
-    main_loop = tornado.ioloop.IOLoop.instance()
-
-    options.sqlite_database
+    # Setup storage, calls are run on one worker thread per pooled connection
+    application.pool = pool
+    application.storage = AsyncStorage(pool, queue_size=options.db_queue_size, io_loop=io_loop, committer=committer,
+        router=router, shards=shards, cache=cache)
 
-    # Setup database connection
-    if options.backend == 'sqlite':
-        import sqlite3
-        application.db = sqlite3.connect(options.sqlite_database)
-    else:
-        import MySQLdb
-        application.db = MySQLdb.connect(host=options.mysql_host, port=options.mysql_port, db=options.mysql_database,
-            user=options.mysql_user, passwd=options.mysql_password)
+    # Progress of the users being deleted, by username
+    application.deletions = {}
 
     # Setup application settings
-    application.quarter_settings = QuarterSettings(application.db)
+    notify_path = options.sqlite_database + "-settings" if options.backend == 'sqlite' else None
+    application.quarter_settings = QuarterSettings(application.pool, storage=application.storage, notify_path=notify_path)
+
+    # Setup sessions, cached until revoked
+    application.sessions = SessionStore(application.pool, storage=application.storage)
+
+    # Setup password hashing
+    application.passwords = passwords or PasswordHasher(options.password_iterations, options.salt, processes=0,
+        io_loop=io_loop)
+
+    # Setup the outbox sender
+    application.mailer = mailer
+    return application
+
+def quarterapp_main():
+    logging.info("Starting application...")
+    main_loop = tornado.ioloop.IOLoop.instance()
+    passwords = create_passwords()
+    pool = create_pool()
+    report_database(pool)
+    committer = create_committer()
+    application = create_application(pool, committer=committer, router=create_router(pool),
+        shards=create_shards(pool, committer), cache=create_cache(), passwords=passwords,
+        mailer=create_mailer(pool, committer))
+    if application.mailer:
+        application.mailer.start()
 
     # Setup periodic callback to update application settings
-    config_loop = tornado.ioloop.PeriodicCallback(application.quarter_settings.update,
-        options.app_config_age * 60 * 1000, io_loop = main_loop)
+    config_loop = tornado.ioloop.PeriodicCallback(application.quarter_settings.poll,
+        options.settings_poll_interval * 1000, io_loop = main_loop)
 
     config_loop.start()
+
+    # Setup periodic callback to drop revoked sessions
+    session_loop = tornado.ioloop.PeriodicCallback(application.sessions.poll,
+        options.session_poll_interval * 1000, io_loop = main_loop)
+    session_loop.start()
     
     try:
         application.listen(options.port)
@@ -163,6 +402,36 @@ def main():
         settings.create_default_config('.')
         return
     read_configuration()
+    if 'migrate' in sys.argv:
+        import migrations
+        for database in [None] + shard_databases():
+            applied = migrations.migrate(connect_database(database=database))
+            print("Applied {0} migrations to {1}".format(len(applied), database or "the main database"))
+        return
+    if not check_migrations():
+        return
+    if 'pack-sheets' in sys.argv:
+        converted = sum(storage.pack_sheets(connect_database(database=database))
+            for database in [None] + shard_databases())
+        print("Converted {0} sheets to the packed format".format(converted))
+        return
+    if 'purge-orphans' in sys.argv:
+        import shards
+        directory = connect_database()
+        purged = storage.purge_orphans(directory)
+        for database in shard_databases():
+            shard_purged = shards.purge_orphans(directory, connect_database(database=database))
+            purged = dict((table, purged[table] + shard_purged[table]) for table in purged)
+        print("Deleted {0} orphaned sheets and {1} orphaned activities".format(purged["sheets"], purged["activities"]))
+        return
+    if 'rebalance' in sys.argv:
+        import shards
+        directory = connect_database()
+        connections = [directory] + [connect_database(database=database) for database in shard_databases()]
+        moved = shards.rebalance(directory, connections, wait=options.shard_cache_ttl + 1,
+            progress=lambda moved: logging.info("Moved %d users", moved))
+        print("Moved {0} users between {1} shards".format(moved, len(connections)))
+        return
     quarterapp_main()
 
 
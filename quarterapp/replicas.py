@@ -0,0 +1,156 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import collections
+import itertools
+import logging
+import threading
+import time
+
+import storage
+
+class ReplicaRouter(object):
+    """
+    Routes reads to replicas of the primary database.
+
+    Storage functions marked with storage.replica are sent to a replica that is
+    within the staleness budget, everything else (and every read when no replica
+    is fresh enough) goes to the primary. A user that has just written reads from
+    the primary until a replica is guaranteed to have the write, i.e. for the
+    length of the staleness budget.
+
+    Replica lag is measured with a heartbeat: the router writes the time to the
+    primary every `interval` seconds and a replica is as far behind as the
+    heartbeat it has.
+    """
+
+    def __init__(self, primary, replicas, max_lag = 5, interval = 1.0, clock = time.time):
+        """
+        @param primary The connection pool of the primary
+        @param replicas A list of (name, connection pool) tuples for the replicas
+        @param max_lag The staleness budget, in seconds
+        @param interval Seconds between heartbeats, None to only check when check() is called
+        @param clock The time function
+        """
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.clock = clock
+        self._lags = [None] * len(replicas)
+        self._reads = [0] * len(replicas)
+        self._primary_reads = 0
+        self._next = itertools.cycle(range(len(replicas)))
+        self._writes = collections.OrderedDict()
+        self._stop = threading.Event()
+        self._monitor = None
+        if interval is not None:
+            self._monitor = threading.Thread(target = self._run, args = (interval, ), name = "replica-monitor")
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def pool_for(self, fn, user_id = None):
+        """
+        Get the connection pool to run a storage call on. Must be called on the
+        IOLoop thread.
+
+        @param fn The storage function
+        @param user_id The user the call is made for, if any
+        @return The connection pool of the primary or of a replica
+        """
+        if getattr(fn, "replica", False) and not self._recently_wrote(user_id):
+            for i in range(len(self.replicas)):
+                index = next(self._next)
+                lag = self._lags[index]
+                if lag is not None and lag <= self.max_lag:
+                    self._reads[index] += 1
+                    return self.replicas[index][1]
+        self._primary_reads += 1
+        return self.primary
+
+    def wrote(self, user_id):
+        """
+        Record that the given user has written to the primary. Must be called
+        on the IOLoop thread.
+        """
+        now = self.clock()
+        self._writes.pop(user_id, None)
+        self._writes[user_id] = now
+        while self._writes:
+            oldest, written = next(self._writes.iteritems())
+            if now - written <= self.max_lag:
+                break
+            del self._writes[oldest]
+
+    def _recently_wrote(self, user_id):
+        written = self._writes.get(user_id)
+        return written is not None and self.clock() - written <= self.max_lag
+
+    def check(self):
+        """
+        Write a heartbeat to the primary and measure the lag of every replica, a
+        replica that cannot be reached has no lag (None) and is not used
+        """
+        with self.primary.connection() as db:
+            storage.beat(db, self.clock())
+        for index, (name, pool) in enumerate(self.replicas):
+            try:
+                with pool.connection() as db:
+                    lag = max(self.clock() - storage.get_heartbeat(db), 0)
+            except Exception, e:
+                logging.warning("Could not check replica %s: %s", name, e)
+                lag = None
+            was_fresh = self._lags[index] is not None and self._lags[index] <= self.max_lag
+            is_fresh = lag is not None and lag <= self.max_lag
+            if was_fresh and not is_fresh:
+                logging.warning("Replica %s is %s seconds behind, reading from the primary", name, lag)
+            elif is_fresh and not was_fresh:
+                logging.info("Replica %s is in use, %.1f seconds behind", name, lag)
+            self._lags[index] = lag
+
+    def stats(self):
+        """
+        Get the replica lags and the number of reads routed to each database
+
+        @return A dict with the primary reads and a list of replicas (name, lag and reads)
+        """
+        return {
+            "primary_reads" : self._primary_reads,
+            "replicas" : [{ "name" : name, "lag" : self._lags[index], "reads" : self._reads[index] }
+                for index, (name, pool) in enumerate(self.replicas)] }
+
+    def close(self):
+        """
+        Stop the heartbeat and close the replica pools
+        """
+        self._stop.set()
+        if self._monitor:
+            self._monitor.join()
+        for name, pool in self.replicas:
+            pool.close()
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception, e:
+                logging.warning("Could not write the replication heartbeat: %s", e)
+            self._stop.wait(interval)
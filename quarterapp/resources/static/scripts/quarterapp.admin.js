@@ -46,13 +46,27 @@ Functions specific to the administrator mode
         },
 
         delete_user : function(element, username) {
+            var $element = $(element);
+            // Show the rows deleted so far while the user's data is deleted
+            var poll = setInterval(function() {
+                $.ajax({
+                    url : element.href,
+                    type : "GET",
+                    success : function(data, status, jqXHR) {
+                        $element.html("deleting (" + (data.sheets + data.activities) + ")");
+                    }
+                });
+            }, 1000);
             $.ajax({
                 url : element.href,
                 type : "POST",
                 success : function(data, status, jqXHR) {
-                    $(element).parents("tr").remove();
+                    clearInterval(poll);
+                    $element.parents("tr").remove();
                 },
                 error : function(jqXHR, status, errorThrown) {
+                    clearInterval(poll);
+                    $element.html("delete");
                     quarterapp.show_error("Oops", "Could not delete user!");
                 }
             });
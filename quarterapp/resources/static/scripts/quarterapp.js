@@ -17,11 +17,29 @@ Copyright (c) 2013 - markus.eliasson@gmail.com
         this.current_activity = { "id": -1, "color" : "#fff", "title" : "Not working"};
         this.current_date = undefined;
         this.pending_update = false;
+        this.picker = undefined;
+        this.sheets = {};
+        this.summary = {};
+        this.edits = {};
+        this.in_flight = undefined;
+        this.flush_timer = undefined;
         this.init();
     };
 
     Quarterapp.prototype = {
         constructor : Quarterapp,
+        weekdays : ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"],
+
+        /**
+         * Milliseconds a fetched sheet is shown without asking the server if it has changed
+         */
+        sheet_fresh_time : 30000,
+
+        /**
+         * Milliseconds to wait for more edits before sending them, see flush_edits
+         */
+        edit_delay : 400,
+
         activity_markup : '<div class="activity-module" data-activity-id="{0}"><div class="activity-color" data-palette-value="{2}"><input class="palette" type="text" value="" style="background-color: {2};" disabled /></div><div class="activity-title">{1}</div><div class="activity-edit-title"><input type="text" value="{1}" /></div><div class="activity-control activity-edit-control"><a href="#" title="Edit"><span>&nbsp;</span></a></div><div class="activity-control activity-save-control"><a href="#" title="Save"><span>&nbsp;</span></a></div><div class="activity-control activity-cancel-control"><a  href="#" title="Cancel"><span>&nbsp;</span></a></div><div class="activity-control activity-delete-control"><a href="#" title="Delete"><span>&nbsp;</span></a></div></div>',
 
         init : function() {
@@ -36,13 +54,33 @@ Copyright (c) 2013 - markus.eliasson@gmail.com
             if($("#datepicker").length > 0) {
                 var current_date = $("#sheet").attr("data-sheet-date");
                 this.current_date = new Date(current_date);
-                var picker = new Pikaday({
+                var quarters = [];
+                $("table.sheet span.activity-cell").each(function(index, cell) {
+                    quarters.push(parseInt($(cell).attr("data-activity-id"), 10));
+                });
+                this.sheets[current_date] = { "quarters" : quarters, "fetched" : new Date().getTime(),
+                    "version" : parseInt($("#sheet").attr("data-sheet-version"), 10) };
+                this.summary = this.count_quarters(quarters);
+                this.render_summary();
+
+                this.picker = new Pikaday({
                     field: document.getElementById('datepicker'),
                     firstDay : 1,
                     defaultDate : this.current_date,
                     setDefaultDate : true,
                     onSelect: $.proxy(this.on_select_date, this)
-                });   
+                });
+
+                // Switch days in place, see show_date
+                $("#previous-date").click($.proxy(this.on_adjacent_date, this, -1));
+                $("#next-date").click($.proxy(this.on_adjacent_date, this, 1));
+                // Give the loaded page a history entry with its date, going back to it shows the date
+                if(window.history.replaceState !== undefined) {
+                    window.history.replaceState({ "date" : current_date }, "");
+                }
+                $(window).bind("popstate", $.proxy(this.on_pop_date, this));
+                this.prefetch_adjacent_sheets();
+                $(window).bind("beforeunload", $.proxy(this.on_unload, this));
             }
 
             // Sheet activity selector
@@ -277,17 +315,224 @@ Copyright (c) 2013 - markus.eliasson@gmail.com
         },
 
         /**
-         * Load a new page when the user selects a different date in the sheet view
+         * Show the sheet of the date the user selects in the sheet view
          */
         on_select_date : function(date) {
-            if((date.getFullYear() === this.current_date.getFullYear()) &&
-                (date.getMonth() === this.current_date.getMonth()) &&
-                (date.getDate() === this.current_date.getDate())) {
+            if(this.to_date_string(date) === this.to_date_string(this.current_date)) {
+                return;
+            }
+            this.show_date(date, true);
+        },
+
+        /**
+         * Show the previous (offset -1) or next (offset 1) day's sheet
+         */
+        on_adjacent_date : function(offset, event) {
+            event.preventDefault();
+            this.show_date(this.add_days(this.current_date, offset), true);
+        },
+
+        /**
+         * Show the sheet of the date in the history entry the user went back or forward to
+         */
+        on_pop_date : function(event) {
+            var state = event.originalEvent.state;
+            if(state && state.date) {
+                this.show_date(new Date(state.date), false);
+            }
+        },
+
+        /**
+         * Return a new date the given number of days from the given date
+         */
+        add_days : function(date, days) {
+            return new Date(date.getFullYear(), date.getMonth(), date.getDate() + days);
+        },
+
+        /**
+         * Switch the sheet view to the given date without reloading the page. If the sheet
+         * cannot be fetched the page for the date is loaded instead.
+         */
+        show_date : function(date, push_history) {
+            var self = this,
+                date_string = this.to_date_string(date);
+
+            this.fetch_sheet(date_string, function(sheet) {
+                if(!sheet) {
+                    window.location = "/sheet/" + date_string;
+                    return;
+                }
+                var quarters = self.edited_quarters(date_string, sheet.quarters);
+                self.current_date = date;
+                self.render_sheet(quarters);
+                self.summary = self.count_quarters(quarters);
+                self.render_summary();
+
+                $("h1.sheet").text(self.weekdays[date.getDay()]);
+                $("#sheet").attr("data-sheet-date", date_string);
+                $("#previous-date").attr("href", "/sheet/" + self.to_date_string(self.add_days(date, -1)));
+                $("#next-date").attr("href", "/sheet/" + self.to_date_string(self.add_days(date, 1)));
+                $("#datepicker").text(date_string);
+                if(self.picker !== undefined) {
+                    // Calls on_select_date, which ignores the current date
+                    self.picker.setDate(date);
+                }
+                if(push_history && window.history.pushState !== undefined) {
+                    window.history.pushState({ "date" : date_string }, "", "/sheet/" + date_string);
+                }
+                self.prefetch_adjacent_sheets();
+            });
+        },
+
+        /**
+         * Fetch the sheets of the days before and after the current date, so switching to
+         * them needs no request (or only a revalidation)
+         */
+        prefetch_adjacent_sheets : function() {
+            this.fetch_sheet(this.to_date_string(this.add_days(this.current_date, -1)), function() {});
+            this.fetch_sheet(this.to_date_string(this.add_days(this.current_date, 1)), function() {});
+        },
+
+        /**
+         * Get the sheet of the given date, callback gets an object with the quarters (or
+         * undefined on failure). A sheet fetched within sheet_fresh_time is used as is, an
+         * older one is revalidated with its ETag and only transferred again if changed.
+         */
+        fetch_sheet : function(date_string, callback) {
+            var self = this,
+                cached = this.sheets[date_string],
+                headers = {};
+
+            if(cached && cached.quarters && (new Date().getTime() - cached.fetched) < this.sheet_fresh_time) {
+                callback(cached);
+                return;
+            }
+            if(cached && cached.request) {
+                cached.request.done(function() { callback(self.sheets[date_string]); });
+                cached.request.fail(function() { callback(undefined); });
                 return;
             }
+            if(cached && cached.etag) {
+                headers["If-None-Match"] = cached.etag;
+            }
+
+            var request = $.ajax({
+                url : "/api/sheet/" + date_string,
+                type : "GET",
+                headers : headers,
+                success : function(data, status, jqXHR) {
+                    var sheet = self.sheets[date_string] || {};
+                    if(jqXHR.status !== 304) {
+                        sheet.quarters = self.from_runs(data.runs);
+                        sheet.version = data.version;
+                    }
+                    sheet.etag = jqXHR.getResponseHeader("Etag");
+                    sheet.fetched = new Date().getTime();
+                    delete sheet.request;
+                    self.sheets[date_string] = sheet;
+                    callback(sheet);
+                },
+                error : function(jqXHR, status, errorThrown) {
+                    delete self.sheets[date_string];
+                    callback(undefined);
+                }
+            });
+            this.sheets[date_string] = $.extend(cached || {}, { "request" : request });
+        },
+
+        /**
+         * Run-length encode edits, a map of quarter to activity id, e.g. "32-40:7,50:3"
+         */
+        to_runs : function(edits) {
+            var runs = [],
+                quarters = $.map(edits, function(id, quarter) { return parseInt(quarter, 10); });
+            quarters.sort(function(a, b) { return a - b; });
+            for(var i = 0; i < quarters.length; i++) {
+                var start = quarters[i],
+                    activity_id = edits[start];
+                while(i + 1 < quarters.length && quarters[i + 1] === quarters[i] + 1 && edits[quarters[i + 1]] === activity_id) {
+                    i++;
+                }
+                runs.push(start === quarters[i] ? "{0}:{1}".format(start, activity_id) : "{0}-{1}:{2}".format(start, quarters[i], activity_id));
+            }
+            return runs.join(",");
+        },
+
+        /**
+         * Get the given date's quarters with the edits not yet saved applied on top
+         */
+        edited_quarters : function(date_string, quarters) {
+            var result = quarters.slice(0),
+                in_flight = this.in_flight !== undefined && this.in_flight.date === date_string ? this.in_flight.edits : {};
+            $.each([in_flight, this.edits[date_string] || {}], function(index, edits) {
+                $.each(edits, function(quarter, activity_id) { result[quarter] = activity_id; });
+            });
+            return result;
+        },
+
+        /**
+         * Decode a run-length encoded sheet into its 96 activity ids
+         */
+        from_runs : function(runs) {
+            var quarters = [];
+            $.each(runs.split(","), function(index, run) {
+                var parts = run.split(":"),
+                    range = parts[0].split("-"),
+                    start = parseInt(range[0], 10),
+                    end = range.length > 1 ? parseInt(range[1], 10) : start;
+                for(var quarter = start; quarter <= end; quarter++) {
+                    quarters[quarter] = parseInt(parts[1], 10);
+                }
+            });
+            return quarters;
+        },
+
+        /**
+         * Count the quarters of each activity
+         */
+        count_quarters : function(quarters) {
+            var summary = {};
+            $.each(quarters, function(index, id) {
+                summary[id] = (summary[id] || 0) + 1;
+            });
+            return summary;
+        },
+
+        /**
+         * Show the hours of each activity of the current sheet
+         */
+        render_summary : function() {
+            var total = 0,
+                $summary = $("#sheet-summary").empty();
+            $.each(this.summary, function(id, count) {
+                var $activity = $('#available-activities div.activity[data-activity-id="' + id + '"]');
+                if(id === "-1" || count <= 0) {
+                    return;
+                }
+                total += count;
+                $summary.append($('<tr><td class="value"></td><td class="activity"></td></tr>').attr("data-activity-id", id));
+                $summary.find("tr:last td.value").text(count / 4);
+                $summary.find("tr:last td.activity").text($activity.attr("data-activity-title") || "");
+            });
+            $("#summary-hours").text(total / 4);
+        },
+
+        /**
+         * Update the sheet's cells with the given 96 activity ids
+         */
+        render_sheet : function(quarters) {
+            var colors = {};
+            $("#available-activities div.activity").each(function(index, element) {
+                colors[$(element).attr("data-activity-id")] = $(element).attr("data-activity-color");
+            });
 
-            var location = "/sheet/" + this.to_date_string(date);
-            window.location = location;
+            $("table.sheet span.activity-cell").each(function(index, cell) {
+                var id = quarters[index].toString(),
+                    color = id !== "-1" && colors[id] !== undefined ? colors[id] : "#fff";
+                $(cell).attr("data-activity-id", id)
+                    .css("background-color", color)
+                    .css("border-color", "#ccc");
+            });
         },
 
         /**
@@ -409,21 +654,10 @@ Copyright (c) 2013 - markus.eliasson@gmail.com
         },
 
         /**
-         * Finalize the activity update by issueing an update request to the server. We expect that
-         * all goes well (as we already updated UI and state), but if it failes restore to old activities
-         * again.
+         * Finalize the activity update by adding the painted quarters to the day's edits, which
+         * are sent after edit_delay. Quick successive strokes are coalesced into a single request.
          */
         on_sheet_mouse_up : function(event) {
-            function cleanup_pending_activities() {
-                var $activities = $("table.sheet span.activity-cell.pending");
-                // Remove any temporary attributes
-                $activities.removeAttr("data-activity-previous-id");
-                $activities.removeAttr("data-activity-previous-color");
-
-                // Remove all pending states
-                $activities.removeClass("pending");
-            }
-
             if(event.which !== 1) {
                 return;
             }
@@ -431,48 +665,122 @@ Copyright (c) 2013 - markus.eliasson@gmail.com
                 return;
             }
 
-            var self = this;
+            var $cells = $("table.sheet span.activity-cell"),
+                $pending = $("table.sheet span.activity-cell.pending"),
+                activity_id = parseInt(this.current_activity.id, 10),
+                date_string = this.to_date_string(this.current_date),
+                edits = this.edits[date_string] || {},
+                quarters = [];
+
+            this.pending_update = false;
+            if($cells.length !== 96) {
+                quarterapp.show_error("Oops", "Sheet is broken, try to refresh the page.");
+                return;
+            }
+
+            $pending.each(function(index, cell) {
+                edits[$cells.index(cell)] = activity_id;
+            });
+            $pending.removeAttr("data-activity-previous-id");
+            $pending.removeAttr("data-activity-previous-color");
+            $pending.removeClass("pending");
+            if($pending.length === 0) {
+                return;
+            }
+            this.edits[date_string] = edits;
 
-            // Get all activities from sheet (all 96), regardless of state. Transform the these
-            // into a JSON array and PUT that at the server.
-            var quarters = []
-            var $cells = $("table.sheet span.activity-cell").each(function(index, cell) {
+            $cells.each(function(index, cell) {
                 quarters.push($(cell).attr("data-activity-id"));
             });
+            this.summary = this.count_quarters(quarters);
+            this.render_summary();
 
-            if(quarters.length !== 96) {
-                quarterapp.show_error("Oops", "Sheet is broken, try to refresh the page.");
+            clearTimeout(this.flush_timer);
+            this.flush_timer = setTimeout($.proxy(this.flush_edits, this), this.edit_delay);
+        },
+
+        /**
+         * Send the edits of one day as a patch of the version they were made on. Only one request
+         * is in flight at a time, edits made meanwhile are sent when it completes. If the sheet was
+         * changed elsewhere the server answers 409 with its sheet, the edits are then applied on
+         * top of that (where they win over the other change) and sent again.
+         */
+        flush_edits : function() {
+            var self = this,
+                date_string, edits, sheet, sent_version;
+
+            clearTimeout(this.flush_timer);
+            this.flush_timer = undefined;
+            if(this.in_flight !== undefined) {
+                return;
+            }
+            for(date_string in this.edits) {
+                break;
+            }
+            if(date_string === undefined) {
                 return;
             }
 
-            // Convert to String instead of Array
-            quarters = quarters + "";
+            edits = this.edits[date_string];
+            delete this.edits[date_string];
+            sheet = this.sheets[date_string];
+            sent_version = sheet && sheet.quarters ? sheet.version : undefined;
+            this.in_flight = { "date" : date_string, "edits" : edits };
 
             $.ajax({
-                    url : "/api/sheet/" + self.to_date_string(self.current_date),
-                    type : "PUT",
-                    data : {
-                        "quarters" : quarters
-                    },
+                    url : "/api/sheet/" + date_string,
+                    type : "PATCH",
+                    data : sent_version === undefined ? { "runs" : this.to_runs(edits) } : { "runs" : this.to_runs(edits), "version" : sent_version },
                     success : function(data, status, jqXHR) {
-                        // If all goes well we have already updated the activity attributes
-                        // final cleanup will remove any state class from UI
+                        // The cells and summary already show the edits, keep the patched sheet as the
+                        // base of the next edits. Without a version the server merged the edits into a
+                        // sheet we may not have, it is fetched again when shown.
+                        var sheet = self.sheets[date_string];
+                        if(sheet && sheet.quarters && sent_version !== undefined && sheet.version === sent_version) {
+                            $.each(edits, function(quarter, activity_id) { sheet.quarters[quarter] = activity_id; });
+                            sheet.version = data.version;
+                            sheet.etag = jqXHR.getResponseHeader("Etag");
+                            sheet.fetched = new Date().getTime();
+                        }
+                        else {
+                            delete self.sheets[date_string];
+                        }
+                        self.in_flight = undefined;
+                        self.flush_edits();
                     },
                     error : function(jqXHR, status, errorThrown) {
-                        var $activities = $("table.sheet span.activity-cell.pending");
-                        $("table.sheet span.activity-cell.pending").each(function(index, element) {
-                            var $element = $(element);
-                            $element.attr("data-activity-id", $element.attr("data-activity-previous-id"));
-                            
-                            var activity_color = $element.attr("data-activity-previous-color");
-                            $element.css("background-color", activity_color);
-                            $element.css("border-color", self.luminance(activity_color, -0.2));
-                        });
+                        self.in_flight = undefined;
+                        if(jqXHR.status === 409) {
+                            var data = $.parseJSON(jqXHR.responseText);
+                            self.edits[date_string] = $.extend(edits, self.edits[date_string]);
+                            self.sheets[date_string] = { "quarters" : self.from_runs(data.runs), "version" : data.version,
+                                "etag" : jqXHR.getResponseHeader("Etag"), "fetched" : new Date().getTime() };
+                            if(self.to_date_string(self.current_date) === date_string) {
+                                self.show_date(self.current_date, false);
+                            }
+                            self.flush_edits();
+                            return;
+                        }
+                        // Show what was actually saved
+                        delete self.sheets[date_string];
+                        delete self.edits[date_string];
+                        quarterapp.show_error("Oops", "Could not save the sheet, please try again.");
+                        if(self.to_date_string(self.current_date) === date_string) {
+                            self.show_date(self.current_date, false);
+                        }
+                        self.flush_edits();
                     }
                 });
+        },
 
-            cleanup_pending_activities();
-            this.pending_update = false;
+        /**
+         * Warn before leaving the page with edits that are not saved yet
+         */
+        on_unload : function() {
+            if(this.in_flight !== undefined || !$.isEmptyObject(this.edits)) {
+                this.flush_edits();
+                return "Your latest changes are still being saved.";
+            }
         }
     }
 
@@ -0,0 +1,216 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Server side sessions.
+
+The session cookie holds an opaque random token, the sessions table holds its
+SHA-256 (so a leaked table cannot be replayed) together with the user and the
+expiry time. Resolved sessions are kept in an in-memory LRU, so an
+authenticated request normally never touches the database, and a session that
+is not cached is looked up through the storage facade, off the IOLoop.
+
+Revoking a user's sessions (disabling or deleting the user) adds the user to
+the session revocation log. Every process polls the log and drops only the
+cached sessions of the revoked users, so a revocation made elsewhere is seen
+within one poll interval. A logout deletes just that session, the cookie is
+cleared so no other process is asked for it again.
+"""
+
+import binascii
+import collections
+import functools
+import hashlib
+import logging
+import os
+import sys
+import time
+
+import pool
+import storage
+
+TOKEN_BYTES = 32
+
+def new_token():
+    """
+    Create a new random session token
+
+    @return The token as a hex string, to be stored in the session cookie
+    """
+    return binascii.hexlify(os.urandom(TOKEN_BYTES))
+
+def session_id(token):
+    """
+    Get the id a session is stored by
+
+    @param token The token from the session cookie
+    @return The hex SHA-256 of the token
+    """
+    if isinstance(token, unicode):
+        token = token.encode("utf-8")
+    return hashlib.sha256(token).hexdigest()
+
+class SessionStore(object):
+    """
+    Resolves session tokens to users, through a LRU of the recently used
+    sessions.
+    """
+
+    def __init__(self, db, storage = None, max_cached = 10000, clock = time.time):
+        """
+        @param db The database connection, or connection pool, used when there
+            is no storage facade
+        @param storage Optional storage facade to look up sessions and poll
+            revocations through, so they never block the IOLoop
+        @param max_cached The maximum number of cached sessions
+        @param clock Function returning the current time in seconds
+        """
+        self.db = db
+        self.storage = storage
+        self.max_cached = max_cached
+        self.clock = clock
+        self.last_revocation = None
+        self._sessions = collections.OrderedDict()
+        self._generation = 0
+        self._polled_at = clock()
+        self._load_last_revocation()
+
+    def cached(self, token):
+        """
+        Get the user of a cached session, without looking it up
+
+        @param token The token from the session cookie
+        @return The user as returned by resolve, or None if the session is not
+            cached or has expired
+        """
+        if not token:
+            return None
+        key = session_id(token)
+        cached = self._sessions.get(key)
+        if cached is None or cached[1] <= self.clock():
+            return None
+        self._sessions[key] = self._sessions.pop(key)
+        return cached[0]
+
+    def resolve(self, token, callback):
+        """
+        Get the user of a session, looking it up in the database if it is not
+        cached. A cached session is passed to callback right away.
+
+        @param token The token from the session cookie
+        @param callback Function called with a dictionary with the user's id,
+            username and type, or None if the session does not exist, has
+            expired or was revoked
+        """
+        user = self.cached(token)
+        if user is not None or not token:
+            callback(user)
+            return
+        key = session_id(token)
+        looked_up = functools.partial(self._looked_up, key, self._generation, callback)
+        if self.storage:
+            self.storage.submit(storage.get_session, (key, self.clock()), {}, looked_up)
+            return
+        try:
+            with pool.connection(self.db) as db:
+                result = (True, storage.get_session(db, key, self.clock()))
+        except Exception:
+            result = (False, sys.exc_info())
+        looked_up(result)
+
+    def remember(self, token, user, expires):
+        """
+        Cache a session just created
+
+        @param token The session token
+        @param user The session's user, with at least id, username and type
+        @param expires The session's expiry time in seconds since the epoch
+        """
+        self._remember(session_id(token), { "id" : user["id"], "username" : user["username"], "type" : user["type"] }, expires)
+
+    def forget(self, token):
+        """
+        Drop a session from the cache, e.g. on logout
+
+        @param token The session token
+        """
+        self._sessions.pop(session_id(token), None)
+
+    def poll(self):
+        """
+        Drop the cached sessions of the users whose sessions have been revoked
+        since the last poll
+        """
+        if self.storage:
+            self.storage.submit(storage.get_session_revocations, (self.last_revocation,), {}, self._polled)
+            return
+        try:
+            with pool.connection(self.db) as db:
+                result = (True, storage.get_session_revocations(db, self.last_revocation))
+        except Exception:
+            result = (False, sys.exc_info())
+        self._polled(result)
+
+    def _looked_up(self, key, generation, callback, result):
+        succeeded, row = result
+        if not succeeded:
+            logging.error("Could not look up session: %s", row[1])
+            callback(None)
+            return
+        if row is None or row.expires <= self.clock():
+            callback(None)
+            return
+        user = { "id" : row.id, "username" : row.username, "type" : row.type }
+        # A revocation polled while the session was looked up may have been read too late
+        if generation == self._generation:
+            self._remember(key, user, row.expires)
+        callback(user)
+
+    def _polled(self, result):
+        succeeded, revocations = result
+        if not succeeded:
+            logging.warning("Could not check for revoked sessions: %s", revocations[1])
+            return
+        if self.clock() - self._polled_at > storage.SESSION_REVOCATIONS_KEPT:
+            # Revocations may have been dropped from the log since the last poll
+            self._sessions.clear()
+            self._generation += 1
+        self._polled_at = self.clock()
+        if not revocations:
+            return
+        revoked = set(revocation.user for revocation in revocations)
+        for key, (user, expires) in self._sessions.items():
+            if user["id"] in revoked:
+                del self._sessions[key]
+        self.last_revocation = revocations[-1].id
+        self._generation += 1
+
+    def _load_last_revocation(self):
+        with pool.connection(self.db) as db:
+            self.last_revocation = storage.get_last_session_revocation(db)
+
+    def _remember(self, key, user, expires):
+        self._sessions.pop(key, None)
+        self._sessions[key] = (user, expires)
+        while len(self._sessions) > self.max_cached:
+            self._sessions.popitem(last = False)
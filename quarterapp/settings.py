@@ -20,7 +20,11 @@
 #  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 #  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import functools
 import logging
+import os
+import sys
+import pool
 import storage
 import tornado.database
 
@@ -30,18 +34,32 @@ class QuarterSettings(object):
     not the running server. I.e. port numbers and such should not be kept here
     but in the application configuration file (quarterapp.conf).
 
-    These settings might be updated at runtime
+    These settings might be updated at runtime, poll() reloads them when the
+    settings version in the database has changed. With a notification file
+    (for processes sharing a SQLite database) a poll only checks the file's
+    modification time, which is touched by every change made through
+    quarterapp, and the version is checked every VERSION_CHECK_POLLS polls.
     """
 
-    def __init__(self, db):
+    VERSION_CHECK_POLLS = 30
+
+    def __init__(self, db, storage = None, notify_path = None):
         """
         Constructs the application settings and try to update the settings
         from database
 
-        @param db The Tornado database object used to access the database
+        @param db The database connection, or connection pool, to use
+        @param storage Optional storage facade to poll through, so polls never
+            block the IOLoop
+        @param notify_path Optional file touched when a setting is changed
         """
         self.db = db
+        self.storage = storage
+        self.notify_path = notify_path
         self.settings = {}
+        self.version = None
+        self._polls = 0
+        self._mtime = self._notify_mtime()
         self.update()
 
     def update(self):
@@ -50,12 +68,71 @@ class QuarterSettings(object):
         old settings remain active
         """
         logging.info("Updating settings...")
-        settings = storage.get_settings(self.db)
-        if settings:
+        with pool.connection(self.db) as db:
+            version = storage.get_settings_version(db)
+            settings = storage.get_settings(db)
+        self._loaded(version, (True, settings))
+
+    def poll(self):
+        """
+        Reload the settings if they have changed since the last update
+        """
+        self._polls += 1
+        if self.notify_path:
+            mtime = self._notify_mtime()
+            if mtime == self._mtime and self._polls % self.VERSION_CHECK_POLLS:
+                return
+            self._mtime = mtime
+        self._call(storage.get_settings_version, self._polled)
+
+    def _polled(self, result):
+        succeeded, version = result
+        if not succeeded:
+            logging.warning("Could not check the settings version: %s", version[1])
+        elif version != self.version:
+            self._call(storage.get_settings, functools.partial(self._loaded, version))
+
+    def _loaded(self, version, result):
+        succeeded, settings = result
+        if succeeded and settings:
             for row in settings:
                 self.settings[row.name] = row.value
-        else:
+            self.version = version
+        elif succeeded:
             logging.warn("Could not find any settings in database - everything setup ok?")
+        else:
+            logging.warning("Could not read the settings: %s", settings[1])
+
+    def _call(self, fn, callback):
+        """
+        Run a storage function through the storage facade, or at once
+        """
+        if self.storage:
+            self.storage.submit(fn, (), {}, callback)
+            return
+        try:
+            with pool.connection(self.db) as db:
+                result = (True, fn(db))
+        except Exception:
+            result = (False, sys.exc_info())
+        callback(result)
+
+    def _notify_mtime(self):
+        try:
+            return os.stat(self.notify_path).st_mtime if self.notify_path else None
+        except OSError:
+            return None
+
+    def _notify(self):
+        """
+        Touch the notification file, telling other processes to reload
+        """
+        if self.notify_path:
+            try:
+                with open(self.notify_path, "a"):
+                    os.utime(self.notify_path, None)
+            except (IOError, OSError), e:
+                logging.warning("Could not touch the settings notification file %s: %s", self.notify_path, e)
 
     def get_value(self, key):
         """
@@ -67,22 +144,51 @@ class QuarterSettings(object):
         else:
             return None
 
-    def put_value(self, key, value):
+    def put_value(self, key, value, callback = None):
         """
         Updates the value for the given key. If this key does not exist to begin with
         this function will not insert the value. I.e. this function will only update
         existing values.
 
+        With a storage facade the value is written through it, the pooled
+        connections may be read-only (SQLite writes go through the committer).
+
         @param key The settings key to update value for
         @param value The new value
+        @param callback Optional function run with a (succeeded, None or exc_info)
+            tuple once the value is written
         """
-        if self.settings.has_key(key):
-            storage.put_setting(self.db, key, value)
-            self.settings[key] = value
-        else:
+        if not self.settings.has_key(key):
             logging.warning("Trying to update a settings key that does not exists! (%s)", key)
             raise Exception("Trying to update a settings key that does not exists!")
 
+        def written(result):
+            if result[0]:
+                self.cache_value(key, value)
+            else:
+                logging.warning("Could not update the setting %s: %s", key, result[1][1])
+            if callback:
+                callback(result)
+
+        if self.storage:
+            self.storage.submit(storage.put_setting, (key, value), {}, written)
+            return
+        with pool.connection(self.db) as db:
+            storage.put_setting(db, key, value)
+        written((True, None))
+
+    def cache_value(self, key, value):
+        """
+        Update the cached value for the given key after it has been written to
+        the database by someone else (e.g. through the storage facade), and
+        notify the other processes
+
+        @param key The settings key
+        @param value The new value
+        """
+        self.settings[key] = value
+        self._notify()
+
 def create_default_config(path):
     """Create a quarterapp.conf file from the example config file"""
     import shutil, os.path
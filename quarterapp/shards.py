@@ -0,0 +1,226 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Horizontal sharding of the users' activities and sheets.
+
+The main database is the first shard and has the directory: the users table
+records the shard of every user. Storage functions marked with
+storage.sharded are run on the shard of their user, functions marked with
+storage.fanout on every shard. Users, signups and settings are only kept in
+the main database.
+
+A user is placed on a shard by a stable hash of the user id when first seen.
+rebalance() moves users whose shard is not the one the hash gives, e.g. after
+a shard has been added, while the application keeps running.
+"""
+
+import collections
+import logging
+import time
+
+import storage
+
+Location = collections.namedtuple("Location", ["shard", "moving"])
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping and Veach), maps a key to one of the given
+    number of buckets. Going from n to n + 1 buckets moves 1 / (n + 1) of the
+    keys, all to the new bucket.
+
+    @param key A non-negative integer
+    @param buckets The number of buckets
+    @return The bucket, 0 <= bucket < buckets
+    """
+    key &= 0xffffffffffffffff
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+class Shards(object):
+    """
+    The shards of a running application, with a cache of the users' locations.
+
+    A location is cached for cache_ttl seconds, so a change to the directory is
+    seen by every application process within that time. The rebalancing relies
+    on it, see rebalance().
+    """
+
+    def __init__(self, shards, cache_ttl = 5, max_cached = 100000, clock = time.time):
+        """
+        @param shards A list of (name, connection pool, committer) tuples, the
+            main database first. The committer may be None. The main database's
+            pool and committer belong to the storage facade and are not closed
+            by close().
+        @param cache_ttl Seconds to cache a user's location
+        @param max_cached The maximum number of cached locations
+        @param clock The time function
+        """
+        self.shards = shards
+        self.cache_ttl = cache_ttl
+        self.max_cached = max_cached
+        self.clock = clock
+        self._locations = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.shards)
+
+    def home(self, user_id):
+        """
+        Get the shard the given user belongs on
+        """
+        return jump_hash(user_id, len(self.shards))
+
+    def pool(self, index):
+        return self.shards[index][1]
+
+    def committer(self, index):
+        return self.shards[index][2]
+
+    def located(self, user_id):
+        """
+        Get the cached location of a user. Must be called on the IOLoop thread.
+
+        @return The Location or None if not cached
+        """
+        cached = self._locations.get(user_id)
+        if cached is None or self.clock() > cached[1]:
+            return None
+        return cached[0]
+
+    def remember(self, user_id, row):
+        """
+        Cache the location of a user. Must be called on the IOLoop thread.
+
+        @param user_id The user
+        @param row The user's location, see storage.get_user_shard. A user that
+            does not exist is located on the main database.
+        @return True if the user is moving or was not located on the same shard
+            before, data of the user cached elsewhere may then be stale
+        """
+        location = Location(row.shard, row.moving) if row else Location(0, None)
+        previous = self._locations.pop(user_id, (None, ))[0]
+        self._locations[user_id] = (location, self.clock() + self.cache_ttl)
+        while len(self._locations) > self.max_cached:
+            self._locations.popitem(last = False)
+        return location != previous or location.moving is not None
+
+    def close(self):
+        """
+        Close the pools and committers of the shards other than the main database
+        """
+        for name, pool, committer in self.shards[1:]:
+            if committer:
+                committer.close()
+            pool.close()
+
+def rebalance(directory, shards, batch_size = 100, wait = 0, progress = None, sleep = time.sleep):
+    """
+    Move every placed user whose shard is not the one given by jump_hash to
+    that shard, finishing interrupted moves first.
+
+    Users are moved in batches. A batch is marked as moving in the directory,
+    from then on the application refuses to write the users' activities and
+    sheets. After waiting for the application's cached locations to expire
+    the data is copied and the directory is updated, after a second wait the
+    data is deleted from the old shard and the users may write again.
+
+    @param directory A connection to the main database
+    @param shards Connections to every shard, the main database first
+    @param batch_size The number of users to move at a time
+    @param wait Seconds the application caches a user's location (shard_cache_ttl)
+    @param progress Optional function called after each batch with the number
+        of moved users so far
+    @param sleep The function used to wait
+    @return The number of moved users
+    """
+    interrupted = [(move.user, move.source, move.target) for move in storage.get_moves(directory)]
+    if interrupted:
+        logging.info("Finishing %d interrupted moves", len(interrupted))
+        _move(directory, shards, interrupted, wait, sleep)
+
+    moved = 0
+    last_id = 0
+    while True:
+        users = storage.get_user_shards(directory, last_id, batch_size)
+        if not users:
+            break
+        moves = [(user.id, user.shard, jump_hash(user.id, len(shards))) for user in users]
+        moves = [(user_id, source, target) for user_id, source, target in moves if source != target]
+        if moves:
+            for user_id, source, target in moves:
+                storage.start_move(directory, user_id, source, target)
+            _move(directory, shards, moves, wait, sleep)
+            moved += len(moves)
+            if progress:
+                progress(moved)
+        last_id = users[-1].id
+    return moved
+
+def _move(directory, shards, moves, wait, sleep):
+    """
+    Move the data of the given (user id, source, target) moves, recorded with
+    storage.start_move, a move interrupted after updating the directory is not
+    copied again
+    """
+    sleep(wait)
+    for user_id, source, target in moves:
+        location = storage.get_user_shard(directory, user_id)
+        if location is not None and location.shard == source:
+            storage.delete_user_data(shards[target], user_id)
+            storage.put_user_data(shards[target], user_id, *storage.get_user_data(shards[source], user_id))
+            storage.set_user_shard(directory, user_id, target)
+    sleep(wait)
+    for user_id, source, target in moves:
+        storage.delete_user_data(shards[source], user_id)
+        storage.end_move(directory, user_id)
+
+def purge_orphans(directory, shard, chunk_size = 1000, progress = None):
+    """
+    Delete the activities and sheets of users that no longer exist from a shard
+    other than the main database, see storage.purge_orphans for the main database
+
+    @param directory A connection to the main database
+    @param shard A connection to the shard
+    @param chunk_size The number of users to check, and rows to delete, at a time
+    @param progress Optional function called after each chunk with the table name
+        and the number of rows deleted from it so far
+    @return A dict with the number of deleted activities and sheets
+    """
+    deleted = { "activities" : 0, "sheets" : 0 }
+    last_id = 0
+    while True:
+        user_ids = storage.get_data_user_ids(shard, last_id, chunk_size)
+        if not user_ids:
+            break
+        existing = storage.get_existing_user_ids(directory, user_ids)
+        for user_id in user_ids:
+            if user_id not in existing:
+                data = storage.delete_user_data(shard, user_id, chunk_size, progress)
+                deleted["activities"] += data["activities"]
+                deleted["sheets"] += data["sheets"]
+        last_id = user_ids[-1]
+    return deleted
@@ -0,0 +1,191 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Binary encoding of a day's quarters.
+
+A sheet is stored as a dictionary coded BLOB:
+
+    byte 0        format tag (PACKED_NIBBLE or PACKED_BYTE)
+    byte 1        number of distinct activity ids (n)
+    n * 4 bytes   the activity ids, signed 32-bit little endian
+    codes         one index into the id table per quarter
+
+With at most 16 distinct activities in a day (the common case) the codes are
+packed two per byte, giving a 66 byte row for a day with four activities.
+
+Sheets written before the binary format was introduced are comma separated
+text, decode() still accepts those so rows can be converted online.
+
+On the wire sheets and changes to sheets are run-length encoded, as comma
+separated runs of "start-end:activity" (or "quarter:activity" for a run of
+one quarter), e.g. "0-31:-1,32-40:7,41-95:-1".
+"""
+
+import struct
+from array import array
+
+QUARTERS_PER_DAY = 96
+
+PACKED_NIBBLE = 0x01
+PACKED_BYTE = 0x02
+
+_HEADER_SIZE = 2
+_ID_SIZE = 4
+
+# Activity ids are stored as signed 32-bit integers
+MIN_ID = -2 ** 31
+MAX_ID = 2 ** 31 - 1
+
+def parse_id(value):
+    """
+    Parse an activity id of a sheet
+
+    @param value The id, an int or a numeric string
+    @return The id as an int
+    @raise ValueError If the value is not a number that fits the stored id
+    """
+    result = int(value)
+    if not MIN_ID <= result <= MAX_ID:
+        raise ValueError("Activity id {0} out of range".format(result))
+    return result
+
+def encode(quarters):
+    """
+    Encode a sequence of activity ids into the packed binary format.
+
+    @param quarters A sequence of 96 activity ids (ints or numeric strings)
+    @return The packed sheet as a byte string
+    @raise ValueError If there are not 96 quarters or an id is not a valid activity id
+    """
+    table = []
+    index = {}
+    codes = bytearray()
+    for quarter in quarters:
+        quarter = parse_id(quarter)
+        code = index.get(quarter)
+        if code is None:
+            code = index[quarter] = len(table)
+            table.append(quarter)
+        codes.append(code)
+
+    if len(codes) != QUARTERS_PER_DAY:
+        raise ValueError("Expected {0} quarters, got {1}".format(QUARTERS_PER_DAY, len(codes)))
+
+    if len(table) <= 16:
+        tag = PACKED_NIBBLE
+        packed = bytearray((codes[i] << 4) | codes[i + 1] for i in range(0, QUARTERS_PER_DAY, 2))
+    else:
+        tag = PACKED_BYTE
+        packed = codes
+
+    header = struct.pack("<BB%di" % len(table), tag, len(table), *table)
+    return header + bytes(packed)
+
+def decode(value):
+    """
+    Decode a stored sheet, packed or legacy text, into an array of activity ids.
+
+    @param value The stored sheet value
+    @return An array('i') of 96 activity ids
+    """
+    if is_packed(value):
+        data = bytearray(value)
+        count = data[1]
+        table = struct.unpack_from("<%di" % count, data, _HEADER_SIZE)
+        codes = data[_HEADER_SIZE + count * _ID_SIZE:]
+        if data[0] == PACKED_NIBBLE:
+            result = array("i")
+            for code in codes:
+                result.append(table[code >> 4])
+                result.append(table[code & 0x0f])
+            return result
+        return array("i", [table[code] for code in codes])
+    return array("i", [int(quarter) for quarter in value.split(",")])
+
+def is_packed(value):
+    """
+    Check if the given stored sheet value uses the binary format
+
+    @param value The stored sheet value
+    @return True if packed, False if the value is legacy comma separated text
+    """
+    if isinstance(value, unicode):
+        return False
+    return len(value) > 0 and bytearray(value[:1])[0] in (PACKED_NIBBLE, PACKED_BYTE)
+
+def encode_runs(quarters):
+    """
+    Run-length encode a sheet
+
+    @param quarters A sequence of 96 activity ids
+    @return The runs covering the whole sheet, e.g. "0-31:-1,32-40:7,41-95:-1"
+    """
+    runs = []
+    start = 0
+    for index in range(1, len(quarters) + 1):
+        if index == len(quarters) or quarters[index] != quarters[start]:
+            runs.append(_run(start, index - 1, quarters[start]))
+            start = index
+    return ",".join(runs)
+
+def _run(start, end, activity_id):
+    if start == end:
+        return "{0}:{1}".format(start, activity_id)
+    return "{0}-{1}:{2}".format(start, end, activity_id)
+
+def decode_runs(value):
+    """
+    Decode run-length encoded quarters
+
+    @param value The runs, e.g. "32-40:7,50:3"
+    @return A list of (start, end, activity id) tuples, end inclusive
+    """
+    runs = []
+    for run in value.split(","):
+        quarters, _, run_id = run.partition(":")
+        start, dash, end = quarters.partition("-")
+        start = int(start)
+        end = int(end) if dash else start
+        if not 0 <= start <= end < QUARTERS_PER_DAY:
+            raise ValueError("Invalid run {0}".format(run))
+        runs.append((start, end, parse_id(run_id)))
+    return runs
+
+def apply_runs(quarters, runs):
+    """
+    Apply runs to a sheet, in place
+
+    @param quarters A mutable sequence of 96 activity ids
+    @param runs A list of (start, end, activity id) tuples, see decode_runs
+    @return The change of each activity's number of quarters, as a dict of
+        activity id to the (non-zero) difference
+    """
+    changes = {}
+    for start, end, activity_id in runs:
+        for index in range(start, end + 1):
+            previous = quarters[index]
+            if previous != activity_id:
+                changes[previous] = changes.get(previous, 0) - 1
+                changes[activity_id] = changes.get(activity_id, 0) + 1
+                quarters[index] = activity_id
+    return dict((activity_id, change) for activity_id, change in changes.items() if change)
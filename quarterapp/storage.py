@@ -20,8 +20,15 @@
 #  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 #  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from functools import wraps
+import logging
 import sqlite3, re
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+import sheet_codec
+
 _SQLITE_RE = re.compile(r'%\((\w+)\)s')
 
 class User(object):
@@ -31,43 +38,323 @@ class User(object):
     Disabled = 0
 
 
-class Data(dict):
+class Row(tuple):
+    """
+    A result row, accessible by position, by column name as a key and by column
+    name as an attribute. Rows are plain tuples; the column index is kept on a
+    class shared by every row with the same set of columns.
+    """
+    __slots__ = ()
+    _columns = ()
+    _index = {}
+
     def __getattr__(self, name):
         try:
-            return self[name]
+            return tuple.__getitem__(self, self._index[name])
         except KeyError:
             raise AttributeError(name)
 
-def hack_sql(fn):
-    """Hack MySQL driver SQL into SQLite3 driver SQL. 
-    WISHLIST: Should have zero impact when using MySQL."""
-    @wraps(fn)
-    def hack_sql(db, sql, *args, **kwargs): 
-        if isinstance(db, sqlite3.Connection):
-            sql = _SQLITE_RE.sub(r':\1', sql.replace('%s', '?'))
-        return fn(db, sql, *args, **kwargs)
-    return hack_sql
-
-@hack_sql
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._columns)
+
+    def items(self):
+        return zip(self._columns, self)
+
+_ROW_CLASSES = {}
+
+def _row_class(cursor):
+    """
+    Get the row class for the columns of the given cursor's result
+    """
+    columns = tuple(c[0] for c in cursor.description)
+    try:
+        return _ROW_CLASSES[columns]
+    except KeyError:
+        cls = _ROW_CLASSES[columns] = type("Row", (Row,), { "__slots__" : (), "_columns" : columns,
+            "_index" : dict((column, i) for i, column in enumerate(columns)) })
+        return cls
+
+class Statement(object):
+    """
+    A SQL statement written for the MySQL driver, with optional variants for
+    backends that need a different statement altogether (given as keyword
+    arguments named after the dialect).
+    """
+    def __init__(self, sql, **variants):
+        self.sql = sql
+        self.variants = variants
+
+class Dialect(object):
+    """
+    Translates statements into a backend's SQL. Each statement is translated
+    once and kept in the dialect's statement registry, so the drivers always
+    get the same pre-translated string for a statement.
+
+    Statement objects are always registered. Plain strings are registered
+    until the registry holds max_statements of them, after that they are
+    translated on every call, so SQL built at run time (IN lists, pragmas)
+    cannot grow the registry without bound.
+    """
+    def __init__(self, name, translate, begin, max_statements = 512):
+        self.name = name
+        self.translate = translate
+        self.begin = begin
+        self.max_statements = max_statements
+        self.statements = {}
+        self.strings = 0
+
+    def sql(self, statement):
+        try:
+            return self.statements[statement]
+        except KeyError:
+            if isinstance(statement, Statement):
+                sql = self.statements[statement] = self.translate(statement.variants.get(self.name, statement.sql))
+                return sql
+            sql = self.translate(statement)
+            if self.strings < self.max_statements:
+                self.statements[statement] = sql
+                self.strings += 1
+            return sql
+
+    def streaming_cursor(self, db):
+        """
+        Get a cursor that keeps the result set on the server and fetches it as
+        it is consumed
+        """
+        if self is MYSQL:
+            import MySQLdb.cursors
+            return db.cursor(MySQLdb.cursors.SSCursor)
+        return db.cursor()
+
+MYSQL = Dialect("mysql", lambda sql: sql, "START TRANSACTION;")
+SQLITE = Dialect("sqlite", lambda sql: _SQLITE_RE.sub(r':\1', sql.replace('%s', '?')), "BEGIN;")
+
+_DIALECTS = { sqlite3.Connection : SQLITE }
+
+def dialect(db):
+    """
+    Get the dialect for the given database connection
+    """
+    try:
+        return _DIALECTS[type(db)]
+    except KeyError:
+        result = _DIALECTS[type(db)] = SQLITE if isinstance(db, sqlite3.Connection) else MYSQL
+        return result
+
+SQLITE_PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout")
+
+_PRAGMA_VALUE_RE = re.compile(r'^-?\w+$')
+_PRAGMA_NAMES = {
+    "synchronous" : { 0 : "off", 1 : "normal", 2 : "full", 3 : "extra" },
+    "temp_store" : { 0 : "default", 1 : "file", 2 : "memory" } }
+
+def apply_pragmas(db, pragmas):
+    """
+    Apply performance pragmas to a SQLite connection
+
+    @param db The SQLite connection
+    @param pragmas A dict of pragma names (see SQLITE_PRAGMAS) to values, None values are left as they are
+    """
+    for name in SQLITE_PRAGMAS:
+        value = pragmas.get(name)
+        if value is None:
+            continue
+        if not _PRAGMA_VALUE_RE.match(str(value)):
+            raise ValueError("Invalid value for pragma {0}: {1}".format(name, value))
+        _exec(db, "PRAGMA {0} = {1};".format(name, value))
+
+def get_pragmas(db):
+    """
+    Get the effective values of the performance pragmas of a SQLite connection
+
+    @param db The SQLite connection
+    @return A dict of pragma names to values
+    """
+    pragmas = {}
+    for name in SQLITE_PRAGMAS:
+        value = _query(db, "PRAGMA {0};".format(name))[0][0]
+        pragmas[name] = _PRAGMA_NAMES.get(name, {}).get(value, value)
+    return pragmas
+
 def _query(db, sql, *params):
     cursor = db.cursor()
-    cursor.execute(sql, *params)
-    cols = [c[0] for c in cursor.description]
-    return [Data(zip(cols, row)) for row in cursor.fetchall()]
+    cursor.execute(dialect(db).sql(sql), *params)
+    cls = _row_class(cursor)
+    return [cls(row) for row in cursor.fetchall()]
+
+def _iter_query(db, sql, params = (), chunk_size = 500):
+    """
+    Iterate over the result of a query, fetching chunk_size rows at a time
+    instead of materializing the whole result. On MySQL the connection cannot
+    run other statements until the iteration is completed.
+    """
+    backend = dialect(db)
+    cursor = backend.streaming_cursor(db)
+    try:
+        cursor.execute(backend.sql(sql), params)
+        cls = _row_class(cursor)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield cls(row)
+    finally:
+        cursor.close()
 
-@hack_sql
 def _query_rowcount(db, sql, params):
     cursor = db.cursor()
-    cursor.execute(sql, params)
+    cursor.execute(dialect(db).sql(sql), params)
     
     return cursor.rowcount
 
-@hack_sql
 def _exec(db, sql, *params):
     cursor = db.cursor()
-    cursor.execute(sql, *params)
+    cursor.execute(dialect(db).sql(sql), *params)
     return cursor.lastrowid
 
+def _exec_many(db, sql, params):
+    cursor = db.cursor()
+    cursor.executemany(dialect(db).sql(sql), params)
+    return cursor.rowcount
+
+_open_transactions = threading.local()
+
+@contextmanager
+def transaction(db):
+    """
+    Run the statements in the with block in one transaction, committed when the
+    block completes and rolled back if it raises. Pooled connections are in
+    autocommit mode so the transaction is started explicitly.
+
+    A transaction within a transaction on the same connection is a savepoint, it
+    only rolls back its own statements and is committed with the outer one.
+    """
+    depths = _open_transactions.__dict__.setdefault("depths", {})
+    depth = depths.get(id(db), 0)
+    cursor = db.cursor()
+    if depth == 0:
+        cursor.execute(dialect(db).begin)
+    else:
+        cursor.execute("SAVEPOINT nested_{0};".format(depth))
+    depths[id(db)] = depth + 1
+    try:
+        try:
+            yield db
+        except:
+            if depth == 0:
+                db.rollback()
+            else:
+                cursor.execute("ROLLBACK TO SAVEPOINT nested_{0};".format(depth))
+                cursor.execute("RELEASE SAVEPOINT nested_{0};".format(depth))
+            raise
+        if depth == 0:
+            db.commit()
+        else:
+            cursor.execute("RELEASE SAVEPOINT nested_{0};".format(depth))
+    finally:
+        if depth == 0:
+            del depths[id(db)]
+        else:
+            depths[id(db)] = depth
+
+_chunk_hooks = threading.local()
+
+@contextmanager
+def between_chunks(db, hook):
+    """
+    Run hook(db) after each chunk committed by the chunked writes run on the
+    connection in the with block, see committer.GroupCommitter
+    """
+    hooks = _chunk_hooks.__dict__.setdefault("hooks", {})
+    hooks[id(db)] = hook
+    try:
+        yield db
+    finally:
+        del hooks[id(db)]
+
+def _chunk_committed(db):
+    """
+    Called by the chunked writes after each chunk, outside of any transaction
+    """
+    hook = _chunk_hooks.__dict__.get("hooks", {}).get(id(db))
+    if hook and not _open_transactions.__dict__.get("depths", {}).get(id(db)):
+        hook(db)
+
+def write(fn = None, alone = False):
+    """
+    Mark a storage function as a write, see committer.GroupCommitter. Short
+    writes may be run in a transaction shared with other writes, writes that
+    manage their own transactions are marked with alone = True. A write run
+    alone that commits in chunks calls _chunk_committed after each chunk, so
+    the writes waiting behind it can be committed in between.
+    """
+    def mark(fn):
+        fn.write = True
+        fn.write_alone = alone
+        return fn
+    if fn:
+        return mark(fn)
+    return mark
+
+def replica(fn):
+    """
+    Mark a storage function as a read that may be served by a replica, see
+    replicas.ReplicaRouter
+    """
+    fn.replica = True
+    return fn
+
+def sharded(fn):
+    """
+    Mark a storage function as using only the activities and sheets of its
+    user_id, it is run on the user's shard, see shards.Shards
+    """
+    fn.sharded = True
+    return fn
+
+def cached(group):
+    """
+    Mark a read of a user's data as cacheable, writes marked with
+    invalidates(group) drop it, see cache.StorageCache
+    """
+    def mark(fn):
+        fn.cached = group
+        return fn
+    return mark
+
+def invalidates(*groups):
+    """
+    Mark a write of a user's data as changing the reads cached in the given
+    groups, see cache.StorageCache
+    """
+    def mark(fn):
+        fn.invalidates = groups
+        return fn
+    return mark
+
+def fanout(merge):
+    """
+    Mark a storage function as covering the activities and sheets of every
+    user, it is run on every shard and the list of results is combined with
+    merge (e.g. sum), see shards.Shards
+    """
+    def mark(fn):
+        fn.fanout = merge
+        return fn
+    return mark
+
 def get_settings(db):
     """
     Get all settings from the database
@@ -90,17 +377,38 @@ def get_setting(db, name):
         return getattr(result[0], "value")
     return None
 
+@write
 def put_setting(db, name, value):
     """
     Set a specific setting to the given value
 
+    The settings version is bumped in the same transaction, see
+    get_settings_version.
+
     @param db The database connection
     @param name The setting's name
     @param value The setting's value
     @return True on success, else False
     """
-    return _exec(db, "UPDATE settings SET value=%(value)s WHERE name=%(name)s ;", { "value" : value, "name" : name }) == 1
+    with transaction(db):
+        result = _exec(db, "UPDATE settings SET value=%(value)s WHERE name=%(name)s ;", { "value" : value, "name" : name }) == 1
+        _exec(db, "UPDATE settings_version SET version = version + 1 WHERE id=1;")
+    return result
+
+def get_settings_version(db):
+    """
+    Get the settings version, which changes whenever a setting is changed. A
+    setting changed by hand must be followed by bumping the version:
+
+        UPDATE settings_version SET version = version + 1;
+
+    @param db The database connection
+    @return The settings version
+    """
+    rows = _query(db, "SELECT version FROM settings_version WHERE id=1;")
+    return rows[0].version if rows else 0
 
+@replica
 def get_signup_count(db):
     """
     Get the total number of pending users (signed up, not active)
@@ -114,6 +422,7 @@ def get_signup_count(db):
     else:
         return 0
 
+@replica
 def get_user_count(db):
     """
     Get the total number of users (not pending users), regardless of their state of type.
@@ -127,6 +436,50 @@ def get_user_count(db):
     else:
         return 0
 
+SEARCH_MIN_LENGTH = 3
+
+# Username searches answered by the search index (FTS5 trigrams on SQLite, an ngram
+# FULLTEXT index on MySQL). On SQLite the paging is done inside the index lookup so
+# only the rows of the requested page are read. On MySQL the ngram phrase narrows
+# down the rows and LIKE keeps the result an exact substring match.
+_MYSQL_SEARCH = "MATCH (username) AGAINST (%(match)s IN BOOLEAN MODE) AND username LIKE %(filter)s"
+
+_COUNT_SEARCH = Statement(
+    "SELECT COUNT(*) FROM users WHERE " + _MYSQL_SEARCH + ";",
+    sqlite = "SELECT COUNT(*) FROM users_search WHERE users_search MATCH %(match)s;")
+
+_SEARCH_USERS = Statement(
+    "SELECT id, username, type, state, last_login FROM users WHERE " + _MYSQL_SEARCH + " ORDER BY id LIMIT %(start)s, %(count)s;",
+    sqlite = "SELECT id, username, type, state, last_login FROM users WHERE id IN "
+        "(SELECT rowid FROM users_search WHERE users_search MATCH %(match)s ORDER BY rowid LIMIT %(start)s, %(count)s) ORDER BY id;")
+
+_SEARCH_USERS_AFTER = Statement(
+    "SELECT id, username, type, state, last_login FROM users WHERE " + _MYSQL_SEARCH + " AND id > %(after)s ORDER BY id LIMIT %(count)s;",
+    sqlite = "SELECT id, username, type, state, last_login FROM users WHERE id IN "
+        "(SELECT rowid FROM users_search WHERE users_search MATCH %(match)s AND rowid > %(after)s ORDER BY rowid LIMIT %(count)s) ORDER BY id;")
+
+_SEARCH_IDS_AFTER = Statement(
+    "SELECT id FROM users WHERE " + _MYSQL_SEARCH + " AND id > %(after)s ORDER BY id LIMIT %(count)s;",
+    sqlite = "SELECT rowid AS id FROM users_search WHERE users_search MATCH %(match)s AND rowid > %(after)s ORDER BY rowid LIMIT %(count)s;")
+
+_SEARCH_IDS_THROUGH = Statement(
+    "SELECT id FROM users WHERE " + _MYSQL_SEARCH + " AND id <= %(last)s ORDER BY id DESC LIMIT %(count)s;",
+    sqlite = "SELECT rowid AS id FROM users_search WHERE users_search MATCH %(match)s AND rowid <= %(last)s ORDER BY rowid DESC LIMIT %(count)s;")
+
+def _search_params(query_filter, **params):
+    """
+    Get the parameters for a username search, and whether the search index can
+    answer it. The index needs at least SEARCH_MIN_LENGTH characters, shorter
+    filters fall back to scanning with LIKE.
+
+    @param query_filter The filter to match against username
+    @return A tuple with True if the search index should be used, and the parameters
+    """
+    params["filter"] = "%{0}%".format(query_filter) # MySQL formatting using % as wildcard
+    params["match"] = '"{0}"'.format(query_filter)
+    return len(query_filter) >= SEARCH_MIN_LENGTH and '"' not in query_filter, params
+
+@replica
 def get_filtered_user_count(db, query_filter):
     """
     Get the total number of users (not pending users), regardless of their state of type, but
@@ -136,31 +489,44 @@ def get_filtered_user_count(db, query_filter):
     @param query_filter The filter to match against username
     @return The number of users
     """
-    query_filter = "%{0}%".format(query_filter) # MySQL formatting using % as wildcard
-    count = _query(db, "SELECT COUNT(*) FROM users WHERE username LIKE %(filter)s;", { "filter" : query_filter })
+    indexed, params = _search_params(query_filter)
+    if indexed:
+        count = _query(db, _COUNT_SEARCH, params)
+    else:
+        count = _query(db, "SELECT COUNT(*) FROM users WHERE username LIKE %(filter)s;", params)
     if len(count) > 0:
         return getattr(count[0], "COUNT(*)")
     else:
         return 0
 
-def get_users(db, start = 0, count = 50):
+@replica
+def get_users(db, start = 0, count = 50, after_id = None):
     """
     Get a list of user rows starting at the given position. If the start index is out of bounds
     an empty list will be returned. If there are as many users as the given 'count' the list will
     be filled with as many as there is.
 
+    Passing after_id pages by key instead of by offset, which is a range scan on the
+    primary key and costs the same regardless of how deep into the table the page is.
+
     @param db The database connection
     @param start The start index in the user table (default is 0)
     @param count The number of users to receive (default is 50)
+    @param after_id Get the users with an id greater than this, start is ignored if given
     @return The list of users
     """
-    users = _query(db, "SELECT id, username, type, state, last_login FROM users ORDER BY id LIMIT %(start)s, %(count)s;",
-        { "start" : start, "count" : count })
+    if after_id is not None:
+        users = _query(db, "SELECT id, username, type, state, last_login FROM users WHERE id > %(after)s ORDER BY id LIMIT %(count)s;",
+            { "after" : after_id, "count" : count })
+    else:
+        users = _query(db, "SELECT id, username, type, state, last_login FROM users ORDER BY id LIMIT %(start)s, %(count)s;",
+            { "start" : start, "count" : count })
     if not users:
         users = []
     return users
 
-def get_filtered_users(db, query_filter, start = 0, count = 50):
+@replica
+def get_filtered_users(db, query_filter, start = 0, count = 50, after_id = None):
     """
     Get a filtered list of user rows starting at the given position. If the start index is out of bounds
     an empty list will be returned. If there are as many users as the given 'count' the list will
@@ -171,15 +537,72 @@ def get_filtered_users(db, query_filter, start = 0, count = 50):
     @param query_filter The query filter to use
     @param start The start index in the user table (default is 0)
     @param count The number of users to receive (default is 50)
+    @param after_id Get the users with an id greater than this, start is ignored if given
     @return A list of matched users
     """
-    query_filter = "%{0}%".format(query_filter) # MySQL formatting using % as wildcard
-    users = _query(db, "SELECT id, username, type, state, last_login FROM users WHERE username LIKE %(filter)s ORDER BY id LIMIT %(start)s, %(count)s;",
-        { "filter" : query_filter, "start" : start, "count" : count })
+    indexed, params = _search_params(query_filter, start = start, count = count, after = after_id)
+    if after_id is not None:
+        if indexed:
+            users = _query(db, _SEARCH_USERS_AFTER, params)
+        else:
+            users = _query(db, "SELECT id, username, type, state, last_login FROM users WHERE username LIKE %(filter)s AND id > %(after)s ORDER BY id LIMIT %(count)s;",
+                params)
+    elif indexed:
+        users = _query(db, _SEARCH_USERS, params)
+    else:
+        users = _query(db, "SELECT id, username, type, state, last_login FROM users WHERE username LIKE %(filter)s ORDER BY id LIMIT %(start)s, %(count)s;",
+            params)
     if not users:
         users = []
     return users
 
+@replica
+def get_user_ids_after(db, after_id, count, query_filter = None):
+    """
+    Get the ids of the users following the given id, used to find where the next
+    pages of a keyset paginated listing start
+
+    @param db The database connection
+    @param after_id Get ids greater than this
+    @param count The maximum number of ids to get
+    @param query_filter Optional filter to match against username
+    @return A list of ids in ascending order
+    """
+    if query_filter:
+        indexed, params = _search_params(query_filter, after = after_id, count = count)
+        if indexed:
+            rows = _query(db, _SEARCH_IDS_AFTER, params)
+        else:
+            rows = _query(db, "SELECT id FROM users WHERE username LIKE %(filter)s AND id > %(after)s ORDER BY id LIMIT %(count)s;", params)
+    else:
+        rows = _query(db, "SELECT id FROM users WHERE id > %(after)s ORDER BY id LIMIT %(count)s;",
+            { "after" : after_id, "count" : count })
+    return [row.id for row in rows]
+
+@replica
+def get_user_ids_through(db, last_id, count, query_filter = None):
+    """
+    Get the ids of the users up to and including the given id, nearest first, used
+    to find where the previous pages of a keyset paginated listing start
+
+    @param db The database connection
+    @param last_id Get ids less than or equal to this
+    @param count The maximum number of ids to get
+    @param query_filter Optional filter to match against username
+    @return A list of ids in descending order
+    """
+    if query_filter:
+        indexed, params = _search_params(query_filter, last = last_id, count = count)
+        if indexed:
+            rows = _query(db, _SEARCH_IDS_THROUGH, params)
+        else:
+            rows = _query(db, "SELECT id FROM users WHERE username LIKE %(filter)s AND id <= %(last)s ORDER BY id DESC LIMIT %(count)s;", params)
+    else:
+        rows = _query(db, "SELECT id FROM users WHERE id <= %(last)s ORDER BY id DESC LIMIT %(count)s;",
+            { "last" : last_id, "count" : count })
+    return [row.id for row in rows]
+
+@write
 def add_user(db, username, password, user_type = User.Normal):
     """
     Adds a new user
@@ -226,6 +649,7 @@ def enabled_user(db, username):
     return False
 
 
+@write
 def enable_user(db, username):
     """
     Set the given user as an active user - regardless of previous state
@@ -235,41 +659,307 @@ def enable_user(db, username):
     """
     _exec(db, "UPDATE users SET state=%(state)s WHERE username=%(username)s;", { "state" : User.Enabled, "username" : username })
 
+@write
 def disable_user(db, username):
     """
     Set the given user as an disabled user - regardless of previous state
 
+    The user's sessions are revoked.
+
     @param db The database connection to use
     @param username The user to disable
     """
-    _exec(db, "UPDATE users SET state=%(state)s WHERE username=%(username)s;", { "state" : User.Disabled, "username" : username })
+    with transaction(db):
+        _exec(db, "UPDATE users SET state=%(state)s WHERE username=%(username)s;", { "state" : User.Disabled, "username" : username })
+        _revoke_user_sessions(db, username)
+
+def _delete_in_chunks(db, table, select_sql, params, chunk_size, progress):
+    """
+    Delete the rows of a table selected by select_sql, chunk_size rows per
+    transaction. The query must select ids greater than %(last_id)s in id order,
+    limited to %(count)s rows, so the table is walked once from start to end.
 
-def delete_user(db, username):
+    @return The number of deleted rows
+    """
+    params = dict(params, last_id = 0, count = chunk_size)
+    deleted = 0
+    while True:
+        ids = [row.id for row in _query(db, select_sql, params)]
+        if not ids:
+            break
+        with transaction(db):
+            _exec_many(db, "DELETE FROM " + table + " WHERE id=%(id)s;", [{ "id" : row_id } for row_id in ids])
+        deleted += len(ids)
+        params["last_id"] = ids[-1]
+        if progress:
+            progress(table, deleted)
+        _chunk_committed(db)
+    return deleted
+
+@write(alone = True)
+def delete_user(db, username, chunk_size = 1000, progress = None):
     """
     Delete a user from the system. All activities and quarters owned by this user will
     also be deleted.
 
+    The user row and sessions go first, then the sheets and activities are deleted in chunks
+    with a transaction per chunk, so a user with years of history never holds the
+    locks for long. Rows left behind by an interrupted delete are removed by
+    purge_orphans.
+
     @param db The database connection to use
     @param username The user to delete
+    @param chunk_size The number of rows to delete per transaction
+    @param progress Optional function called after each chunk with the table name
+        and the number of rows deleted from it so far
+    @return A dict with the number of deleted users, activities and sheets
+    """
+    deleted = { "users" : 0, "activities" : 0, "sheets" : 0 }
+    users = _query(db, "SELECT id FROM users WHERE username=%(username)s;", { "username" : username })
+    if not users:
+        return deleted
+
+    with transaction(db):
+        _revoke_user_sessions(db, username)
+        deleted["users"] = _query_rowcount(db, "DELETE FROM users WHERE username=%(username)s;", { "username" : username })
+    for user in users:
+        data = delete_user_data(db, user.id, chunk_size, progress)
+        deleted["sheets"] += data["sheets"]
+        deleted["activities"] += data["activities"]
+    return deleted
+
+@sharded
+@write(alone = True)
+@invalidates("activities", "sheets")
+def delete_user_data(db, user_id, chunk_size = 1000, progress = None):
+    """
+    Delete the sheets and activities of a user, in chunks with a transaction per
+    chunk
+
+    @param db The database connection to use
+    @param user_id The user whose data to delete
+    @param chunk_size The number of rows to delete per transaction
+    @param progress Optional function called after each chunk with the table name
+        and the number of rows deleted from it so far
+    @return A dict with the number of deleted activities and sheets
+    """
+    return {
+        "sheets" : _delete_in_chunks(db, "sheets",
+            "SELECT id FROM sheets WHERE user=%(user)s AND id > %(last_id)s ORDER BY id LIMIT %(count)s;",
+            { "user" : user_id }, chunk_size, progress),
+        "activities" : _delete_in_chunks(db, "activities",
+            "SELECT id FROM activities WHERE user=%(user)s AND id > %(last_id)s ORDER BY id LIMIT %(count)s;",
+            { "user" : user_id }, chunk_size, progress) }
+
+@write(alone = True)
+def purge_orphans(db, chunk_size = 1000, progress = None):
+    """
+    Delete sheets and activities whose user no longer exists, left behind by
+    users deleted before delete_user cascaded or by an interrupted delete.
+
+    @param db The database connection to use
+    @param chunk_size The number of rows to delete per transaction
+    @param progress Optional function called after each chunk with the table name
+        and the number of rows deleted from it so far
+    @return A dict with the number of deleted activities and sheets
+    """
+    return {
+        "sheets" : _delete_in_chunks(db, "sheets",
+            "SELECT sheets.id FROM sheets LEFT JOIN users ON users.id = sheets.user "
+            "WHERE users.id IS NULL AND sheets.id > %(last_id)s ORDER BY sheets.id LIMIT %(count)s;",
+            {}, chunk_size, progress),
+        "activities" : _delete_in_chunks(db, "activities",
+            "SELECT activities.id FROM activities LEFT JOIN users ON users.id = activities.user "
+            "WHERE users.id IS NULL AND activities.id > %(last_id)s ORDER BY activities.id LIMIT %(count)s;",
+            {}, chunk_size, progress) }
+
+def get_user_id(db, username):
+    """
+    Get the id of the given user
+
+    @param db The database connection to use
+    @param username The user to look up
+    @return The user's id or None if there is no such user
+    """
+    users = _query(db, "SELECT id FROM users WHERE username=%(username)s;", { "username" : username })
+    return users[0].id if users else None
+
+def get_user_shard(db, user_id):
+    """
+    Get the shard of a user from the directory in the main database
+
+    @param db The main database connection
+    @param user_id The user to look up
+    @return A row with the user's shard (None if not yet placed) and the shard
+        the user is being moved to (None if not moving), or None if there is
+        no such user
+    """
+    rows = _query(db, "SELECT users.shard AS shard, shard_moves.target AS moving FROM users "
+        "LEFT JOIN shard_moves ON shard_moves.user = users.id WHERE users.id=%(user)s;", { "user" : user_id })
+    return rows[0] if rows else None
+
+@write
+def place_user(db, user_id, shard):
+    """
+    Place a user that has not been placed yet on the given shard. A user that
+    already has activities or sheets in the main database, created before
+    sharding was configured, is placed on the main database (shard 0) instead.
+
+    @param db The main database connection
+    @param user_id The user to place
+    @param shard The shard to place the user on
+    @return The user's shard, see get_user_shard
+    """
+    _exec(db, "UPDATE users SET shard = CASE WHEN EXISTS (SELECT 1 FROM activities WHERE user=%(user)s) "
+        "OR EXISTS (SELECT 1 FROM sheets WHERE user=%(user)s) THEN 0 ELSE %(shard)s END "
+        "WHERE id=%(user)s AND shard IS NULL;", { "user" : user_id, "shard" : shard })
+    return get_user_shard(db, user_id)
+
+def get_user_shards(db, after_id, count):
+    """
+    Get the shards of the placed users, in id order
+
+    @param db The main database connection
+    @param after_id Get the users with an id greater than this
+    @param count The maximum number of users to get
+    @return A list of rows with id and shard
+    """
+    return _query(db, "SELECT id, shard FROM users WHERE id > %(after)s AND shard IS NOT NULL ORDER BY id LIMIT %(count)s;",
+        { "after" : after_id, "count" : count })
+
+@write
+def set_user_shard(db, user_id, shard):
+    """
+    Record the shard a user's activities and sheets are on
+
+    @param db The main database connection
+    @param user_id The user
+    @param shard The user's shard
+    """
+    _exec(db, "UPDATE users SET shard=%(shard)s WHERE id=%(user)s;", { "user" : user_id, "shard" : shard })
+
+@write
+def start_move(db, user_id, source, target):
     """
-    # TODO Make a transaction and also delete all activities and quarters!
-    _exec(db, "DELETE FROM users WHERE username=%(username)s;", { "username" : username })
+    Record that a user is being moved between shards, the user's activities
+    and sheets must not be written until end_move
 
-def signup_user(db, email, code, ip):
+    @param db The main database connection
+    @param user_id The user to move
+    @param source The shard the user is on
+    @param target The shard the user is moved to
     """
-    Add the given signup details
+    _exec(db, "INSERT INTO shard_moves (user, source, target) VALUES(%(user)s, %(source)s, %(target)s);",
+        { "user" : user_id, "source" : source, "target" : target })
+
+@write
+def end_move(db, user_id):
+    """
+    Record that a user is no longer being moved
+
+    @param db The main database connection
+    @param user_id The moved user
+    """
+    _exec(db, "DELETE FROM shard_moves WHERE user=%(user)s;", { "user" : user_id })
+
+def get_moves(db):
+    """
+    Get the moves in progress
+
+    @param db The main database connection
+    @return A list of rows with user, source and target
+    """
+    return _query(db, "SELECT user, source, target FROM shard_moves ORDER BY user;")
+
+def get_existing_user_ids(db, user_ids):
+    """
+    Get which of the given user ids exist
+
+    @param db The main database connection
+    @param user_ids A list of user ids
+    @return A set of the user ids that exist
+    """
+    if not user_ids:
+        return set()
+    params = dict(("id{0}".format(i), user_id) for i, user_id in enumerate(user_ids))
+    placeholders = ", ".join("%({0})s".format(name) for name in sorted(params))
+    return set(row.id for row in _query(db, "SELECT id FROM users WHERE id IN (" + placeholders + ");", params))
+
+def get_data_user_ids(db, after_id, count):
+    """
+    Get the ids of the users that have activities or sheets in the given
+    database, in id order
+
+    @param db The database connection to use
+    @param after_id Get the users with an id greater than this
+    @param count The maximum number of ids to get
+    @return A list of user ids
+    """
+    rows = _query(db, "SELECT user FROM (SELECT DISTINCT user FROM activities WHERE user > %(after)s ORDER BY user LIMIT %(count)s) AS a "
+        "UNION SELECT user FROM (SELECT DISTINCT user FROM sheets WHERE user > %(after)s ORDER BY user LIMIT %(count)s) AS s "
+        "ORDER BY user LIMIT %(count)s;", { "after" : after_id, "count" : count })
+    return [row.user for row in rows]
+
+def get_user_data(db, user_id):
+    """
+    Get all activities and sheets of a user, as stored
+
+    @param db The database connection to use
+    @param user_id The user
+    @return A tuple of the activities (rows with id, title and color) and the
+        sheets (a list of (date, stored quarters, version) tuples)
+    """
+    activities = _query(db, "SELECT id, title, color FROM activities WHERE user=%(user)s ORDER BY id;", { "user" : user_id })
+    sheets = _query(db, "SELECT date, quarters, version FROM sheets WHERE user=%(user)s ORDER BY date;", { "user" : user_id })
+    return activities, [(str(row.date), row.quarters, row.version) for row in sheets]
+
+@write
+@invalidates("activities", "sheets")
+def put_user_data(db, user_id, activities, sheets):
+    """
+    Insert the activities and sheets of a user copied from another database, in
+    one transaction. The activities get new ids in this database and the sheets
+    are rewritten to use them, as the sheets change their versions are bumped.
+
+    @param db The database connection to use
+    @param user_id The user
+    @param activities The activities, see get_user_data
+    @param sheets The sheets, see get_user_data
+    @return A dict with the number of inserted activities and sheets
+    """
+    with transaction(db):
+        ids = {}
+        for activity in activities:
+            ids[activity.id] = add_activity(db, user_id, activity.title, activity.color)
+        params = [{ "user" : user_id, "date" : date, "version" : version + 1, "quarters" : _binary(db, sheet_codec.encode(
+            [ids.get(quarter, quarter) for quarter in sheet_codec.decode(quarters)])) } for date, quarters, version in sheets]
+        if params:
+            _exec_many(db, "INSERT INTO sheets (user, date, quarters, version) VALUES(%(user)s, %(date)s, %(quarters)s, %(version)s);", params)
+    return { "activities" : len(activities), "sheets" : len(sheets) }
+
+@write
+def signup_user(db, email, code, ip, mail = None):
+    """
+    Add the given signup details. The activation mail is queued in the same
+    transaction so there is never a signup without its mail or the other way
+    around.
 
     @param db The database connection to use
     @param email The new users email
     @param code The activation code
     @param ip The IP address that requested the sign up
+    @param mail The activation mail to queue, or None to not send any
     @return True on success, else False 
     """
     # TODO Make transaction to see if username is unique
-    rowid = _exec(db, "INSERT INTO signups (username, activation_code, ip) VALUES(%(email)s, %(code)s, %(ip)s);",
-        { "email" : email, "code" : code, "ip" : ip })
+    with transaction(db):
+        rowid = _exec(db, "INSERT INTO signups (username, activation_code, ip) VALUES(%(email)s, %(code)s, %(ip)s);",
+            { "email" : email, "code" : code, "ip" : ip })
+        if mail:
+            queue_mail(db, email, mail)
     return rowid > -1
 
+@write
 def activate_user(db, code, password):
     """
     Creates a new user if the given email is found in the signup table and the code matches the assigned
@@ -282,33 +972,39 @@ def activate_user(db, code, password):
     @param password The users encrypted password
     @return True if the user was activated, else False
     """
-    try:
-        # TODO Make transaction
-        signups = _query(db, "SELECT username, activation_code FROM signups WHERE activation_code=%(code)s;", { "code" : code })
-
-        if signups[0].activation_code == code:
-            _exec(db, "DELETE FROM signups WHERE activation_code=%(code)s;", { 'code' : code })
-            _exec(db, "INSERT INTO users (username, password, type, state) VALUES(%(username)s, %(password)s, \"0\", \"1\");",
-                { "username": signups[0].username, "password" : password })
-            return True
-    except:
+    signups = _query(db, "SELECT username, activation_code FROM signups WHERE activation_code=%(code)s;", { "code" : code })
+    if not signups or signups[0].activation_code != code:
         return False
 
-def set_user_reset_code(db, username, reset_code):
+    # The user is created and the signup dropped together, a failure leaves the signup as it was
+    with transaction(db):
+        _exec(db, "INSERT INTO users (username, password, type, state) VALUES(%(username)s, %(password)s, \"0\", \"1\");",
+            { "username": signups[0].username, "password" : password })
+        _exec(db, "DELETE FROM signups WHERE activation_code=%(code)s;", { 'code' : code })
+    return True
+
+@write
+def set_user_reset_code(db, username, reset_code, mail = None):
     """
-    Set the reset code for a given user.
+    Set the reset code for a given user. The reset mail is queued in the same
+    transaction as the code is stored.
 
     @param db The database connection to use
     @param username The user to update
     @param reset_code The reset code to store
-    @return True on success, else False
+    @param mail The reset mail to queue, or None to not send any
+    @return True on success, False if there is no such user
     """
-    try:
-        _exec(db, "UPDATE users SET reset_code=%(code)s WHERE username=%(user)s", { "code" : reset_code, "user" : username} )
-        return True
-    except:
-        return False
+    with transaction(db):
+        updated = _query_rowcount(db, "UPDATE users SET reset_code=%(code)s WHERE username=%(user)s",
+            { "code" : reset_code, "user" : username })
+        if updated < 1:
+            return False
+        if mail:
+            queue_mail(db, username, mail)
+    return True
 
+@write
 def reset_password(db, reset_code, new_password):
     """
     Resets a user password for the user account with the given reset_code.
@@ -329,6 +1025,102 @@ def reset_password(db, reset_code, new_password):
     except:
         return False
 
+@write
+def create_session(db, session_id, user_id, expires):
+    """
+    Store a new session, and drop the user's expired sessions
+
+    @param db The database connection to use
+    @param session_id The session id as stored, see sessions.SessionStore
+    @param user_id The user the session belongs to
+    @param expires The session's expiry time in seconds since the epoch
+    """
+    _exec(db, "DELETE FROM sessions WHERE user=%(user)s AND expires < %(now)s;", { "user" : user_id, "now" : time.time() })
+    _exec(db, "INSERT INTO sessions (id, user, expires) VALUES(%(id)s, %(user)s, %(expires)s);",
+        { "id" : session_id, "user" : user_id, "expires" : expires })
+
+def get_session(db, session_id, now):
+    """
+    Get the user of a session
+
+    @param db The database connection to use
+    @param session_id The session id as stored
+    @param now The current time in seconds since the epoch
+    @return A row with the user's id, username and type and the session's
+        expiry, or None if there is no such session, it has expired or the
+        user is disabled
+    """
+    rows = _query(db, "SELECT users.id AS id, users.username AS username, users.type AS type, sessions.expires AS expires "
+        "FROM sessions JOIN users ON users.id = sessions.user "
+        "WHERE sessions.id=%(id)s AND sessions.expires > %(now)s AND users.state=%(enabled)s;",
+        { "id" : session_id, "now" : now, "enabled" : User.Enabled })
+    return rows[0] if rows else None
+
+@write
+def delete_session(db, session_id):
+    """
+    Delete a session, e.g. on logout. Other processes may still have it cached,
+    but its cookie is cleared.
+
+    @param db The database connection to use
+    @param session_id The session id as stored
+    """
+    _exec(db, "DELETE FROM sessions WHERE id=%(id)s;", { "id" : session_id })
+
+# Seconds a revocation stays in the log, a process that has not polled for this
+# long drops all of its cached sessions
+SESSION_REVOCATIONS_KEPT = 24 * 60 * 60
+
+def _revoke_user_sessions(db, username):
+    now = time.time()
+    _exec(db, "DELETE FROM sessions WHERE user IN (SELECT id FROM users WHERE username=%(username)s);", { "username" : username })
+    _exec(db, "INSERT INTO session_revocations (user, revoked) SELECT id, %(now)s FROM users WHERE username=%(username)s;",
+        { "username" : username, "now" : now })
+    _exec(db, "DELETE FROM session_revocations WHERE revoked < %(before)s;", { "before" : now - SESSION_REVOCATIONS_KEPT })
+
+def get_session_revocations(db, after):
+    """
+    Get the users whose sessions have been revoked
+
+    @param db The database connection
+    @param after The id of the last revocation already seen
+    @return A list of rows with the id and user of each newer revocation, in id order
+    """
+    return _query(db, "SELECT id, user FROM session_revocations WHERE id > %(after)s ORDER BY id;", { "after" : after })
+
+def get_last_session_revocation(db):
+    """
+    Get the id of the latest session revocation
+
+    @param db The database connection
+    @return The id, 0 if no sessions have been revoked
+    """
+    rows = _query(db, "SELECT MAX(id) AS id FROM session_revocations;")
+    return rows[0].id if rows and rows[0].id is not None else 0
+
+def get_login(db, username):
+    """
+    Get the user logging in, with the stored password hash to check
+
+    @param db The database connection to use
+    @param username The username
+    @return The user's id, username, type, state and password, or None
+    """
+    rows = _query(db, "SELECT id, username, type, state, password FROM users WHERE username=%(username)s;",
+        { "username" : username })
+    return rows[0] if rows else None
+
+@write
+def set_password(db, user_id, password):
+    """
+    Store a new password hash for the given user, e.g. an upgraded hash
+
+    @param db The database connection to use
+    @param user_id The user's id
+    @param password The password hash
+    """
+    _exec(db, "UPDATE users SET password=%(password)s WHERE id=%(id)s;", { "password" : password, "id" : user_id })
+
 def authenticate_user(db, username, password):
     """
     Authenticates the given user
@@ -348,6 +1140,9 @@ def authenticate_user(db, username, password):
     except:
         return None
 
+@sharded
+@replica
+@cached("activities")
 def get_activities(db, user_id):
     """
     Get all activities for the given user
@@ -360,6 +1155,9 @@ def get_activities(db, user_id):
         activities = []
     return activities    
 
+@sharded
+@write
+@invalidates("activities")
 def add_activity(db, user_id, title, color):
     """
     Adds a new activity
@@ -372,6 +1170,9 @@ def add_activity(db, user_id, title, color):
     return _exec(db, "INSERT INTO activities (user, title, color) VALUES(%(id)s, %(title)s, %(color)s);",
         { "id" : user_id, "title" : title, "color" : color })
 
+@sharded
+@replica
+@cached("activities")
 def get_activity(db, user_id, activity_id):
     """
     Get the given activity_id
@@ -386,6 +1187,9 @@ def get_activity(db, user_id, activity_id):
     else:
         return None
 
+@sharded
+@write
+@invalidates("activities")
 def update_activity(db, user_id, activity_id, title, color):
     """Update an existing activity with new values
 
@@ -398,6 +1202,9 @@ def update_activity(db, user_id, activity_id, title, color):
     return _exec(db, "UPDATE activities SET title=%(title)s, color=%(color)s WHERE user=%(user)s AND id=%(activity_id)s;",
         { "title" : title, "color" : color, "user" : user_id, "activity_id" : activity_id})
 
+@sharded
+@write
+@invalidates("activities")
 def delete_activity(db, user_id, activity_id):
     """Deletes a given activity
 
@@ -407,23 +1214,150 @@ def delete_activity(db, user_id, activity_id):
     """
     return _exec(db, "DELETE FROM activities WHERE user=%(user)s AND id=%(activity)s;", {'user': user_id, 'activity': activity_id})
 
-def update_sheet(db, user_id, date, quarters):
+def _binary(db, data):
+    """Wrap packed bytes so the driver stores them as a BLOB"""
+    if dialect(db) is SQLITE:
+        return sqlite3.Binary(data)
+    return data
+
+_UPSERT_SHEET = Statement(
+    "INSERT INTO sheets (user, date, quarters, version) VALUES(%(user)s, %(date)s, %(quarters)s, 1) "
+        "ON DUPLICATE KEY UPDATE quarters=VALUES(quarters), version=version + 1;",
+    sqlite = "INSERT INTO sheets (user, date, quarters, version) VALUES(%(user)s, %(date)s, %(quarters)s, 1) "
+        "ON CONFLICT(user, date) DO UPDATE SET quarters=excluded.quarters, version=sheets.version + 1;")
+
+# The upsert handing back the version it wrote. On MySQL an insert affects one
+# row and an update two, with the new version as LAST_INSERT_ID. SQLite needs
+# 3.35 for RETURNING.
+_UPSERT_SHEET_VERSION = Statement(
+    "INSERT INTO sheets (user, date, quarters, version) VALUES(%(user)s, %(date)s, %(quarters)s, 1) "
+        "ON DUPLICATE KEY UPDATE quarters=VALUES(quarters), version=LAST_INSERT_ID(version + 1);",
+    sqlite = "INSERT INTO sheets (user, date, quarters, version) VALUES(%(user)s, %(date)s, %(quarters)s, 1) "
+        "ON CONFLICT(user, date) DO UPDATE SET quarters=excluded.quarters, version=sheets.version + 1 RETURNING version;")
+
+@sharded
+@write
+@invalidates("sheets")
+def update_sheet(db, user_id, date, quarters, version = None):
     """
     Inserts the given time sheet for the given date. If a record exist for this
     date it will be replaced, if nothing exists a new record will be created.
 
+    This is a single upsert statement relying on the unique (user, date) index,
+    so concurrent updates of the same day can never create duplicate rows. The
+    statement also hands back the version it wrote.
+
     @param db The database connection to use
     @param user_id The id of the authenticated user the activity is associated with
     @param date The time sheets date, must be in the format YYYY-MM-DD
-    @param quarters the time sheets list of quarters
+    @param quarters the time sheets sequence of 96 activity ids
+    @param version The version the sheet was edited from, StaleSheet is raised
+        if the stored sheet has another version (see patch_sheet)
+    @return The sheet's new version
     """
-    result = _query_rowcount(db, "UPDATE sheets SET quarters=%(quarters)s WHERE user=%(user)s and date=%(date)s",
-        { "quarters" : quarters, "user" : user_id, "date" : date })
-    if result == 0:
-        result = _exec(db, "INSERT INTO sheets (user, date, quarters) VALUES(%(user)s, %(date)s, %(quarters)s);",
-            { "quarters" : quarters, "user" : user_id, "date" : date })
-    return result
+    if version is not None:
+        if len(quarters) != sheet_codec.QUARTERS_PER_DAY:
+            raise ValueError("Expected {0} quarters, got {1}".format(sheet_codec.QUARTERS_PER_DAY, len(quarters)))
+        runs = sheet_codec.decode_runs(sheet_codec.encode_runs([int(quarter) for quarter in quarters]))
+        return patch_sheet(db, user_id, date, runs, version)[0]
+    params = { "quarters" : _binary(db, sheet_codec.encode(quarters)), "user" : user_id, "date" : date }
+    if dialect(db) is SQLITE:
+        return _query(db, _UPSERT_SHEET_VERSION, params)[0].version
+    cursor = db.cursor()
+    cursor.execute(MYSQL.sql(_UPSERT_SHEET_VERSION), params)
+    return cursor.lastrowid if cursor.rowcount == 2 else 1
+
+# Only a sheet written in between is ignored, unlike INSERT IGNORE other errors still surface
+_INSERT_SHEET_IF_MISSING = Statement(
+    "INSERT INTO sheets (user, date, quarters, version) VALUES(%(user)s, %(date)s, %(quarters)s, 1) "
+        "ON DUPLICATE KEY UPDATE id=id;",
+    sqlite = "INSERT INTO sheets (user, date, quarters, version) VALUES(%(user)s, %(date)s, %(quarters)s, 1) "
+        "ON CONFLICT(user, date) DO NOTHING;")
+
+# The number of times patch_sheet applies the runs before giving up on a sheet that keeps changing
+PATCH_SHEET_ATTEMPTS = 5
+
+class StaleSheet(Exception):
+    """
+    Raised when a sheet is written based on an older version than the stored
+    one, with the stored version and quarters so the writer can merge its
+    changes and try again
+    """
+    def __init__(self, version, quarters):
+        Exception.__init__(self, "Sheet has changed, version is {0}".format(version))
+        self.version = version
+        self.quarters = quarters
+
+@sharded
+@write
+@invalidates("sheets")
+def patch_sheet(db, user_id, date, runs, version = None):
+    """
+    Change some of the quarters of a time sheet, a day without a sheet starts
+    with no work in any quarter. The sheet is only written if it has not been
+    changed since it was read, otherwise the runs are applied again.
 
+    @param db The database connection to use
+    @param user_id The id of the authenticated user the sheet belongs to
+    @param date The time sheets date, must be in the format YYYY-MM-DD
+    @param runs The quarters to set, a list of (start, end, activity id) tuples
+    @param version The version the runs were made against (0 for a day without
+        a sheet), StaleSheet is raised if the sheet has another version. If None
+        the runs are applied to whatever version is stored.
+    @return A (version, changes) tuple of the sheet's new version and the change
+        of each activity's number of quarters, see sheet_codec.apply_runs
+    @raise StaleSheet Also if the sheet changed under every one of the
+        PATCH_SHEET_ATTEMPTS writes
+    """
+    params = { "user" : user_id, "date" : date }
+    def read():
+        rows = _query(db, "SELECT quarters, version FROM sheets WHERE user=%(user)s AND date=%(date)s;", params)
+        if rows:
+            return rows[0].version, sheet_codec.decode(rows[0].quarters)
+        return 0, array("i", [-1] * sheet_codec.QUARTERS_PER_DAY)
+
+    for attempt in range(PATCH_SHEET_ATTEMPTS):
+        stored_version, quarters = read()
+        if version is not None and version != stored_version:
+            raise StaleSheet(stored_version, quarters)
+        changes = sheet_codec.apply_runs(quarters, runs)
+        if stored_version and not changes:
+            return (stored_version, changes)
+        packed = _binary(db, sheet_codec.encode(quarters))
+        if stored_version:
+            written = _query_rowcount(db, "UPDATE sheets SET quarters=%(quarters)s, version=%(version)s "
+                "WHERE user=%(user)s AND date=%(date)s AND version=%(previous)s;",
+                dict(params, quarters = packed, version = stored_version + 1, previous = stored_version))
+        else:
+            written = _query_rowcount(db, _INSERT_SHEET_IF_MISSING, dict(params, quarters = packed))
+        if written:
+            return (stored_version + 1, changes)
+    raise StaleSheet(*read())
+
+@sharded
+@write
+@invalidates("sheets")
+def update_sheets(db, user_id, sheets):
+    """
+    Inserts or replaces the time sheets for many dates in one transaction, either
+    all of the sheets are written or none of them.
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user the sheets belong to
+    @param sheets A sequence of (date, quarters) tuples, dates in the format YYYY-MM-DD
+    @return The number of written sheets
+    """
+    params = [{ "quarters" : _binary(db, sheet_codec.encode(quarters)), "user" : user_id, "date" : date }
+        for date, quarters in sheets]
+    if not params:
+        return 0
+    with transaction(db):
+        _exec_many(db, _UPSERT_SHEET, params)
+    return len(params)
+
+@sharded
+@replica
+@cached("sheets")
 def get_sheet(db, user_id, date):
     """
     Get a timesheet for the given user and date
@@ -431,10 +1365,208 @@ def get_sheet(db, user_id, date):
     @param db The database connection to use
     @param user_id The id of the authenticated user the activity is associated with
     @param date The time sheets date, must be in the format YYYY-MM-DD
-    @return The sheet containing the quarters or None if no sheet found
+    @return The sheet's quarters as an array of activity ids or None if no sheet found
     """
     sheets = _query(db, "SELECT quarters FROM sheets WHERE user=%(user)s and date=%(date)s", { "user" : user_id, "date" : date })
     if sheets and len(sheets) == 1:
-        return sheets[0]["quarters"]
+        return sheet_codec.decode(sheets[0]["quarters"])
     else:
         return None
+
+@sharded
+@replica
+@cached("sheets")
+def get_sheet_version(db, user_id, date):
+    """
+    Get a timesheet together with its version, which changes on every write of
+    the sheet
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user the sheet belongs to
+    @param date The time sheets date, must be in the format YYYY-MM-DD
+    @return A (version, quarters) tuple, (0, None) if no sheet found
+    """
+    sheets = _query(db, "SELECT quarters, version FROM sheets WHERE user=%(user)s and date=%(date)s", { "user" : user_id, "date" : date })
+    if sheets:
+        return (sheets[0].version, sheet_codec.decode(sheets[0].quarters))
+    return (0, None)
+
+_SHEETS_IN_RANGE = "SELECT date, quarters FROM sheets WHERE user=%(user)s AND date BETWEEN %(start)s AND %(end)s ORDER BY date;"
+
+@sharded
+@replica
+def get_sheets(db, user_id, start, end):
+    """
+    Get all timesheets for the given user within a date range, in one range scan
+    over the (user, date) index. Ranges are not cached, there are too many of
+    them to keep.
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user the sheets belong to
+    @param start The first date of the range (inclusive), YYYY-MM-DD
+    @param end The last date of the range (inclusive), YYYY-MM-DD
+    @return A list of (date, quarters) tuples ordered by date, days without a sheet are left out
+    """
+    rows = _iter_query(db, _SHEETS_IN_RANGE, { "user" : user_id, "start" : start, "end" : end })
+    return [(str(row.date), sheet_codec.decode(row.quarters)) for row in rows]
+
+@sharded
+@replica
+def stream_sheets(db, user_id, start, end, each, chunk_size = 31):
+    """
+    Read the timesheets of a date range like get_sheets, but hand them on in
+    chunks as they are fetched from the cursor instead of collecting them
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user the sheets belong to
+    @param start The first date of the range (inclusive), YYYY-MM-DD
+    @param end The last date of the range (inclusive), YYYY-MM-DD
+    @param each Function called with each list of up to chunk_size (date,
+        quarters) tuples, on the thread running the query
+    @param chunk_size The number of sheets to fetch and hand on at a time
+    @return The number of sheets read
+    """
+    count = 0
+    chunk = []
+    for row in _iter_query(db, _SHEETS_IN_RANGE, { "user" : user_id, "start" : start, "end" : end }, chunk_size):
+        chunk.append((str(row.date), sheet_codec.decode(row.quarters)))
+        if len(chunk) == chunk_size:
+            each(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        each(chunk)
+        count += len(chunk)
+    return count
+
+@fanout(sum)
+@replica
+def get_sheet_count(db):
+    """
+    Get the number of reported days
+
+    @param db The database connection to use
+    @return The number of sheets
+    """
+    count = _query(db, "SELECT COUNT(*) FROM sheets;")
+    return getattr(count[0], "COUNT(*)")
+
+@write
+def beat(db, now):
+    """
+    Write the replication heartbeat, replicas are as far behind as their
+    heartbeat is old
+
+    @param db The primary database connection
+    @param now The current time in seconds since the epoch
+    """
+    _exec(db, "UPDATE replication_heartbeat SET beat=%(now)s WHERE id=1;", { "now" : now })
+
+def get_heartbeat(db):
+    """
+    Get the replication heartbeat
+
+    @param db The database connection, a primary or a replica
+    @return The time of the last heartbeat in seconds since the epoch
+    """
+    rows = _query(db, "SELECT beat FROM replication_heartbeat WHERE id=1;")
+    return rows[0].beat if rows else 0
+
+@write(alone = True)
+def pack_sheets(db, batch_size = 500):
+    """
+    Convert sheets stored as comma separated text into the packed binary format.
+
+    Rows are converted in batches ordered by id and each batch is committed on its
+    own, so the application can keep running while the conversion is in progress.
+    A row that is rewritten by the application during the conversion is left as is.
+    On MySQL the quarters column must already be a BLOB, see migration 3.
+
+    @param db The database connection to use
+    @param batch_size The number of rows to read and convert per batch
+    @return The number of converted rows
+    """
+    converted = 0
+    last_id = 0
+    while True:
+        rows = _query(db, "SELECT id, quarters FROM sheets WHERE id > %(last_id)s ORDER BY id LIMIT %(count)s;",
+            { "last_id" : last_id, "count" : batch_size })
+        if not rows:
+            break
+        for row in rows:
+            if sheet_codec.is_packed(row.quarters):
+                continue
+            try:
+                packed = _binary(db, sheet_codec.encode(row.quarters.split(",")))
+            except ValueError:
+                logging.warning("Could not convert sheet %s, leaving it as text", row.id)
+                continue
+            converted += _query_rowcount(db, "UPDATE sheets SET quarters=%(packed)s WHERE id=%(id)s AND quarters=%(quarters)s;",
+                { "packed" : packed, "id" : row.id, "quarters" : row.quarters })
+        db.commit()
+        last_id = rows[-1].id
+        _chunk_committed(db)
+    return converted
+
+@write
+def queue_mail(db, recipient, message):
+    """
+    Put a mail in the outbox, it is sent by mailer.Mailer
+
+    @param db The database connection to use
+    @param recipient The recipient's address
+    @param message The complete message, headers included
+    @return The id of the queued mail
+    """
+    return _exec(db, "INSERT INTO outbox (recipient, message, attempts, next_attempt) VALUES(%(recipient)s, %(message)s, 0, %(now)s);",
+        { "recipient" : recipient, "message" : message, "now" : time.time() })
+
+@write
+def claim_mail(db, now, count, lease):
+    """
+    Claim the mail due to be sent. A claimed mail is not due again until the
+    lease has passed, so several senders never send the same mail.
+
+    @param db The database connection to use
+    @param now The current time in seconds since the epoch
+    @param count The maximum number of mails to claim
+    @param lease The time the claimed mail is due again, unless sent or deferred
+    @return The claimed mail, rows with id, recipient, message and attempts
+    """
+    rows = _query(db, "SELECT id, recipient, message, attempts, next_attempt FROM outbox WHERE next_attempt <= %(now)s ORDER BY next_attempt, id LIMIT %(count)s;",
+        { "now" : now, "count" : count })
+    return [row for row in rows if _query_rowcount(db, "UPDATE outbox SET next_attempt=%(lease)s WHERE id=%(id)s AND next_attempt=%(next_attempt)s;",
+        { "lease" : lease, "id" : row.id, "next_attempt" : row.next_attempt })]
+
+@write
+def delete_mail(db, mail_ids):
+    """
+    Remove sent (or undeliverable) mail from the outbox
+
+    @param db The database connection to use
+    @param mail_ids The ids of the mail to remove
+    """
+    _exec_many(db, "DELETE FROM outbox WHERE id=%(id)s;", [{ "id" : mail_id } for mail_id in mail_ids])
+
+@write
+def defer_mail(db, mail_id, attempts, next_attempt):
+    """
+    Retry a mail that could not be sent later
+
+    @param db The database connection to use
+    @param mail_id The mail's id
+    @param attempts The number of failed attempts so far
+    @param next_attempt The time of the next attempt in seconds since the epoch
+    """
+    _exec(db, "UPDATE outbox SET attempts=%(attempts)s, next_attempt=%(next_attempt)s WHERE id=%(id)s;",
+        { "attempts" : attempts, "next_attempt" : next_attempt, "id" : mail_id })
+
+def get_outbox_size(db):
+    """
+    Get the number of mails waiting to be sent
+
+    @param db The database connection
+    @return The number of mails in the outbox
+    """
+    count = _query(db, "SELECT COUNT(*) FROM outbox;")
+    return getattr(count[0], "COUNT(*)") if count else 0
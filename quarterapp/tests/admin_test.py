@@ -0,0 +1,181 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+import os
+import json
+import re
+import sqlite3
+import tempfile
+import time
+
+from tornado.options import options
+from tornado.testing import AsyncHTTPTestCase
+
+import quarterapp.admin
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.quarter_errors import ERROR_UPDATE_SETTING, ERROR_NO_DELETE_RUNNING
+from quarterapp.quarterapp import define_options, create_application
+from quarterapp.cache import StorageCache
+from quarterapp.pool import ConnectionPool
+from quarterapp.sessions import new_token, session_id
+from quarterapp.tests.storage_test import setup_sqlite
+
+def page_link_re(count):
+    return re.compile(r'href="/admin/users\?after=(\d+)&amp;page=(\d+)&amp;count={0}"'.format(count))
+
+class TestAdminUsers(AsyncHTTPTestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(self.filename)
+        quarterapp.migrations.migrate(db)
+        self.admin_id = quarterapp.storage._query(db, "SELECT id FROM users WHERE username='admin';")[0].id
+        for i in range(29):
+            quarterapp.storage._exec(db, "INSERT INTO users (username, password, type, state) VALUES(%(username)s, '', 0, 1);",
+                { "username" : "user{0}@example.com".format(i) })
+        self.token = new_token()
+        quarterapp.storage.create_session(db, session_id(self.token), self.admin_id, time.time() + 3600)
+        db.commit()
+        db.close()
+        super(TestAdminUsers, self).setUp()
+
+    def tearDown(self):
+        # Stop the storage workers first, they wake the IOLoop with their results
+        self._app.storage.close()
+        self._app.pool.close()
+        super(TestAdminUsers, self).tearDown()
+        os.remove(self.filename)
+
+    def get_app(self):
+        define_options()
+        options.cookie_secret = "test"
+        self.pool = ConnectionPool(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False), size = 2)
+        return create_application(self.pool, io_loop = self.io_loop, cache = StorageCache(100000))
+
+    def get_users_page(self, query, count = 5):
+        response = self.fetch("/admin/users?" + query, headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(200, response.code)
+        return response.body, [(int(page), int(after)) for after, page in page_link_re(count).findall(response.body)]
+
+    def test_first_page(self):
+        body, links = self.get_users_page("count=5")
+        self.assertIn("admin", body)
+        self.assertNotIn("user4@example.com", body)
+        self.assertEqual([(0, 0), (1, 5), (2, 10), (3, 15), (4, 20), (5, 25)], links)
+
+    def test_deep_page(self):
+        body, links = self.get_users_page("after=20&page=4&count=5")
+        self.assertIn("user19@example.com", body)
+        self.assertNotIn("user18@example.com", body)
+        self.assertEqual([(0, 0), (1, 5), (2, 10), (3, 15), (4, 20), (5, 25)], links)
+
+    def test_window(self):
+        # With one user per page the page after id n is page n (the admin is id 1)
+        body, links = self.get_users_page("after=25&page=25&count=1", count = 1)
+        self.assertEqual([(page, page) for page in range(20, 30)], links)
+
+    def test_page_that_does_not_match_after(self):
+        # The first page is in the window, so the page is known whatever the client says
+        body, links = self.get_users_page("after=10&page=40&count=5")
+        self.assertEqual([(0, 0), (1, 5), (2, 10), (3, 15), (4, 20), (5, 25)], links)
+        body, links = self.get_users_page("after=2&page=0&count=1", count = 1)
+        self.assertEqual([(page, page) for page in range(0, 10)], links)
+
+        # Further away the page is only kept from numbering the pages before it below one
+        body, links = self.get_users_page("after=25&page=2&count=1", count = 1)
+        self.assertEqual([(page, page + 19) for page in range(1, 11)], links)
+
+    def test_count_is_bounded(self):
+        limit = quarterapp.admin.MAX_PAGINATION_ITEMS_PER_PAGE
+        quarterapp.admin.MAX_PAGINATION_ITEMS_PER_PAGE = 5
+        try:
+            body, links = self.get_users_page("count=1000000")
+        finally:
+            quarterapp.admin.MAX_PAGINATION_ITEMS_PER_PAGE = limit
+        self.assertNotIn("user4@example.com", body)
+        self.assertEqual([(0, 0), (1, 5), (2, 10), (3, 15), (4, 20), (5, 25)], links)
+
+    def test_synchronous_page_after_session_lookup(self):
+        # The session is not cached yet, so the handler runs once it has been looked up
+        response = self.fetch("/admin/new-user", headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(200, response.code)
+        self.assertEqual(404, self.fetch("/admin/new-user", headers = { "Cookie" : "session=" + new_token() }).code)
+
+    def test_delete_drops_cached_data(self):
+        cache = self._app.storage.cache
+        with self.pool.connection() as db:
+            user_id = quarterapp.storage.get_user_id(db, "user0@example.com")
+        activities = cache.key(quarterapp.storage.get_activities, user_id, (user_id,), {})
+        cache.put(activities, [], cache.started())
+
+        response = self.fetch("/admin/delete/user0@example.com", method = "POST", body = "",
+            headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(200, response.code)
+        self.assertFalse(cache.get(activities)[0])
+
+    def test_delete_reports_chunks(self):
+        with self.pool.connection() as db:
+            user_id = quarterapp.storage.get_user_id(db, "user0@example.com")
+            first = datetime.date(2010, 1, 1)
+            quarterapp.storage._exec_many(db, "INSERT INTO sheets (user, date, quarters) VALUES(%(user)s, %(date)s, '');",
+                [{ "user" : user_id, "date" : str(first + datetime.timedelta(days = i)) } for i in range(1001)])
+
+        response = self.fetch("/admin/delete/user0@example.com", method = "POST", body = "",
+            headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(200, response.code)
+        result = json.loads(response.body)
+        self.assertEqual(2, result["chunks"])
+        self.assertEqual({ "users" : 1, "activities" : 0, "sheets" : 1001 }, result["deleted"])
+        self.assertEqual({}, self._app.deletions)
+
+    def test_delete_status(self):
+        response = self.fetch("/admin/delete/user0@example.com", headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(500, response.code)
+        self.assertEqual(ERROR_NO_DELETE_RUNNING.code, json.loads(response.body)["error"])
+
+        self._app.deletions["user0@example.com"] = { "chunks" : 3, "activities" : 0, "sheets" : 2500 }
+        response = self.fetch("/admin/delete/user0@example.com", headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(200, response.code)
+        result = json.loads(response.body)
+        self.assertEqual((3, 2500), (result["chunks"], result["sheets"]))
+
+    def test_statistics(self):
+        response = self.fetch("/admin/statistics", headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(200, response.code)
+        self.assertIn("Days reported", response.body)
+
+    def test_update_setting(self):
+        response = self.fetch("/admin/settings/allow-signups", method = "POST", body = "value=0",
+            headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(200, response.code)
+        self.assertEqual({ "key" : "allow-signups", "value" : "0" }, json.loads(response.body))
+        self.assertEqual("0", self._app.quarter_settings.get_value("allow-signups"))
+        with self.pool.connection() as db:
+            self.assertEqual("0", quarterapp.storage.get_setting(db, "allow-signups"))
+
+        response = self.fetch("/admin/settings/no-such-setting", method = "POST", body = "value=0",
+            headers = { "Cookie" : "session=" + self.token })
+        self.assertEqual(500, response.code)
+        self.assertEqual(ERROR_UPDATE_SETTING.code, json.loads(response.body)["error"])
@@ -0,0 +1,244 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import urllib
+
+from tornado.options import options
+from tornado.testing import AsyncHTTPTestCase
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.quarterapp import define_options, create_application
+from quarterapp.pool import ConnectionPool
+from quarterapp.quarter_utils import hash_password
+from quarterapp.sessions import new_token, session_id
+from quarterapp.tests.storage_test import setup_sqlite
+
+class TestApi(AsyncHTTPTestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(self.filename)
+        quarterapp.migrations.migrate(db)
+        self.user_id = quarterapp.storage._exec(db, "INSERT INTO users (username, password, type, state) VALUES('bob', '', 0, 1);")
+        self.token = new_token()
+        quarterapp.storage.create_session(db, session_id(self.token), self.user_id, time.time() + 3600)
+        db.commit()
+        db.close()
+        super(TestApi, self).setUp()
+
+    def tearDown(self):
+        # Stop the storage workers first, they wake the IOLoop with their results
+        self._app.storage.close()
+        self._app.pool.close()
+        super(TestApi, self).tearDown()
+        os.remove(self.filename)
+
+    def get_app(self):
+        define_options()
+        options.cookie_secret = "test"
+        options.salt = "test"
+        self.pool = ConnectionPool(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False), size = 2)
+        return create_application(self.pool, io_loop = self.io_loop)
+
+    def request(self, path, method = "GET", body = None, headers = None):
+        """Issue an authenticated request as the test user"""
+        all_headers = { "Cookie" : "session=" + self.token }
+        if body is not None:
+            all_headers["Content-Type"] = "application/x-www-form-urlencoded"
+            body = urllib.urlencode(body)
+        all_headers.update(headers or {})
+        return self.fetch(path, method = method, body = body, headers = all_headers)
+
+    ## Sheets
+
+    def test_put_sheet(self):
+        response = self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["-1"] * 94 + ["5", "5"]) })
+        self.assertEqual(200, response.code)
+        self.assertEqual({ "-1" : 94, "5" : 2 }, json.loads(response.body)["summary"])
+
+    def test_get_sheet(self):
+        response = self.request("/api/sheet/2013-02-05")
+        self.assertEqual(200, response.code)
+        self.assertEqual("0-95:-1", json.loads(response.body)["runs"])
+        empty = response.headers["Etag"]
+
+        response = self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["3"] * 96) })
+        written = response.headers["Etag"]
+        self.assertNotEqual(empty, written)
+
+        response = self.request("/api/sheet/2013-02-05")
+        self.assertEqual(written, response.headers["Etag"])
+        self.assertEqual({ "3" : 96 }, json.loads(response.body)["summary"])
+
+    def test_get_sheet_not_modified(self):
+        self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["3"] * 96) })
+        etag = self.request("/api/sheet/2013-02-05").headers["Etag"]
+
+        response = self.request("/api/sheet/2013-02-05", headers = { "If-None-Match" : etag })
+        self.assertEqual(304, response.code)
+        self.assertEqual("", response.body)
+
+        self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["4"] * 96) })
+        response = self.request("/api/sheet/2013-02-05", headers = { "If-None-Match" : etag })
+        self.assertEqual(200, response.code)
+        self.assertEqual("0-95:4", json.loads(response.body)["runs"])
+
+    def test_if_none_match_lists(self):
+        self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["3"] * 96) })
+        self.request("/api/sheet/2013-02-06", "PUT", { "quarters" : ",".join(["3"] * 96) })
+        etag = self.request("/api/sheet/2013-02-05").headers["Etag"]
+        other = self.request("/api/sheet/2013-02-06").headers["Etag"]
+        self.assertNotEqual(etag, other)
+
+        for header, code in ((other, 200), (etag[:-1] + '1"', 200), ('"x", ' + etag, 304), ("W/" + etag, 304), ("*", 304)):
+            response = self.request("/api/sheet/2013-02-05", headers = { "If-None-Match" : header })
+            self.assertEqual(code, response.code, header)
+
+    def test_patch_sheet(self):
+        response = self.request("/api/sheet/2013-02-05", "PATCH", { "runs" : "32-40:7,50:3" })
+        self.assertEqual(200, response.code)
+        self.assertEqual({ "-1" : -10, "7" : 9, "3" : 1 }, json.loads(response.body)["changes"])
+        etag = response.headers["Etag"]
+
+        response = self.request("/api/sheet/2013-02-05", "PATCH", { "runs" : "36-44:3" })
+        self.assertEqual({ "-1" : -4, "7" : -5, "3" : 9 }, json.loads(response.body)["changes"])
+        self.assertNotEqual(etag, response.headers["Etag"])
+
+        response = self.request("/api/sheet/2013-02-05", headers = { "If-None-Match" : response.headers["Etag"] })
+        self.assertEqual(304, response.code)
+        response = self.request("/api/sheet/2013-02-05")
+        self.assertEqual("0-31:-1,32-35:7,36-44:3,45-49:-1,50:3,51-95:-1", json.loads(response.body)["runs"])
+
+    def test_patch_sheet_invalid_runs(self):
+        for runs in ("", "90-96:3", "40-32:3", "7:x", "1-2-3:4", "7:4294967296"):
+            response = self.request("/api/sheet/2013-02-05", "PATCH", { "runs" : runs })
+            self.assertEqual(500, response.code)
+            self.assertEqual(606, json.loads(response.body)["error"])
+
+    def test_patch_sheet_stale_version(self):
+        response = self.request("/api/sheet/2013-02-05", "PATCH", { "runs" : "32-40:7", "version" : "0" })
+        self.assertEqual(1, json.loads(response.body)["version"])
+
+        response = self.request("/api/sheet/2013-02-05", "PATCH", { "runs" : "36-44:3", "version" : "0" })
+        self.assertEqual(409, response.code)
+        body = json.loads(response.body)
+        self.assertEqual((608, 1, "0-31:-1,32-40:7,41-95:-1"), (body["error"], body["version"], body["runs"]))
+        self.assertEqual(self.request("/api/sheet/2013-02-05").headers["Etag"], response.headers["Etag"])
+
+        response = self.request("/api/sheet/2013-02-05", "PATCH", { "runs" : "36-44:3", "version" : "1" })
+        self.assertEqual(200, response.code)
+        self.assertEqual(2, json.loads(response.body)["version"])
+
+    def test_put_sheet_stale_version(self):
+        response = self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["3"] * 96), "version" : "1" })
+        self.assertEqual(409, response.code)
+        self.assertEqual("0-95:-1", json.loads(response.body)["runs"])
+
+        response = self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["3"] * 96), "version" : "x" })
+        self.assertEqual(607, json.loads(response.body)["error"])
+
+    def test_get_sheet_invalid_date(self):
+        response = self.request("/api/sheet/2013-02-30")
+        self.assertEqual(500, response.code)
+
+    def test_put_sheet_id_out_of_range(self):
+        response = self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["-1"] * 95 + [str(2 ** 40)]) })
+        self.assertEqual(500, response.code)
+        self.assertEqual(603, json.loads(response.body)["error"])
+
+    def test_put_sheet_wrong_length(self):
+        response = self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : "-1,-1" })
+        self.assertEqual(500, response.code)
+        self.assertEqual(601, json.loads(response.body)["error"])
+
+    def test_get_sheet_range(self):
+        self.request("/api/sheet/2013-02-05", "PUT", { "quarters" : ",".join(["3"] * 96) })
+        self.request("/api/sheet/2013-02-07", "PUT", { "quarters" : ",".join(["-1"] * 96) })
+
+        response = self.request("/api/sheets?from=2013-02-01&to=2013-02-06")
+        self.assertEqual(200, response.code)
+        sheets = json.loads(response.body)["sheets"]
+        self.assertEqual(["2013-02-05"], [sheet["date"] for sheet in sheets])
+        self.assertEqual([3] * 96, sheets[0]["quarters"])
+        self.assertEqual({ "3" : 96 }, sheets[0]["summary"])
+
+    def test_get_sheet_range_in_chunks(self):
+        sheets = dict(("2013-{0:02d}-{1:02d}".format(month, day), [month] * 96) for month in (1, 2) for day in range(1, 29))
+        self.request("/api/sheets", "PUT", { "sheets" : json.dumps(sheets) })
+
+        response = self.request("/api/sheets?from=2013-01-01&to=2013-02-28")
+        self.assertEqual(200, response.code)
+        sheets = json.loads(response.body)["sheets"]
+        self.assertEqual(56, len(sheets))
+        self.assertEqual({ "2" : 96 }, sheets[-1]["summary"])
+
+    def test_get_sheet_range_invalid(self):
+        for query in ("from=2013-02-06&to=2013-02-01", "from=2013-02-01", "from=2012-01-01&to=2013-01-01"):
+            response = self.request("/api/sheets?" + query)
+            self.assertEqual(500, response.code)
+            self.assertEqual(604, json.loads(response.body)["error"])
+
+    def test_put_sheets(self):
+        sheets = { "2013-02-05" : ",".join(["3"] * 96), "2013-02-06" : [-1] * 48 + [4] * 48 }
+        response = self.request("/api/sheets", "PUT", { "sheets" : json.dumps(sheets) })
+        self.assertEqual(200, response.code)
+        self.assertEqual({ "2013-02-05" : { "3" : 96 }, "2013-02-06" : { "-1" : 48, "4" : 48 } },
+            json.loads(response.body)["summaries"])
+
+        response = self.request("/api/sheets?from=2013-02-01&to=2013-02-28")
+        self.assertEqual(["2013-02-05", "2013-02-06"], [sheet["date"] for sheet in json.loads(response.body)["sheets"]])
+
+    def test_put_sheets_invalid_day(self):
+        sheets = { "2013-02-05" : ",".join(["3"] * 96), "2013-02-06" : "-1,-1" }
+        response = self.request("/api/sheets", "PUT", { "sheets" : json.dumps(sheets) })
+        self.assertEqual(500, response.code)
+        self.assertEqual(601, json.loads(response.body)["error"])
+
+        response = self.request("/api/sheets?from=2013-02-01&to=2013-02-28")
+        self.assertEqual([], json.loads(response.body)["sheets"])
+
+    ## Sessions
+
+    def test_login_and_logout(self):
+        with self.pool.connection() as db:
+            quarterapp.storage.add_user(db, "alice", hash_password("secret", options.salt))
+        response = self.fetch("/login", method = "POST", body = urllib.urlencode({ "username" : "alice", "password" : "secret" }),
+            follow_redirects = False)
+        self.assertEqual(302, response.code)
+        token = re.search(r"session=(\w+);", response.headers["Set-Cookie"]).group(1)
+        self.assertIn("httponly", response.headers["Set-Cookie"].lower())
+        with self.pool.connection() as db:
+            self.assertTrue(quarterapp.storage.get_login(db, "alice").password.startswith("pbkdf2_sha512$"))
+
+        headers = { "Cookie" : "session=" + token }
+        self.assertEqual(200, self.fetch("/api/activities", headers = headers).code)
+        self.assertEqual(302, self.fetch("/logout", headers = headers, follow_redirects = False).code)
+        self.assertEqual(302, self.fetch("/api/activities", headers = headers, follow_redirects = False).code)
+
@@ -0,0 +1,185 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import sqlite3
+import tempfile
+import time
+
+from tornado import gen
+from tornado.testing import AsyncTestCase
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.pool import ConnectionPool
+from quarterapp.async_storage import *
+from quarterapp.committer import GroupCommitter
+from quarterapp.settings import QuarterSettings
+from quarterapp.tests.storage_test import setup_sqlite
+
+BOB_THE_USER = 1
+
+class TestAsyncStorage(AsyncTestCase):
+    def setUp(self):
+        super(TestAsyncStorage, self).setUp()
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(self.filename)
+        quarterapp.migrations.migrate(db)
+        db.close()
+        self.pool = ConnectionPool(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False), size = 2)
+        self.storage = AsyncStorage(self.pool, io_loop = self.io_loop)
+
+    def tearDown(self):
+        self.storage.close()
+        self.pool.close()
+        os.remove(self.filename)
+        super(TestAsyncStorage, self).tearDown()
+
+    def run_engine(self, fn):
+        """Run the given generator function to completion on the test IOLoop"""
+        @gen.engine
+        def run():
+            result = yield gen.Task(lambda callback: fn(callback))
+            self.stop(result)
+        run()
+        return self.wait()
+
+    def test_result(self):
+        @gen.engine
+        def store(callback):
+            yield self.storage.add_activity(BOB_THE_USER, "Activity", "#fff")
+            activities = yield self.storage.get_activities(BOB_THE_USER)
+            callback(activities)
+        activities = self.run_engine(store)
+        self.assertEqual(["Activity"], [activity.title for activity in activities])
+
+    def test_exception_is_raised_at_yield(self):
+        @gen.engine
+        def fail(callback):
+            try:
+                yield self.storage.update_sheet(BOB_THE_USER, "2013-02-05", [-1])
+                callback("no error")
+            except ValueError:
+                callback("error")
+        self.assertEqual("error", self.run_engine(fail))
+
+    def test_slow_call_does_not_block_other_calls(self):
+        finished = []
+        def slow(db):
+            time.sleep(0.2)
+            finished.append("slow")
+        quarterapp.storage.slow_call = slow
+        try:
+            @gen.engine
+            def run_slow(callback):
+                yield self.storage.slow_call()
+                callback()
+
+            @gen.engine
+            def run_fast(callback):
+                yield self.storage.get_user_count()
+                finished.append("fast")
+                callback()
+
+            @gen.engine
+            def both(callback):
+                yield [gen.Task(run_slow), gen.Task(run_fast)]
+                callback(finished)
+            self.assertEqual(["fast", "slow"], self.run_engine(both))
+        finally:
+            del quarterapp.storage.slow_call
+
+    def test_queue_is_bounded(self):
+        storage = AsyncStorage(self.pool, workers = 1, queue_size = 1, io_loop = self.io_loop)
+        try:
+            block = lambda db: time.sleep(0.1)
+            storage.submit(block, (), {}, lambda result: None)
+            time.sleep(0.02)
+            storage.submit(block, (), {}, lambda result: None)
+            self.assertRaises(StorageBusy, storage.submit, block, (), {}, lambda result: None)
+        finally:
+            storage.close()
+
+    def test_writes_go_through_committer(self):
+        self.storage.close()
+        committer = GroupCommitter(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False))
+        self.storage = AsyncStorage(self.pool, io_loop = self.io_loop, committer = committer)
+
+        @gen.engine
+        def store(callback):
+            yield self.storage.add_activity(BOB_THE_USER, "Activity", "#fff")
+            activities = yield self.storage.get_activities(BOB_THE_USER)
+            callback(activities)
+        activities = self.run_engine(store)
+        self.assertEqual(["Activity"], [activity.title for activity in activities])
+        self.assertEqual(1, committer.stats()["writes"])
+
+    def test_reads_follow_pending_writes(self):
+        self.storage.close()
+        self.pool.close()
+        def read_only():
+            db = sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False)
+            quarterapp.storage._exec(db, "PRAGMA query_only = ON;")
+            return db
+        self.pool = ConnectionPool(read_only, size = 2)
+        committer = GroupCommitter(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False),
+            window = 0.2)
+        self.storage = AsyncStorage(self.pool, io_loop = self.io_loop, committer = committer)
+
+        results = {}
+        def done(name):
+            def callback(result):
+                results[name] = result
+                if len(results) == 3:
+                    self.stop()
+            return callback
+        self.storage.submit(quarterapp.storage.update_sheet, (BOB_THE_USER, "2013-02-05", [4] * 96), {}, done("write"))
+        self.storage.submit(quarterapp.storage.get_sheet, (BOB_THE_USER, "2013-02-05"), {}, done("own read"))
+        self.storage.submit(quarterapp.storage.get_sheet, (BOB_THE_USER + 1, "2013-02-05"), {}, done("other read"))
+        self.wait()
+
+        self.assertEqual((True, None), (results["write"][0], results["other read"][1]))
+        self.assertEqual([4] * 96, list(results["own read"][1]))
+        self.assertEqual({}, self.storage._pending_writes)
+
+        with self.pool.connection() as db:
+            self.assertRaises(sqlite3.OperationalError, quarterapp.storage.add_activity, db, BOB_THE_USER, "Work", "#fff")
+
+    def test_settings_written_through_committer(self):
+        self.storage.close()
+        self.pool.close()
+        def read_only():
+            db = sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False)
+            quarterapp.storage._exec(db, "PRAGMA query_only = ON;")
+            return db
+        self.pool = ConnectionPool(read_only, size = 2)
+        committer = GroupCommitter(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False))
+        self.storage = AsyncStorage(self.pool, io_loop = self.io_loop, committer = committer)
+        settings = QuarterSettings(self.pool, storage = self.storage)
+
+        settings.put_value("allow-signups", "0", self.stop)
+        self.assertTrue(self.wait()[0])
+        self.assertEqual("0", settings.get_value("allow-signups"))
+        with self.pool.connection() as db:
+            self.assertEqual("0", quarterapp.storage.get_setting(db, "allow-signups"))
@@ -0,0 +1,157 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from tornado import gen
+from tornado.testing import AsyncTestCase
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.cache import StorageCache
+from quarterapp.pool import ConnectionPool
+from quarterapp.async_storage import AsyncStorage
+from quarterapp.tests.storage_test import setup_sqlite
+
+BOB_THE_USER = 1
+
+def key(cache, fn, *args):
+    return cache.key(fn, args[0], args, {})
+
+class TestStorageCache(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = StorageCache(10000)
+        sheet = key(cache, quarterapp.storage.get_sheet, BOB_THE_USER, "2013-02-05")
+        self.assertEqual((False, None), cache.get(sheet))
+        cache.put(sheet, [1] * 96, cache.started())
+        self.assertEqual((True, [1] * 96), cache.get(sheet))
+        self.assertEqual({ "hits" : 1, "misses" : 1, "hit_ratio" : 0.5 },
+            dict((name, cache.stats()[name]) for name in ("hits", "misses", "hit_ratio")))
+
+    def test_writes_are_not_cached(self):
+        cache = StorageCache(10000)
+        self.assertEqual(None, key(cache, quarterapp.storage.update_sheet, BOB_THE_USER, "2013-02-05", [1] * 96))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = StorageCache(10000)
+        keys = [key(cache, quarterapp.storage.get_sheet, BOB_THE_USER, "2013-02-{0:02d}".format(day)) for day in range(1, 29)]
+        for sheet in keys:
+            cache.put(sheet, [1] * 96, cache.started())
+            cache.get(keys[0])
+        stats = cache.stats()
+        self.assertTrue(stats["evictions"] > 0)
+        self.assertTrue(stats["bytes"] <= 10000)
+        self.assertTrue(cache.get(keys[0])[0])
+        self.assertFalse(cache.get(keys[1])[0])
+        self.assertTrue(cache.get(keys[-1])[0])
+
+    def test_invalidate_group(self):
+        cache = StorageCache(10000)
+        sheet = key(cache, quarterapp.storage.get_sheet, BOB_THE_USER, "2013-02-05")
+        activities = key(cache, quarterapp.storage.get_activities, BOB_THE_USER)
+        other = key(cache, quarterapp.storage.get_activities, BOB_THE_USER + 1)
+        for cached in (sheet, activities, other):
+            cache.put(cached, [], cache.started())
+        cache.invalidate(BOB_THE_USER, ("sheets", ))
+        self.assertEqual([False, True, True], [cache.get(cached)[0] for cached in (sheet, activities, other)])
+        cache.invalidate(BOB_THE_USER)
+        self.assertEqual([False, False, True], [cache.get(cached)[0] for cached in (sheet, activities, other)])
+
+    def test_read_overlapping_write_is_not_cached(self):
+        cache = StorageCache(10000, max_writers = 1)
+        sheet = key(cache, quarterapp.storage.get_sheet, BOB_THE_USER, "2013-02-05")
+        started = cache.started()
+        cache.invalidate(BOB_THE_USER, ("sheets", ))
+        cache.put(sheet, [1] * 96, started)
+        self.assertFalse(cache.get(sheet)[0])
+
+        # Also when the write has been forgotten
+        started = cache.started()
+        cache.invalidate(BOB_THE_USER, ("sheets", ))
+        cache.invalidate(BOB_THE_USER + 1, ("sheets", ))
+        cache.put(sheet, [1] * 96, started)
+        self.assertFalse(cache.get(sheet)[0])
+
+    def test_max_age(self):
+        now = [1000.0]
+        cache = StorageCache(10000, max_age = 10, clock = lambda: now[0])
+        sheet = key(cache, quarterapp.storage.get_sheet, BOB_THE_USER, "2013-02-05")
+        cache.put(sheet, [1] * 96, cache.started())
+        now[0] += 11
+        self.assertFalse(cache.get(sheet)[0])
+        self.assertEqual(0, cache.stats()["bytes"])
+
+class TestCachedStorage(AsyncTestCase):
+    def setUp(self):
+        super(TestCachedStorage, self).setUp()
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(self.filename)
+        quarterapp.migrations.migrate(db)
+        db.close()
+        self.pool = ConnectionPool(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False), size = 2)
+        self.storage = AsyncStorage(self.pool, io_loop = self.io_loop, cache = StorageCache(100000))
+
+    def tearDown(self):
+        self.storage.close()
+        self.pool.close()
+        os.remove(self.filename)
+        super(TestCachedStorage, self).tearDown()
+
+    def run_engine(self, fn):
+        """Run the given generator function to completion on the test IOLoop"""
+        @gen.engine
+        def run():
+            result = yield gen.Task(lambda callback: fn(callback))
+            self.stop(result)
+        run()
+        return self.wait()
+
+    def test_page_view_is_cached(self):
+        @gen.engine
+        def view(callback):
+            activities = yield self.storage.get_activities(BOB_THE_USER)
+            sheet = yield self.storage.get_sheet(BOB_THE_USER, "2013-02-05")
+            callback((activities, sheet))
+
+        @gen.engine
+        def store(callback):
+            yield self.storage.add_activity(BOB_THE_USER, "Work", "#fff")
+            yield self.storage.update_sheet(BOB_THE_USER, "2013-02-05", [1] * 96)
+            callback()
+
+        self.assertEqual(([], None), self.run_engine(view))
+        checkouts = self.pool.stats()["checkouts"]
+        self.assertEqual(([], None), self.run_engine(view))
+        self.assertEqual(checkouts, self.pool.stats()["checkouts"])
+
+        self.run_engine(store)
+        activities, sheet = self.run_engine(view)
+        self.assertEqual(["Work"], [activity.title for activity in activities])
+        self.assertEqual([1] * 96, list(sheet))
+        checkouts = self.pool.stats()["checkouts"]
+        self.run_engine(view)
+        self.assertEqual(checkouts, self.pool.stats()["checkouts"])
+        self.assertEqual(4, self.storage.cache.stats()["hits"])
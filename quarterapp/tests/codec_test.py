@@ -0,0 +1,79 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import unittest
+
+from quarterapp.sheet_codec import *
+
+class TestSheetCodec(unittest.TestCase):
+    def test_empty_sheet(self):
+        quarters = [-1] * 96
+        packed = encode(quarters)
+        self.assertTrue(is_packed(packed))
+        self.assertEqual(quarters, list(decode(packed)))
+
+    def test_nibble_packing(self):
+        quarters = [(i % 16) * 1000 - 1 for i in range(96)]
+        packed = encode(quarters)
+        self.assertEqual(PACKED_NIBBLE, ord(packed[0]))
+        self.assertEqual(2 + 16 * 4 + 48, len(packed))
+        self.assertEqual(quarters, list(decode(packed)))
+
+    def test_byte_packing(self):
+        quarters = range(96)
+        packed = encode(quarters)
+        self.assertEqual(PACKED_BYTE, ord(packed[0]))
+        self.assertEqual(quarters, list(decode(packed)))
+
+    def test_string_ids(self):
+        self.assertEqual([12] * 96, list(decode(encode(["12"] * 96))))
+
+    def test_legacy_text(self):
+        text = ",".join(["-1"] * 95 + ["42"])
+        self.assertFalse(is_packed(text))
+        self.assertFalse(is_packed(unicode(text)))
+        self.assertEqual([-1] * 95 + [42], list(decode(text)))
+        self.assertEqual([-1] * 95 + [42], list(decode(unicode(text))))
+
+    def test_wrong_length(self):
+        self.assertRaises(ValueError, encode, [-1] * 95)
+        self.assertRaises(ValueError, encode, ["a"] * 96)
+        self.assertRaises(ValueError, encode, [2 ** 40] * 96)
+        self.assertRaises(ValueError, encode, [-1] * 95 + [2 ** 31])
+        self.assertEqual([2 ** 31 - 1, -2 ** 31] * 48, list(decode(encode([2 ** 31 - 1, -2 ** 31] * 48))))
+
+    def test_runs(self):
+        quarters = [-1] * 32 + [7] * 9 + [-1] * 9 + [3] + [-1] * 45
+        self.assertEqual("0-31:-1,32-40:7,41-49:-1,50:3,51-95:-1", encode_runs(quarters))
+        self.assertEqual([(0, 31, -1), (32, 40, 7), (41, 49, -1), (50, 50, 3), (51, 95, -1)], decode_runs(encode_runs(quarters)))
+        self.assertEqual("0-95:5", encode_runs([5] * 96))
+
+    def test_invalid_runs(self):
+        for runs in ("", "96:1", "5-4:1", "1:a", "1-:2", "0-95", "1:4294967296"):
+            self.assertRaises(ValueError, decode_runs, runs)
+
+    def test_apply_runs(self):
+        quarters = [-1] * 96
+        self.assertEqual({ -1 : -10, 7 : 9, 3 : 1 }, apply_runs(quarters, decode_runs("32-40:7,50:3")))
+        self.assertEqual({ 7 : -2, 3 : 2 }, apply_runs(quarters, decode_runs("39-41:3,41:-1")))
+        self.assertEqual({}, apply_runs(quarters, decode_runs("0-10:-1")))
+        self.assertEqual([-1] * 32 + [7] * 7 + [3] * 2 + [-1] * 9 + [3] + [-1] * 45, quarters)
@@ -0,0 +1,147 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.committer import GroupCommitter
+from quarterapp.tests.storage_test import setup_sqlite
+
+BOB_THE_USER = 1
+
+def failing_write(db, date):
+    """Write a sheet and then fail, the sheet must be rolled back"""
+    quarterapp.storage.update_sheet(db, BOB_THE_USER, date, [1] * 96)
+    raise RuntimeError("failed after writing")
+
+class TestGroupCommitter(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(self.filename)
+        quarterapp.migrations.migrate(db)
+        db.close()
+        self.committer = None
+
+    def tearDown(self):
+        if self.committer:
+            self.committer.close()
+        os.remove(self.filename)
+
+    def connect(self):
+        return sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False)
+
+    def write_all(self, writes):
+        """Submit (fn, args) writes at once and wait for all of them to be acknowledged"""
+        results = [None] * len(writes)
+        done = threading.Semaphore(0)
+        def acknowledge(index, result):
+            results[index] = result
+            done.release()
+        for index, (fn, args) in enumerate(writes):
+            self.committer.submit(fn, args, {}, lambda result, index = index: acknowledge(index, result))
+        for write in writes:
+            done.acquire()
+        return results
+
+    def test_writes_are_committed_together(self):
+        self.committer = GroupCommitter(self.connect, window = 0.5, max_batch = 10)
+        writes = [(quarterapp.storage.update_sheet, (BOB_THE_USER, "2013-02-{0:02d}".format(day), [day] * 96)) for day in range(1, 11)]
+        results = self.write_all(writes)
+
+        self.assertTrue(all(succeeded for succeeded, value in results))
+        self.assertEqual(1, self.committer.stats()["commits"])
+        self.assertEqual(10, self.committer.stats()["largest_batch"])
+        sheets = quarterapp.storage.get_sheets(self.connect(), BOB_THE_USER, "2013-02-01", "2013-02-28")
+        self.assertEqual(10, len(sheets))
+
+    def test_failed_write_is_rolled_back_alone(self):
+        self.committer = GroupCommitter(self.connect, window = 0.5, max_batch = 3)
+        results = self.write_all([
+            (quarterapp.storage.update_sheet, (BOB_THE_USER, "2013-02-01", [1] * 96)),
+            (failing_write, ("2013-02-02",)),
+            (quarterapp.storage.update_sheet, (BOB_THE_USER, "2013-02-03", [3] * 96))])
+
+        self.assertEqual([True, False, True], [succeeded for succeeded, value in results])
+        self.assertEqual(RuntimeError, results[1][1][0])
+        sheets = quarterapp.storage.get_sheets(self.connect(), BOB_THE_USER, "2013-02-01", "2013-02-28")
+        self.assertEqual(["2013-02-01", "2013-02-03"], [date for date, quarters in sheets])
+
+    def test_close_commits_pending_writes(self):
+        self.committer = GroupCommitter(self.connect, window = 10)
+        acknowledged = []
+        self.committer.submit(quarterapp.storage.add_activity, (BOB_THE_USER, "Work", "#fff"), {}, acknowledged.append)
+        self.committer.close()
+        self.committer = None
+
+        self.assertEqual(1, len(acknowledged))
+        self.assertEqual(1, len(quarterapp.storage.get_activities(self.connect(), BOB_THE_USER)))
+
+    def test_write_alone_ends_batch(self):
+        self.committer = GroupCommitter(self.connect, window = 0.5, max_batch = 10)
+        db = self.connect()
+        quarterapp.storage.add_user(db, "bob@example.com", "secret")
+        bob = quarterapp.storage.get_users(db, after_id = 0)[-1].id
+        results = self.write_all([
+            (quarterapp.storage.update_sheet, (bob, "2013-02-01", [1] * 96)),
+            (quarterapp.storage.delete_user, ("bob@example.com",)),
+            (quarterapp.storage.update_sheet, (BOB_THE_USER, "2013-02-02", [2] * 96))])
+
+        self.assertEqual({ "users" : 1, "activities" : 0, "sheets" : 1 }, results[1][1])
+        self.assertEqual(2, self.committer.stats()["commits"])
+        self.assertEqual([], quarterapp.storage.get_sheets(db, bob, "2013-02-01", "2013-02-28"))
+        sheets = quarterapp.storage.get_sheets(db, BOB_THE_USER, "2013-02-01", "2013-02-28")
+        self.assertEqual(["2013-02-02"], [date for date, quarters in sheets])
+
+    def test_writes_run_between_chunks(self):
+        self.committer = GroupCommitter(self.connect)
+        db = self.connect()
+        quarterapp.storage.add_user(db, "bob@example.com", "secret")
+        bob = quarterapp.storage.get_users(db, after_id = 0)[-1].id
+        quarterapp.storage.update_sheets(db, bob, [("2013-02-{0:02d}".format(day), [day] * 96) for day in range(1, 6)])
+
+        first_chunk, waited = threading.Event(), threading.Event()
+        def progress(table, deleted):
+            if deleted == 1:
+                first_chunk.set()
+                waited.wait(5)
+        acknowledged = []
+        done = threading.Semaphore(0)
+        def acknowledge(name, result):
+            acknowledged.append((name, result[0]))
+            done.release()
+        self.committer.submit(quarterapp.storage.delete_user, ("bob@example.com",), { "chunk_size" : 1, "progress" : progress },
+            lambda result: acknowledge("delete_user", result))
+        self.assertTrue(first_chunk.wait(5))
+        self.committer.submit(quarterapp.storage.add_activity, (BOB_THE_USER, "Work", "#fff"), {},
+            lambda result: acknowledge("add_activity", result))
+        waited.set()
+        done.acquire()
+        done.acquire()
+
+        self.assertEqual([("add_activity", True), ("delete_user", True)], acknowledged)
+        self.assertEqual([], quarterapp.storage.get_sheets(db, bob, "2013-02-01", "2013-02-28"))
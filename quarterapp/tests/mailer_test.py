@@ -0,0 +1,207 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import asyncore
+import logging
+import os
+import smtpd
+import socket
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.committer import GroupCommitter
+from quarterapp.mailer import Mailer
+from quarterapp.pool import ConnectionPool
+from quarterapp.tests.storage_test import setup_sqlite
+
+class SMTPStandIn(smtpd.SMTPServer):
+    """
+    A local SMTP server collecting the mail it receives, refusing recipients
+    in refused and counting the connections
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+        self._running = True
+        self._thread = threading.Thread(target = self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout = 0.01, count = 1)
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestMailer(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(self.filename)
+        quarterapp.migrations.migrate(db)
+        db.close()
+        self.pool = ConnectionPool(self.connect, size = 1)
+        self.server = SMTPStandIn()
+        self.clock = Clock()
+
+    def tearDown(self):
+        self.server.stop()
+        self.pool.close()
+        os.remove(self.filename)
+
+    def connect(self):
+        return sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False)
+
+    def mailer(self, port = None, **kwargs):
+        return Mailer(self.pool, "127.0.0.1", port or self.server.port, sender = "no-reply@example.com", backoff = 30,
+            max_attempts = 3, clock = self.clock, **kwargs)
+
+    def queue(self, count):
+        with self.pool.connection() as db:
+            for i in range(count):
+                quarterapp.storage.queue_mail(db, "user{0}@example.com".format(i), "Subject: test {0}\n\nHello".format(i))
+        self.clock.now = 2e9
+
+    def outbox(self):
+        with self.pool.connection() as db:
+            return quarterapp.storage._query(db, "SELECT recipient, attempts, next_attempt FROM outbox ORDER BY id;")
+
+    def test_batches_share_a_connection(self):
+        self.queue(5)
+        mailer = self.mailer(batch_size = 2)
+        self.assertEqual([2, 2, 1, 0], [mailer.send_due() for i in range(4)])
+        mailer.close()
+        self.assertEqual(["user{0}@example.com".format(i) for i in range(5)], [rcpttos[0] for mailfrom, rcpttos, data in self.server.messages])
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual([], self.outbox())
+        self.assertEqual({ "sent" : 5, "retried" : 0, "dropped" : 0, "connects" : 1 }, mailer.stats())
+
+    def test_retry_with_backoff(self):
+        self.queue(1)
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        mailer = self.mailer(port = closed.getsockname()[1])
+        closed.close()
+
+        self.assertEqual(1, mailer.send_due())
+        self.assertEqual([(1, self.clock.now + 30)], [(mail.attempts, mail.next_attempt) for mail in self.outbox()])
+        self.assertEqual(0, mailer.send_due())
+
+        self.clock.now += 30
+        self.assertEqual(1, mailer.send_due())
+        self.assertEqual([(2, self.clock.now + 60)], [(mail.attempts, mail.next_attempt) for mail in self.outbox()])
+
+        self.clock.now += 60
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger().addHandler(handler)
+        try:
+            mailer.send_due()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual([], self.outbox())
+        # The message holds activation and reset codes, it must not be logged
+        dropped = [record.getMessage() for record in records if "Dropping" in record.getMessage()]
+        self.assertEqual(1, len(dropped))
+        self.assertIn("user0@example.com", dropped[0])
+        self.assertNotIn("Hello", dropped[0])
+        self.assertEqual({ "sent" : 0, "retried" : 2, "dropped" : 1, "connects" : 0 }, mailer.stats())
+
+    def test_claimed_mail_is_not_sent_twice(self):
+        self.queue(2)
+        with self.pool.connection() as db:
+            claimed = quarterapp.storage.claim_mail(db, self.clock.now, 1, self.clock.now + 60)
+        self.assertEqual(["user0@example.com"], [mail.recipient for mail in claimed])
+        mailer = self.mailer()
+        self.assertEqual(1, mailer.send_due())
+        mailer.close()
+        self.assertEqual(["user1@example.com"], [rcpttos[0] for mailfrom, rcpttos, data in self.server.messages])
+
+    def test_background_sender_with_committer(self):
+        committer = GroupCommitter(self.connect)
+        mailer = self.mailer(committer = committer, poll_interval = 60)
+        mailer.start()
+        try:
+            self.queue(1)
+            with self.pool.connection() as db:
+                self.assertEqual(1, quarterapp.storage.get_outbox_size(db))
+            sent = threading.Event()
+            self.server.process_message = lambda *args: sent.set()
+            mailer.wake()
+            self.assertTrue(sent.wait(5))
+        finally:
+            mailer.close()
+            committer.close()
+        self.assertEqual([], self.outbox())
+
+    def refuse_mail(self):
+        with self.pool.connection() as db:
+            quarterapp.storage._exec(db, "CREATE TRIGGER refuse_mail BEFORE INSERT ON outbox BEGIN SELECT RAISE(ABORT, 'outbox full'); END;")
+
+    def test_signup_is_queued_with_its_mail(self):
+        with self.pool.connection() as db:
+            self.assertTrue(quarterapp.storage.signup_user(db, "one@example.com", "sleepy", "127.0.0.1", "Subject: signup\n\nHello"))
+        self.assertEqual(["one@example.com"], [mail.recipient for mail in self.outbox()])
+
+        self.refuse_mail()
+        with self.pool.connection() as db:
+            self.assertRaises(sqlite3.Error, quarterapp.storage.signup_user, db, "two@example.com", "tired", "127.0.0.1", "Subject: signup\n\nHello")
+            self.assertEqual(1, quarterapp.storage.get_signup_count(db))
+
+    def test_reset_code_is_set_with_its_mail(self):
+        with self.pool.connection() as db:
+            quarterapp.storage.add_user(db, "one@example.com", "secretpassword")
+            self.assertFalse(quarterapp.storage.set_user_reset_code(db, "nobody@example.com", "okay", "Subject: reset\n\nHello"))
+        self.assertEqual([], self.outbox())
+
+        with self.pool.connection() as db:
+            self.assertTrue(quarterapp.storage.set_user_reset_code(db, "one@example.com", "okay", "Subject: reset\n\nHello"))
+        self.assertEqual(["one@example.com"], [mail.recipient for mail in self.outbox()])
+
+        self.refuse_mail()
+        with self.pool.connection() as db:
+            self.assertRaises(sqlite3.Error, quarterapp.storage.set_user_reset_code, db, "one@example.com", "again", "Subject: reset\n\nHello")
+            self.assertFalse(quarterapp.storage.reset_password(db, "again", "anothersecret"))
@@ -0,0 +1,144 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import unittest
+import os
+import tempfile
+
+import quarterapp.storage
+import quarterapp.migrations
+import quarterapp.sheet_codec
+from quarterapp.tests.storage_test import setup_sqlite
+
+def query_plan(db, sql, params):
+    """Get the query plan for the given query as a single string"""
+    rows = quarterapp.storage._query(db, "EXPLAIN QUERY PLAN " + sql, params)
+    return " | ".join(row.detail for row in rows)
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.db = setup_sqlite(self.filename)
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.filename)
+
+    def assertUsesIndex(self, index, sql, params):
+        plan = query_plan(self.db, sql, params)
+        self.assertTrue(("USING INDEX " + index) in plan or ("USING COVERING INDEX " + index) in plan,
+            "Expected index {0} in plan: {1}".format(index, plan))
+
+    def test_migrate_from_base_schema(self):
+        self.assertEqual(0, quarterapp.migrations.current_version(self.db))
+        applied = quarterapp.migrations.migrate(self.db)
+        self.assertEqual([m.version for m in quarterapp.migrations.MIGRATIONS], applied)
+        self.assertEqual(applied[-1], quarterapp.migrations.current_version(self.db))
+        self.assertEqual([], quarterapp.migrations.migrate(self.db))
+
+    def test_migrate_to_target(self):
+        self.assertEqual([1], quarterapp.migrations.migrate(self.db, target = 1))
+        self.assertEqual(1, quarterapp.migrations.current_version(self.db))
+
+    def test_missing_migrations(self):
+        self.assertEqual(1, quarterapp.migrations.missing(self.db)[0].version)
+        online = [m.version for m in quarterapp.migrations.MIGRATIONS if m.online]
+        quarterapp.migrations.migrate(self.db, target = online[0] - 1)
+        self.assertEqual([], quarterapp.migrations.missing(self.db))
+
+    ## Migration 1
+
+    def test_activities_by_user(self):
+        quarterapp.migrations.migrate(self.db, target = 1)
+        self.assertUsesIndex("activities_user",
+            "SELECT id, title, color FROM activities WHERE user=%(user)s;", { "user" : 1 })
+
+    def test_users_by_username(self):
+        quarterapp.migrations.migrate(self.db, target = 1)
+        self.assertUsesIndex("users_username",
+            "SELECT username FROM users WHERE username=%(username)s;", { "username" : "bob" })
+        self.assertUsesIndex("users_username",
+            "SELECT id, username, type, state FROM users WHERE username=%(username)s AND password=%(password)s;",
+            { "username" : "bob", "password" : "secret" })
+
+    def test_users_by_reset_code(self):
+        quarterapp.migrations.migrate(self.db, target = 1)
+        self.assertUsesIndex("users_reset_code",
+            "SELECT username FROM users WHERE reset_code=%(code)s;", { "code" : "okay" })
+
+    def test_signups_by_activation_code(self):
+        quarterapp.migrations.migrate(self.db, target = 1)
+        self.assertUsesIndex("signups_activation_code",
+            "SELECT username, activation_code FROM signups WHERE activation_code=%(code)s;", { "code" : "sleepy" })
+
+    ## Migration 2
+
+    def test_sheet_by_user_and_date(self):
+        quarterapp.migrations.migrate(self.db, target = 2)
+        self.assertUsesIndex("sheets_user_date",
+            "SELECT quarters FROM sheets WHERE user=%(user)s and date=%(date)s", { "user" : 1, "date" : "2013-02-05" })
+
+    def test_duplicate_sheets_are_removed(self):
+        for quarters in ("old", "new"):
+            quarterapp.storage._exec(self.db, "INSERT INTO sheets (user, date, quarters) VALUES(1, '2013-02-05', %(quarters)s);",
+                { "quarters" : quarters })
+        quarterapp.migrations.migrate(self.db, target = 2)
+
+        rows = quarterapp.storage._query(self.db, "SELECT quarters FROM sheets;")
+        self.assertEqual(["new"], [row.quarters for row in rows])
+        self.assertRaises(Exception, quarterapp.storage._exec, self.db,
+            "INSERT INTO sheets (user, date, quarters) VALUES(1, '2013-02-05', 'again');")
+
+    ## Migration 12
+
+    def test_text_sheets_are_packed(self):
+        quarterapp.storage._exec(self.db, "INSERT INTO sheets (user, date, quarters) VALUES(1, '2013-02-05', %(quarters)s);",
+            { "quarters" : ",".join(["3"] * 96) })
+        quarterapp.migrations.migrate(self.db, target = 12)
+
+        rows = quarterapp.storage._query(self.db, "SELECT quarters FROM sheets;")
+        self.assertTrue(quarterapp.sheet_codec.is_packed(rows[0].quarters))
+
+    ## Migration 4
+
+    def test_existing_users_are_indexed(self):
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secret")
+        quarterapp.migrations.migrate(self.db, target = 4)
+
+        self.assertEqual(1, quarterapp.storage.get_filtered_user_count(self.db, "xample"))
+        plan = query_plan(self.db, "SELECT rowid AS id FROM users_search WHERE users_search MATCH %(match)s AND rowid > %(after)s ORDER BY rowid LIMIT 5;",
+            { "match" : '"xample"', "after" : 0 })
+        self.assertIn("VIRTUAL TABLE INDEX", plan)
+
+    def test_search_index_follows_users(self):
+        quarterapp.migrations.migrate(self.db)
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secret")
+        quarterapp.storage.add_user(self.db, "alice@Example.com", "secret")
+        self.assertEqual(["alice@Example.com", "bob@example.com"],
+            sorted(user.username for user in quarterapp.storage.get_filtered_users(self.db, "EXAMPLE")))
+
+        quarterapp.storage.delete_user(self.db, "bob@example.com")
+        self.assertEqual(1, quarterapp.storage.get_filtered_user_count(self.db, "example"))
+        self.assertEqual(0, quarterapp.storage.get_filtered_user_count(self.db, "bob@"))
+        self.assertEqual(1, quarterapp.storage.get_filtered_user_count(self.db, "ce"))
@@ -0,0 +1,101 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from tornado import gen
+from tornado.testing import AsyncTestCase
+
+import quarterapp.quarter_utils
+from quarterapp.passwords import PasswordHasher, PasswordHasherBusy
+from quarterapp.quarter_utils import hash_password
+
+class TestPasswordHasher(AsyncTestCase):
+    def setUp(self):
+        super(TestPasswordHasher, self).setUp()
+        self.hasher = PasswordHasher(10, "salt", processes = 2, queue_size = 2, io_loop = self.io_loop)
+
+    def tearDown(self):
+        self.hasher.close()
+        super(TestPasswordHasher, self).tearDown()
+
+    def run_engine(self, fn):
+        gen.engine(fn)(self.stop)
+        return self.wait()
+
+    def test_hash_and_check(self):
+        def check(callback):
+            hashed = yield self.hasher.hash("secret")
+            valid = yield self.hasher.check("secret", hashed)
+            invalid = yield self.hasher.check("guess", hashed)
+            callback((valid, invalid))
+        self.assertEqual(((True, None), (False, None)), self.run_engine(check))
+
+    def test_legacy_hash_is_upgraded(self):
+        def check(callback):
+            result = yield self.hasher.check("secret", hash_password("secret", "salt"))
+            callback(result)
+        valid, upgraded = self.run_engine(check)
+        self.assertTrue(valid)
+        self.assertTrue(upgraded.startswith("pbkdf2_sha512$10$"))
+
+    def test_failure_is_raised(self):
+        def check(callback):
+            try:
+                yield self.hasher.check("secret", "pbkdf2_sha512$many$salt$hash")
+                callback(None)
+            except ValueError:
+                callback("raised")
+        self.assertEqual("raised", self.run_engine(check))
+
+    def test_queue_is_bounded(self):
+        results = []
+        def done(result):
+            results.append(result)
+            self.stop()
+        for i in range(2):
+            self.hasher.submit(hash_password, ("secret", "salt"), {}, done)
+        self.assertEqual(2, self.hasher.pending())
+        self.assertRaises(PasswordHasherBusy, self.hasher.submit, hash_password, ("secret", "salt"), {}, done)
+        self.wait(lambda: len(results) == 2)
+        self.assertEqual(0, self.hasher.pending())
+
+    def test_inline(self):
+        hasher = PasswordHasher(10, "salt", processes = 0, io_loop = self.io_loop)
+        results = []
+        hasher.submit(hash_password, ("secret", "salt"), {}, results.append)
+        self.assertEqual([(True, hash_password("secret", "salt"))], results)
+
+    def test_missing_hash_is_hashed_too(self):
+        hasher = PasswordHasher(10, "salt", processes = 0, io_loop = self.io_loop)
+        make_password = quarterapp.quarter_utils.make_password
+        hashed = []
+        def counting_make_password(*args):
+            hashed.append(args[1])
+            return make_password(*args)
+        quarterapp.quarter_utils.make_password = counting_make_password
+        try:
+            def check(callback):
+                result = yield hasher.check("", None)
+                callback(result)
+            self.assertEqual((False, None), self.run_engine(check))
+        finally:
+            quarterapp.quarter_utils.make_password = make_password
+        self.assertEqual([10], hashed)
@@ -0,0 +1,87 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import unittest
+import sqlite3
+
+from quarterapp.pool import *
+
+class FlakyDatabase(object):
+    """Connection factory failing the first given number of attempts"""
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = 0
+
+    def connect(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise Exception("Can't connect")
+        return sqlite3.connect(":memory:")
+
+class TestConnectionPool(unittest.TestCase):
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(lambda: sqlite3.connect(":memory:"), size = 2)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertIs(first, second)
+        self.assertEqual(2, pool.stats()["checkouts"])
+        self.assertEqual(0, pool.stats()["in_use"])
+
+    def test_utilization(self):
+        pool = ConnectionPool(lambda: sqlite3.connect(":memory:"), size = 2)
+        db = pool.checkout()
+        self.assertEqual(0.5, pool.stats()["utilization"])
+        pool.checkin(db)
+        self.assertEqual(0.0, pool.stats()["utilization"])
+        self.assertEqual(1, pool.stats()["peak_in_use"])
+
+    def test_timeout(self):
+        pool = ConnectionPool(lambda: sqlite3.connect(":memory:"), size = 1, timeout = 0.01)
+        db = pool.checkout()
+        self.assertRaises(PoolError, pool.checkout)
+        self.assertEqual(1, pool.stats()["timeouts"])
+        pool.checkin(db)
+        pool.checkin(pool.checkout())
+
+    def test_reconnect_broken_connection(self):
+        pool = ConnectionPool(lambda: sqlite3.connect(":memory:"), size = 1)
+        with pool.connection() as db:
+            db.close()
+        with pool.connection() as db:
+            self.assertIsNotNone(db.execute("SELECT 1").fetchone())
+        self.assertEqual(1, pool.stats()["reconnects"])
+
+    def test_connect_with_backoff(self):
+        database = FlakyDatabase(2)
+        pool = ConnectionPool(database.connect, size = 1, backoff = 0.001)
+        with pool.connection() as db:
+            self.assertIsNotNone(db)
+        self.assertEqual(3, database.attempts)
+
+    def test_give_up_connecting(self):
+        database = FlakyDatabase(10)
+        pool = ConnectionPool(database.connect, size = 1, retries = 3, backoff = 0.001)
+        self.assertRaises(PoolError, pool.checkout)
+        self.assertEqual(0, pool.stats()["in_use"])
+        self.assertEqual(3, database.attempts)
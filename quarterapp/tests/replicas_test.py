@@ -0,0 +1,141 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sqlite3
+import tempfile
+
+from tornado import gen
+from tornado.testing import AsyncTestCase
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.pool import ConnectionPool
+from quarterapp.replicas import ReplicaRouter
+from quarterapp.async_storage import AsyncStorage
+from quarterapp.tests.storage_test import setup_sqlite
+
+BOB_THE_USER = 1
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def unreachable():
+    raise sqlite3.OperationalError("unable to open database file")
+
+class TestReplicaRouter(AsyncTestCase):
+    """
+    The primary and the replica are separate SQLite files, replication is
+    simulated by writing to the replica file directly. The replica has an
+    activity the primary does not, so a read shows where it was served from.
+    """
+    def setUp(self):
+        super(TestReplicaRouter, self).setUp()
+        self.filenames = []
+        self.primary = self.create_database()
+        self.replica = self.create_database()
+        with self.replica.connection() as db:
+            quarterapp.storage.add_activity(db, BOB_THE_USER, "Replicated", "#fff")
+        self.clock = Clock(1000.0)
+        self.router = ReplicaRouter(self.primary, [("replica", self.replica)], max_lag = 5, interval = None,
+            clock = self.clock)
+
+    def tearDown(self):
+        self.router.close()
+        self.primary.close()
+        for filename in self.filenames:
+            os.remove(filename)
+        super(TestReplicaRouter, self).tearDown()
+
+    def create_database(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(filename)
+        quarterapp.migrations.migrate(db)
+        db.close()
+        self.filenames.append(filename)
+        return ConnectionPool(lambda: sqlite3.connect(filename, isolation_level = None, check_same_thread = False), size = 1)
+
+    def replicate(self, lag):
+        """Let the replica catch up to the primary as it was lag seconds ago"""
+        with self.replica.connection() as db:
+            quarterapp.storage.beat(db, self.clock() - lag)
+        self.router.check()
+
+    def test_reads_go_to_fresh_replica(self):
+        self.replicate(2)
+        self.assertIs(self.replica, self.router.pool_for(quarterapp.storage.get_activities, BOB_THE_USER))
+        self.assertIs(self.primary, self.router.pool_for(quarterapp.storage.add_activity, BOB_THE_USER))
+        self.assertIs(self.primary, self.router.pool_for(quarterapp.storage.authenticate_user))
+        self.assertEqual(2, self.router.stats()["replicas"][0]["lag"])
+
+    def test_heartbeat_is_written_to_primary(self):
+        self.router.check()
+        with self.primary.connection() as db:
+            self.assertEqual(self.clock(), quarterapp.storage.get_heartbeat(db))
+
+    def test_reads_after_write_go_to_primary(self):
+        self.replicate(0)
+        self.router.wrote(BOB_THE_USER)
+        self.assertIs(self.primary, self.router.pool_for(quarterapp.storage.get_activities, BOB_THE_USER))
+        self.assertIs(self.replica, self.router.pool_for(quarterapp.storage.get_activities, BOB_THE_USER + 1))
+
+        self.clock.now += 6
+        self.replicate(0)
+        self.assertIs(self.replica, self.router.pool_for(quarterapp.storage.get_activities, BOB_THE_USER))
+
+    def test_stale_replica_is_not_used(self):
+        self.replicate(6)
+        self.assertIs(self.primary, self.router.pool_for(quarterapp.storage.get_activities, BOB_THE_USER))
+
+        self.replicate(1)
+        self.assertIs(self.replica, self.router.pool_for(quarterapp.storage.get_activities, BOB_THE_USER))
+
+    def test_unreachable_replica_is_not_used(self):
+        broken = ConnectionPool(unreachable, size = 1, retries = 1, backoff = 0)
+        self.router = ReplicaRouter(self.primary, [("broken", broken), ("replica", self.replica)], interval = None,
+            clock = self.clock)
+        self.replicate(0)
+        for i in range(4):
+            self.assertIs(self.replica, self.router.pool_for(quarterapp.storage.get_activities, BOB_THE_USER))
+        self.assertEqual(None, self.router.stats()["replicas"][0]["lag"])
+
+    def test_async_storage_routes_reads(self):
+        self.replicate(0)
+        storage = AsyncStorage(self.primary, io_loop = self.io_loop, router = self.router)
+        try:
+            @gen.engine
+            def run(callback):
+                replicated = yield storage.get_activities(BOB_THE_USER)
+                yield storage.add_activity(BOB_THE_USER, "Written", "#fff")
+                written = yield storage.get_activities(BOB_THE_USER)
+                callback((replicated, written))
+            run(self.stop)
+            replicated, written = self.wait()
+        finally:
+            storage.close()
+        self.assertEqual(["Replicated"], [activity.title for activity in replicated])
+        self.assertEqual(["Written"], [activity.title for activity in written])
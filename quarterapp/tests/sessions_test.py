@@ -0,0 +1,178 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.pool import ConnectionPool
+from quarterapp.sessions import SessionStore, new_token, session_id
+from quarterapp.tests.storage_test import setup_sqlite
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class DeferredStorage(object):
+    """Storage facade stand-in that runs submitted calls when told to"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.calls = []
+
+    def submit(self, fn, args, kwargs, callback):
+        self.calls.append((fn, args, kwargs, callback))
+
+    def run(self):
+        fn, args, kwargs, callback = self.calls.pop(0)
+        with self.pool.connection() as db:
+            callback((True, fn(db, *args, **kwargs)))
+
+def resolve(sessions, token):
+    """Resolve a session of a store without a storage facade"""
+    resolved = []
+    sessions.resolve(token, resolved.append)
+    return resolved[0]
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(self.filename)
+        quarterapp.migrations.migrate(db)
+        self.user_id = quarterapp.storage._exec(db, "INSERT INTO users (username, password, type, state) VALUES('bob', '', 0, 1);")
+        self.other_user_id = quarterapp.storage._exec(db, "INSERT INTO users (username, password, type, state) VALUES('alice', '', 0, 1);")
+        db.commit()
+        db.close()
+        self.pool = ConnectionPool(lambda: sqlite3.connect(self.filename, isolation_level = None, check_same_thread = False), size = 1)
+        self.clock = Clock()
+        self.sessions = SessionStore(self.pool, clock = self.clock)
+        self.token = self.create_session(self.clock.now + 60)
+
+    def tearDown(self):
+        self.pool.close()
+        os.remove(self.filename)
+
+    def create_session(self, expires, user_id = None):
+        token = new_token()
+        with self.pool.connection() as db:
+            quarterapp.storage.create_session(db, session_id(token), user_id or self.user_id, expires)
+        return token
+
+    def lookups(self):
+        return self.pool.stats()["checkouts"]
+
+    def test_token_is_not_stored(self):
+        with self.pool.connection() as db:
+            stored = quarterapp.storage._query(db, "SELECT id FROM sessions;")[0].id
+        self.assertNotEqual(self.token, stored)
+        self.assertEqual(session_id(self.token), stored)
+
+    def test_lookup_is_cached(self):
+        self.assertEqual(None, self.sessions.cached(self.token))
+        self.assertEqual({ "id" : self.user_id, "username" : "bob", "type" : 0 }, resolve(self.sessions, self.token))
+        lookups = self.lookups()
+        self.assertEqual("bob", resolve(self.sessions, self.token)["username"])
+        self.assertEqual("bob", self.sessions.cached(self.token)["username"])
+        self.assertEqual(lookups, self.lookups())
+
+    def test_lookup_through_storage(self):
+        storage = DeferredStorage(self.pool)
+        sessions = SessionStore(self.pool, storage = storage, clock = self.clock)
+        resolved = []
+        lookups = self.lookups()
+        sessions.resolve(self.token, resolved.append)
+        self.assertEqual(([], lookups), (resolved, self.lookups()))
+
+        storage.run()
+        self.assertEqual("bob", resolved[0]["username"])
+        sessions.resolve(self.token, resolved.append)
+        self.assertEqual(([], "bob"), (storage.calls, resolved[1]["username"]))
+
+    def test_unknown_session(self):
+        self.assertEqual(None, resolve(self.sessions, None))
+        self.assertEqual(None, resolve(self.sessions, new_token()))
+
+    def test_expired_session(self):
+        self.assertNotEqual(None, resolve(self.sessions, self.token))
+        self.clock.now += 61
+        self.assertEqual(None, resolve(self.sessions, self.token))
+
+    def test_disable_revokes_after_poll(self):
+        self.assertNotEqual(None, resolve(self.sessions, self.token))
+        with self.pool.connection() as db:
+            quarterapp.storage.disable_user(db, "bob")
+        self.assertNotEqual(None, resolve(self.sessions, self.token))
+        self.sessions.poll()
+        self.assertEqual(None, resolve(self.sessions, self.token))
+        with self.pool.connection() as db:
+            self.assertEqual(0, len(quarterapp.storage._query(db, "SELECT id FROM sessions;")))
+
+    def test_revocation_keeps_other_users_sessions(self):
+        other_token = self.create_session(self.clock.now + 60, self.other_user_id)
+        resolve(self.sessions, self.token)
+        resolve(self.sessions, other_token)
+        with self.pool.connection() as db:
+            quarterapp.storage.disable_user(db, "bob")
+        self.sessions.poll()
+        self.assertEqual(None, self.sessions.cached(self.token))
+        self.assertEqual("alice", self.sessions.cached(other_token)["username"])
+
+    def test_logout_is_not_broadcast(self):
+        other = SessionStore(self.pool, clock = self.clock)
+        other_token = self.create_session(self.clock.now + 60, self.other_user_id)
+        resolve(other, other_token)
+        with self.pool.connection() as db:
+            quarterapp.storage.delete_session(db, session_id(self.token))
+            self.assertEqual([], quarterapp.storage.get_session_revocations(db, 0))
+        other.poll()
+        self.assertEqual("alice", other.cached(other_token)["username"])
+        self.assertEqual(None, resolve(other, self.token))
+
+    def test_revocation_during_lookup_is_not_cached(self):
+        storage = DeferredStorage(self.pool)
+        sessions = SessionStore(self.pool, storage = storage, clock = self.clock)
+        sessions.resolve(self.token, lambda user: None)
+        fn, args, kwargs, looked_up = storage.calls.pop(0)
+        with self.pool.connection() as db:
+            row = fn(db, *args, **kwargs)
+            quarterapp.storage.disable_user(db, "bob")
+        sessions.poll()
+        storage.run()
+        looked_up((True, row))
+        self.assertEqual(None, sessions.cached(self.token))
+
+    def test_least_recently_used_is_dropped(self):
+        sessions = SessionStore(self.pool, max_cached = 2, clock = self.clock)
+        tokens = [self.token, self.create_session(self.clock.now + 60), self.create_session(self.clock.now + 60)]
+        for token in tokens:
+            resolve(sessions, token)
+        lookups = self.lookups()
+        resolve(sessions, tokens[2])
+        self.assertEqual(lookups, self.lookups())
+        resolve(sessions, tokens[0])
+        self.assertEqual(lookups + 1, self.lookups())
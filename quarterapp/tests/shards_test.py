@@ -0,0 +1,202 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  Permission is hereby granted, free of charge, to any person obtaining
+#  a copy of this software and associated documentation files (the
+#  "Software"), to deal in the Software without restriction, including
+#  without limitation the rights to use, copy, modify, merge, publish,
+#  distribute, sublicense, and/or sell copies of the Software, and to
+#  permit persons to whom the Software is furnished to do so, subject to
+#  the following conditions:
+#
+#  The above copyright notice and this permission notice shall be
+#  included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+#  LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+#  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from tornado import gen
+from tornado.testing import AsyncTestCase
+
+import quarterapp.storage
+import quarterapp.migrations
+from quarterapp.pool import ConnectionPool
+from quarterapp.shards import Shards, jump_hash, rebalance, purge_orphans
+from quarterapp.async_storage import AsyncStorage, StorageBusy
+from quarterapp.tests.storage_test import setup_sqlite
+
+# With two shards users 1 to 3 belong on the main database and 4 to 6 on the other shard
+ADMIN = 1
+MAIN_USER = 2
+SHARD_USER = 4
+
+class TestJumpHash(unittest.TestCase):
+    def test_is_stable(self):
+        self.assertEqual([0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1], [jump_hash(key, 2) for key in range(1, 12)])
+
+    def test_new_bucket_takes_keys_from_every_bucket(self):
+        moved = [key for key in range(10000) if jump_hash(key, 4) != jump_hash(key, 5)]
+        self.assertTrue(1800 < len(moved) < 2200)
+        self.assertEqual(set([4]), set(jump_hash(key, 5) for key in moved))
+
+class TestShards(AsyncTestCase):
+    """
+    The main database and a second shard are SQLite files, users 2 to 5 are
+    added after the directory migration and are not placed yet
+    """
+    def setUp(self):
+        super(TestShards, self).setUp()
+        self.filenames = []
+        self.main = self.create_database()
+        self.shard = self.create_database()
+        for user in range(2, 6):
+            quarterapp.storage.add_user(self.main, "user{0}@example.com".format(user), "")
+        self.pools = [ConnectionPool(lambda filename = filename: self.connect(filename), size = 2) for filename in self.filenames]
+        self.shards = Shards([("main", self.pools[0], None), ("shard", self.pools[1], None)], cache_ttl = 60)
+        self.storage = AsyncStorage(self.pools[0], io_loop = self.io_loop, shards = self.shards)
+
+    def tearDown(self):
+        self.storage.close()
+        self.pools[0].close()
+        for db in (self.main, self.shard):
+            db.close()
+        for filename in self.filenames:
+            os.remove(filename)
+        super(TestShards, self).tearDown()
+
+    def connect(self, filename):
+        return sqlite3.connect(filename, isolation_level = None, check_same_thread = False)
+
+    def create_database(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        db = setup_sqlite(filename)
+        quarterapp.migrations.migrate(db)
+        db.close()
+        self.filenames.append(filename)
+        return self.connect(filename)
+
+    def run_engine(self, fn):
+        """Run the given generator function to completion on the test IOLoop"""
+        @gen.engine
+        def run():
+            result = yield gen.Task(lambda callback: fn(callback))
+            self.stop(result)
+        run()
+        return self.wait()
+
+    def titles(self, db, user_id):
+        return [activity.title for activity in quarterapp.storage.get_activities(db, user_id)]
+
+    def test_users_are_placed_by_hash(self):
+        @gen.engine
+        def store(callback):
+            for user_id in (ADMIN, MAIN_USER, SHARD_USER):
+                yield self.storage.add_activity(user_id, "Work", "#fff")
+            activities = yield self.storage.get_activities(SHARD_USER)
+            callback(activities)
+        self.assertEqual(["Work"], [activity.title for activity in self.run_engine(store)])
+
+        self.assertEqual(["Work"], self.titles(self.main, ADMIN))
+        self.assertEqual(["Work"], self.titles(self.main, MAIN_USER))
+        self.assertEqual([], self.titles(self.main, SHARD_USER))
+        self.assertEqual(["Work"], self.titles(self.shard, SHARD_USER))
+        self.assertEqual(1, quarterapp.storage.get_user_shard(self.main, SHARD_USER).shard)
+
+    def test_user_with_data_in_main_database_stays(self):
+        quarterapp.storage.add_activity(self.main, SHARD_USER, "Before sharding", "#fff")
+
+        @gen.engine
+        def read(callback):
+            activities = yield self.storage.get_activities(SHARD_USER)
+            callback(activities)
+        self.assertEqual(["Before sharding"], [activity.title for activity in self.run_engine(read)])
+        self.assertEqual(0, quarterapp.storage.get_user_shard(self.main, SHARD_USER).shard)
+
+    def test_admin_wide_calls_fan_out(self):
+        quarterapp.storage.update_sheet(self.main, MAIN_USER, "2013-02-05", [-1] * 96)
+        quarterapp.storage.update_sheet(self.shard, SHARD_USER, "2013-02-05", [-1] * 96)
+        quarterapp.storage.update_sheet(self.shard, SHARD_USER, "2013-02-06", [-1] * 96)
+
+        @gen.engine
+        def count(callback):
+            sheets = yield self.storage.get_sheet_count()
+            callback(sheets)
+        self.assertEqual(3, self.run_engine(count))
+
+    def test_busy_fan_out_queues_nothing(self):
+        self.storage.close()
+        self.storage = AsyncStorage(self.pools[0], workers = 1, queue_size = 2, io_loop = self.io_loop, shards = self.shards)
+        release = threading.Event()
+        self.storage.submit(lambda db: release.wait(5), (), {}, lambda result: None)
+        time.sleep(0.05)
+        self.storage.submit(lambda db: None, (), {}, lambda result: None)
+        try:
+            self.assertRaises(StorageBusy, self.storage.submit, quarterapp.storage.get_sheet_count, (), {}, lambda result: None)
+            self.assertEqual(1, self.storage.pending())
+        finally:
+            release.set()
+
+    def test_moving_user_cannot_write(self):
+        quarterapp.storage.set_user_shard(self.main, SHARD_USER, 1)
+        quarterapp.storage.start_move(self.main, SHARD_USER, 1, 0)
+
+        @gen.engine
+        def store(callback):
+            yield self.storage.get_activities(SHARD_USER)
+            try:
+                yield self.storage.add_activity(SHARD_USER, "Work", "#fff")
+                callback("no error")
+            except StorageBusy:
+                callback("busy")
+        self.assertEqual("busy", self.run_engine(store))
+
+    def test_rebalance_moves_users_home(self):
+        quarterapp.storage.set_user_shard(self.main, SHARD_USER, 0)
+        quarterapp.storage.add_activity(self.shard, SHARD_USER + 1, "Taken id", "#fff")
+        work = quarterapp.storage.add_activity(self.main, SHARD_USER, "Work", "#fff")
+        rest = quarterapp.storage.add_activity(self.main, SHARD_USER, "Rest", "#fff")
+        quarterapp.storage.update_sheet(self.main, SHARD_USER, "2013-02-05", [work] * 48 + [rest] * 47 + [-1])
+
+        self.assertEqual(1, rebalance(self.main, [self.main, self.shard], wait = 0))
+
+        self.assertEqual(1, quarterapp.storage.get_user_shard(self.main, SHARD_USER).shard)
+        self.assertEqual([], quarterapp.storage.get_moves(self.main))
+        self.assertEqual([], self.titles(self.main, SHARD_USER))
+        self.assertEqual(None, quarterapp.storage.get_sheet(self.main, SHARD_USER, "2013-02-05"))
+        activities = dict((activity.title, activity.id) for activity in quarterapp.storage.get_activities(self.shard, SHARD_USER))
+        self.assertEqual([activities["Work"]] * 48 + [activities["Rest"]] * 47 + [-1],
+            list(quarterapp.storage.get_sheet(self.shard, SHARD_USER, "2013-02-05")))
+
+    def test_rebalance_finishes_interrupted_move(self):
+        # Interrupted after updating the directory, before deleting the data from the old shard
+        quarterapp.storage.start_move(self.main, SHARD_USER, 0, 1)
+        quarterapp.storage.set_user_shard(self.main, SHARD_USER, 1)
+        quarterapp.storage.add_activity(self.main, SHARD_USER, "Work", "#fff")
+        quarterapp.storage.add_activity(self.shard, SHARD_USER, "Work", "#fff")
+
+        self.assertEqual(0, rebalance(self.main, [self.main, self.shard], wait = 0))
+        self.assertEqual([], quarterapp.storage.get_moves(self.main))
+        self.assertEqual([], self.titles(self.main, SHARD_USER))
+        self.assertEqual(["Work"], self.titles(self.shard, SHARD_USER))
+
+    def test_purge_orphans_from_shard(self):
+        quarterapp.storage.add_activity(self.shard, SHARD_USER, "Work", "#fff")
+        quarterapp.storage.add_activity(self.shard, 100, "Deleted", "#fff")
+        quarterapp.storage.update_sheet(self.shard, 100, "2013-02-05", [-1] * 96)
+
+        self.assertEqual({ "activities" : 1, "sheets" : 1 }, purge_orphans(self.main, self.shard))
+        self.assertEqual(["Work"], self.titles(self.shard, SHARD_USER))
+        self.assertEqual([], self.titles(self.shard, 100))
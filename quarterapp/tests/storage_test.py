@@ -27,6 +27,8 @@ import sys
 import tempfile
 
 import quarterapp.storage
+import quarterapp.migrations
+import quarterapp.sheet_codec
 from quarterapp.settings import *
 from quarterapp.quarter_utils import *
 
@@ -59,7 +61,7 @@ CREATE TABLE `sheets` (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
     `user` INT(11) NOT NULL,
     `date` DATE NOT NULL,
-    `quarters` TEXT NOT NULL
+    `quarters` BLOB NOT NULL
 ) ;
 
 CREATE TABLE `settings` (
@@ -72,7 +74,7 @@ CREATE TABLE `settings` (
 CREATE TABLE `users` (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
     `username` VARCHAR(256) NOT NULL DEFAULT '',
-    `password` VARCHAR(90) NOT NULL DEFAULT '',
+    `password` VARCHAR(255) NOT NULL DEFAULT '',
     `type` TINYINT NOT NULL DEFAULT '0',
     `state`  TINYINT NOT NULL DEFAULT '0',
     `last_login` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -122,6 +124,7 @@ class TestStorage(unittest.TestCase):
             fd, temp_name = tempfile.mkstemp()
             os.close(fd) #Don't need the fd
             cls.db = setup_sqlite(temp_name)
+        quarterapp.migrations.migrate(cls.db)
 
     @classmethod
     def tearDownClass(cls):
@@ -179,10 +182,132 @@ class TestStorage(unittest.TestCase):
         sheet = quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2013-02-05")
         self.assertIsNone(sheet)
 
-        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-05", str(default_sheet()))
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-05", default_sheet())
         sheet = quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2012-02-05")
         
         self.assertIsNotNone(sheet)
+        self.assertEqual(default_sheet(), list(sheet))
+
+    def test_update_existing_sheet(self):
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-07", default_sheet())
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-07", [3] * 96)
+
+        sheet = quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2012-02-07")
+        self.assertEqual([3] * 96, list(sheet))
+        rows = quarterapp.storage._query(self.db, "SELECT id FROM sheets WHERE date='2012-02-07';")
+        self.assertEqual(1, len(rows))
+
+    def test_sheet_version(self):
+        self.assertEqual((0, None), quarterapp.storage.get_sheet_version(self.db, BOB_THE_USER, "2012-02-07"))
+        self.assertEqual(1, quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-07", default_sheet()))
+        self.assertEqual(2, quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-07", [3] * 96))
+        quarterapp.storage.update_sheets(self.db, BOB_THE_USER, [("2012-02-07", [4] * 96), ("2012-02-08", [4] * 96)])
+
+        version, quarters = quarterapp.storage.get_sheet_version(self.db, BOB_THE_USER, "2012-02-07")
+        self.assertEqual((3, [4] * 96), (version, list(quarters)))
+        self.assertEqual(1, quarterapp.storage.get_sheet_version(self.db, BOB_THE_USER, "2012-02-08")[0])
+
+    def test_patch_sheet(self):
+        self.assertEqual((1, { -1 : -4, 3 : 4 }), quarterapp.storage.patch_sheet(self.db, BOB_THE_USER, "2012-02-07", [(4, 7, 3)]))
+        self.assertEqual((1, {}), quarterapp.storage.patch_sheet(self.db, BOB_THE_USER, "2012-02-07", [(5, 6, 3)]))
+        self.assertEqual((2, { 3 : -1, 2 : 1 }), quarterapp.storage.patch_sheet(self.db, BOB_THE_USER, "2012-02-07", [(7, 7, 2)]))
+        self.assertEqual([-1] * 4 + [3] * 3 + [2] + [-1] * 88, list(quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2012-02-07")))
+
+    def test_patch_sheet_stale_version(self):
+        self.assertEqual((1, { -1 : -4, 3 : 4 }), quarterapp.storage.patch_sheet(self.db, BOB_THE_USER, "2012-02-07", [(4, 7, 3)], 0))
+        with self.assertRaises(quarterapp.storage.StaleSheet) as raised:
+            quarterapp.storage.patch_sheet(self.db, BOB_THE_USER, "2012-02-07", [(8, 8, 2)], 0)
+        self.assertEqual(1, raised.exception.version)
+        self.assertEqual([-1] * 4 + [3] * 4 + [-1] * 88, list(raised.exception.quarters))
+
+        self.assertEqual((2, { -1 : -1, 2 : 1 }), quarterapp.storage.patch_sheet(self.db, BOB_THE_USER, "2012-02-07", [(8, 8, 2)], 1))
+        with self.assertRaises(quarterapp.storage.StaleSheet):
+            quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-07", [5] * 96, 1)
+        self.assertEqual(3, quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-07", [5] * 96, 2))
+        self.assertEqual([5] * 96, list(quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2012-02-07")))
+
+    def patch_sheet_written_in_between(self, date, runs, times):
+        """
+        Patch a sheet while another writer gets in between the first times
+        reads and writes of it, return the other writer's versions and the
+        patch_sheet result or exception
+        """
+        writes = []
+        apply_runs = quarterapp.sheet_codec.apply_runs
+        def apply_runs_after_write(quarters, runs):
+            if len(writes) < times:
+                writes.append(quarterapp.storage.update_sheet(self.db, BOB_THE_USER, date, [5] * 96))
+            return apply_runs(quarters, runs)
+
+        quarterapp.sheet_codec.apply_runs = apply_runs_after_write
+        try:
+            return writes, quarterapp.storage.patch_sheet(self.db, BOB_THE_USER, date, runs)
+        except quarterapp.storage.StaleSheet, stale:
+            return writes, stale
+        finally:
+            quarterapp.sheet_codec.apply_runs = apply_runs
+
+    def test_patch_sheet_written_in_between(self):
+        # A sheet inserted in between is patched on the next attempt
+        writes, result = self.patch_sheet_written_in_between("2012-02-07", [(4, 7, 3)], 1)
+        self.assertEqual(([1], (2, { 5 : -4, 3 : 4 })), (writes, result))
+
+        writes, stale = self.patch_sheet_written_in_between("2012-02-08", [(4, 7, 3)], 100)
+        self.assertEqual(quarterapp.storage.PATCH_SHEET_ATTEMPTS, len(writes))
+        self.assertIsInstance(stale, quarterapp.storage.StaleSheet)
+        self.assertEqual((writes[-1], [5] * 96), (stale.version, list(stale.quarters)))
+
+    def test_update_sheets(self):
+        written = quarterapp.storage.update_sheets(self.db, BOB_THE_USER,
+            [("2012-03-01", [1] * 96), ("2012-03-02", [2] * 96)])
+        self.assertEqual(2, written)
+        sheets = quarterapp.storage.get_sheets(self.db, BOB_THE_USER, "2012-03-01", "2012-03-02")
+        self.assertEqual([("2012-03-01", [1] * 96), ("2012-03-02", [2] * 96)],
+            [(date, list(quarters)) for date, quarters in sheets])
+
+    def test_update_sheets_rolls_back(self):
+        with self.assertRaises(ValueError):
+            quarterapp.storage.update_sheets(self.db, BOB_THE_USER, [("2012-03-05", [1] * 96), ("2012-03-06", [2] * 95)])
+        with self.assertRaises(sqlite3.Error):
+            with quarterapp.storage.transaction(self.db):
+                quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-03-05", [1] * 96)
+                quarterapp.storage._exec(self.db, "INSERT INTO no_such_table VALUES(1);")
+        self.assertEqual([], quarterapp.storage.get_sheets(self.db, BOB_THE_USER, "2012-03-05", "2012-03-06"))
+
+    def test_get_sheets_in_range(self):
+        for date, activity in (("2013-01-31", 1), ("2013-02-01", 2), ("2013-02-03", 3), ("2013-02-04", 4)):
+            quarterapp.storage.update_sheet(self.db, BOB_THE_USER, date, [activity] * 96)
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER + 1, "2013-02-02", default_sheet())
+
+        sheets = quarterapp.storage.get_sheets(self.db, BOB_THE_USER, "2013-02-01", "2013-02-03")
+        self.assertEqual(["2013-02-01", "2013-02-03"], [date for date, quarters in sheets])
+        self.assertEqual([2] * 96, list(sheets[0][1]))
+
+        self.assertEqual([], quarterapp.storage.get_sheets(self.db, BOB_THE_USER, "2012-01-01", "2012-12-31"))
+
+    def test_stream_sheets_in_chunks(self):
+        for day in range(1, 6):
+            quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-02-{0:02d}".format(day), [day] * 96)
+
+        chunks = []
+        count = quarterapp.storage.stream_sheets(self.db, BOB_THE_USER, "2013-02-01", "2013-02-28", chunks.append, chunk_size = 2)
+        self.assertEqual(5, count)
+        self.assertEqual([["2013-02-01", "2013-02-02"], ["2013-02-03", "2013-02-04"], ["2013-02-05"]],
+            [[date for date, quarters in chunk] for chunk in chunks])
+        self.assertEqual([5] * 96, list(chunks[-1][0][1]))
+
+    def test_pack_legacy_sheets(self):
+        legacy = ",".join(["-1"] * 48 + ["7"] * 48)
+        quarterapp.storage._exec(self.db, "INSERT INTO sheets (user, date, quarters) VALUES(%(user)s, %(date)s, %(quarters)s);",
+            { "user" : BOB_THE_USER, "date" : "2012-02-06", "quarters" : legacy })
+        sheet = quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2012-02-06")
+        self.assertEqual([-1] * 48 + [7] * 48, list(sheet))
+
+        self.assertEqual(1, quarterapp.storage.pack_sheets(self.db, batch_size = 1))
+        self.assertEqual(0, quarterapp.storage.pack_sheets(self.db))
+
+        sheet = quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2012-02-06")
+        self.assertEqual([-1] * 48 + [7] * 48, list(sheet))
 
 
     ## Signup tests
@@ -205,6 +330,35 @@ class TestStorage(unittest.TestCase):
         result = quarterapp.storage.activate_user(self.db, "sleepy", "mybloodyvalentine")
         self.assertTrue(result)
 
+    def test_user_activation_rolls_back(self):
+        quarterapp.storage.signup_user(self.db, "one@example.com", "sleepy", "127.0.0.1")
+        quarterapp.storage._exec(self.db, "CREATE TRIGGER keep_signups BEFORE DELETE ON signups BEGIN SELECT RAISE(ABORT, 'kept'); END;")
+        try:
+            self.assertRaises(sqlite3.Error, quarterapp.storage.activate_user, self.db, "sleepy", "mybloodyvalentine")
+        finally:
+            quarterapp.storage._exec(self.db, "DROP TRIGGER keep_signups;")
+        self.assertIsNone(quarterapp.storage.get_login(self.db, "one@example.com"))
+        self.assertTrue(quarterapp.storage.activate_user(self.db, "sleepy", "mybloodyvalentine"))
+
+    def test_password_hash_round_trips(self):
+        hashed = make_password("mybloodyvalentine", 1000)
+        self.assertTrue(len(hashed) <= 255) # users.password is a VARCHAR(255)
+
+        quarterapp.storage.signup_user(self.db, "one@example.com", "sleepy", "127.0.0.1")
+        self.assertTrue(quarterapp.storage.activate_user(self.db, "sleepy", hashed))
+        user = quarterapp.storage.get_login(self.db, "one@example.com")
+        self.assertEqual(hashed, user.password)
+        self.assertEqual((True, None), check_password("mybloodyvalentine", user.password, "", 1000))
+
+        hashed = make_password("loveless", 1000)
+        quarterapp.storage.set_password(self.db, user.id, hashed)
+        self.assertEqual(hashed, quarterapp.storage.get_login(self.db, "one@example.com").password)
+
+        hashed = make_password("isnt anything", 1000)
+        quarterapp.storage.set_user_reset_code(self.db, "one@example.com", "okay")
+        self.assertTrue(quarterapp.storage.reset_password(self.db, "okay", hashed))
+        self.assertEqual(hashed, quarterapp.storage.get_login(self.db, "one@example.com").password)
+
     def test_many_signups(self):
         quarterapp.storage.signup_user(self.db, "one@example.com", "sleepy", "127.0.0.1")
         quarterapp.storage.signup_user(self.db, "two@example.com", "sleepy", "127.0.0.1")
@@ -245,6 +399,36 @@ class TestStorage(unittest.TestCase):
         user_count = quarterapp.storage.get_user_count(self.db)
         self.assertEqual(2, user_count)
 
+    def test_delete_user_cascades(self):
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword")
+        quarterapp.storage.add_user(self.db, "alice@example.com", "secretpassword")
+        bob, alice = [user.id for user in quarterapp.storage.get_users(self.db)]
+        for user in (bob, alice):
+            quarterapp.storage.add_activity(self.db, user, "Work", "#ff0000")
+            quarterapp.storage.update_sheets(self.db, user, [("2013-02-0{0}".format(day), default_sheet()) for day in range(1, 6)])
+
+        progress = []
+        deleted = quarterapp.storage.delete_user(self.db, "bob@example.com", chunk_size = 2,
+            progress = lambda table, count: progress.append((table, count)))
+
+        self.assertEqual({ "users" : 1, "activities" : 1, "sheets" : 5 }, deleted)
+        self.assertEqual([("sheets", 2), ("sheets", 4), ("sheets", 5), ("activities", 1)], progress)
+        self.assertEqual([], quarterapp.storage.get_sheets(self.db, bob, "2013-01-01", "2013-12-31"))
+        self.assertEqual([], quarterapp.storage.get_activities(self.db, bob))
+        self.assertEqual(5, len(quarterapp.storage.get_sheets(self.db, alice, "2013-01-01", "2013-12-31")))
+        self.assertEqual(1, len(quarterapp.storage.get_activities(self.db, alice)))
+
+    def test_purge_orphans(self):
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword")
+        bob = quarterapp.storage.get_users(self.db)[0].id
+        for user in (bob, bob + 1):
+            quarterapp.storage.add_activity(self.db, user, "Work", "#ff0000")
+            quarterapp.storage.update_sheets(self.db, user, [("2013-02-01", default_sheet()), ("2013-02-02", default_sheet())])
+
+        self.assertEqual({ "activities" : 1, "sheets" : 2 }, quarterapp.storage.purge_orphans(self.db, chunk_size = 1))
+        self.assertEqual(2, len(quarterapp.storage.get_sheets(self.db, bob, "2013-01-01", "2013-12-31")))
+        self.assertEqual({ "activities" : 0, "sheets" : 0 }, quarterapp.storage.purge_orphans(self.db))
+
     def test_authenticate_user(self):
         quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword")
         quarterapp.storage.add_user(self.db, "bobby@example.com", "secretpassword")
@@ -355,6 +539,63 @@ class TestStorage(unittest.TestCase):
         result = quarterapp.storage.get_filtered_users(self.db, ".com", 1)
         self.assertEqual(4, len(result))
 
+    def test_get_users_after_id(self):
+        for i in range(6):
+            quarterapp.storage.add_user(self.db, "user{0}@{1}.com".format(i, "example" if i % 2 else "internet"), "secretpassword")
+        ids = [user.id for user in quarterapp.storage.get_users(self.db)]
+
+        result = quarterapp.storage.get_users(self.db, count = 2, after_id = ids[1])
+        self.assertEqual(ids[2:4], [user.id for user in result])
+
+        result = quarterapp.storage.get_filtered_users(self.db, "example", count = 5, after_id = ids[1])
+        self.assertEqual([ids[3], ids[5]], [user.id for user in result])
+
+        self.assertEqual(ids[4:], quarterapp.storage.get_user_ids_after(self.db, ids[3], 10))
+        self.assertEqual([ids[3], ids[2]], quarterapp.storage.get_user_ids_through(self.db, ids[3], 2))
+        self.assertEqual([ids[3], ids[1]], quarterapp.storage.get_user_ids_through(self.db, ids[3], 10, "example"))
+
+    def test_row_access(self):
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword")
+        user = quarterapp.storage.get_users(self.db)[0]
+        self.assertEqual("bob@example.com", user.username)
+        self.assertEqual("bob@example.com", user["username"])
+        self.assertEqual(user.id, user[0])
+        self.assertEqual("bob@example.com", dict(user)["username"])
+        self.assertRaises(AttributeError, getattr, user, "password")
+        self.assertRaises(KeyError, lambda: user["password"])
+
+    def test_iter_query(self):
+        for i in range(5):
+            quarterapp.storage.add_user(self.db, "user{0}@example.com".format(i), "secretpassword")
+        rows = quarterapp.storage._iter_query(self.db, "SELECT username FROM users ORDER BY id;", chunk_size = 2)
+        self.assertEqual(["user{0}@example.com".format(i) for i in range(5)], [row.username for row in rows])
+
+    def test_apply_pragmas(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        db = sqlite3.connect(filename, isolation_level = None)
+        try:
+            quarterapp.storage.apply_pragmas(db, { "journal_mode" : "wal", "synchronous" : "normal",
+                "cache_size" : -8000, "temp_store" : "memory", "busy_timeout" : 1000, "mmap_size" : None })
+            pragmas = quarterapp.storage.get_pragmas(db)
+            self.assertEqual({ "journal_mode" : "wal", "synchronous" : "normal", "cache_size" : -8000,
+                "temp_store" : "memory", "busy_timeout" : 1000, "mmap_size" : 0 }, pragmas)
+            self.assertRaises(ValueError, quarterapp.storage.apply_pragmas, db, { "journal_mode" : "wal; DROP TABLE users" })
+        finally:
+            db.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+
+    def test_statement_registry_is_bounded(self):
+        dialect = quarterapp.storage.Dialect("sqlite", quarterapp.storage.SQLITE.translate, "BEGIN;", max_statements = 2)
+        statement = quarterapp.storage.Statement("SELECT %(a)s;", sqlite = "SELECT %(b)s;")
+        for i in range(5):
+            self.assertEqual("SELECT id FROM users WHERE id IN (?{0});".format(", ?" * i),
+                dialect.sql("SELECT id FROM users WHERE id IN (%s{0});".format(", %s" * i)))
+        self.assertEqual("SELECT :b;", dialect.sql(statement))
+        self.assertEqual(3, len(dialect.statements))
+        self.assertEqual("SELECT :b;", dialect.statements[statement])
 
     ## Test settings
 
@@ -397,6 +638,32 @@ class TestStorage(unittest.TestCase):
         self.assertEqual("0", quarterapp.storage.get_setting(self.db, "allow-signups"))
         settings.put_value("allow-signups", "1")
         
+    def test_poll_reloads_changed_settings(self):
+        settings = QuarterSettings(self.db)
+        quarterapp.storage.put_setting(self.db, "allow-signups", "0")
+        self.assertEqual("1", settings.get_value("allow-signups"))
+        settings.poll()
+        self.assertEqual("0", settings.get_value("allow-signups"))
+        quarterapp.storage.put_setting(self.db, "allow-signups", "1")
+
+    def test_poll_checks_notification_file(self):
+        fd, notify_path = tempfile.mkstemp()
+        os.close(fd)
+        os.utime(notify_path, (0, 0))
+        try:
+            settings = QuarterSettings(self.db, notify_path = notify_path)
+            other = QuarterSettings(self.db, notify_path = notify_path)
+            quarterapp.storage.put_setting(self.db, "allow-signups", "0")
+            settings.poll()
+            self.assertEqual("1", settings.get_value("allow-signups"))
+
+            other.put_value("allow-signups", "0")
+            settings.poll()
+            self.assertEqual("0", settings.get_value("allow-signups"))
+            other.put_value("allow-signups", "1")
+        finally:
+            os.remove(notify_path)
+
     def test_settings_db(self):
         quarterapp.storage.put_setting(self.db, "allow-signups", "w")
         self.assertEqual("w", quarterapp.storage.get_setting(self.db, "allow-signups"))
@@ -44,6 +44,28 @@ class TestUnit(unittest.TestCase):
         self.assertEqual( hash_password("secret", "salt"), hash_password("secret", "salt"))
         self.assertNotEqual( hash_password("secret", "salt"), hash_password("secret", "pepper"))
 
+    def test_make_password(self):
+        hashed = make_password("secret", 10)
+        algorithm, iterations, salt, digest = hashed.split("$")
+        self.assertEqual(("pbkdf2_sha512", "10"), (algorithm, iterations))
+        self.assertNotEqual(hashed, make_password("secret", 10))
+        self.assertEqual(hashed, make_password("secret", 10, salt))
+
+    def test_check_password(self):
+        hashed = make_password("secret", 10)
+        self.assertEqual((True, None), check_password("secret", hashed, "salt", 10))
+        self.assertEqual((False, None), check_password("Secret", hashed, "salt", 10))
+        self.assertEqual((False, None), check_password("secret", "", "salt", 10))
+
+    def test_check_password_upgrades(self):
+        valid, upgraded = check_password("secret", hash_password("secret", "salt"), "salt", 10)
+        self.assertTrue(valid)
+        self.assertEqual((True, None), check_password("secret", upgraded, "salt", 10))
+        self.assertEqual((False, None), check_password("secret", hash_password("secret", "pepper"), "salt", 10))
+
+        valid, upgraded = check_password("secret", make_password("secret", 10), "salt", 20)
+        self.assertEqual("20", upgraded.split("$")[1])
+
     def test_valid_date(self):
         self.assertTrue(valid_date("2013-01-29"))
         self.assertTrue(valid_date("1999-12-29"))